@@ -0,0 +1,621 @@
+#!/usr/bin/env python3
+"""
+Compute MHIT streamflow statistics by era directly from daily streamflow CSV data.
+
+The published statistics of https://doi.org/10.5066/P9EBKREQ (see stat_vars_dict
+in data/preprocess/luts.py) are only available for fixed eras. This script
+computes them from the same daily streamflow CSVs that
+process_streamflow_climatology.py ingests, so they can be computed for any era
+or new model run. The statistics come in families:
+    magnitude: ma3, ma4, ma12-ma23, mh14, ml17, sum_cv, mh20, spr_mag, sum_mag, lf1
+    duration: dh1-dh5, dl1-dl5, dh15, dl16, spr_dur3, spr_dur7, sum_dur3, sum_dur7
+    frequency: fh1, fh5, fh6, fh7, fl1, fl3, spr_freq, sum_freq
+    timing: th1, tl1, spr_ord, sum_ord
+    rate: ra1, ra3, ra8
+
+All streams of a block are processed at once as a float32 (day, stream) array:
+moving averages (1, 3, 7, 30 and 90 days) come from cumulative sums, and annual
+values from reductions over each water year (October 1 through September 30),
+so there are no loops over streams. The flows of a block are sorted once for
+all percentiles. Flow events (pulses) are runs of days above or below a
+threshold, found from the days where the threshold mask turns on. Julian dates
+are summarized with a circular median, so that dates on either side of the new
+year are close together. Moving averages run over the
+whole era, so windows can span the start of a water year.
+
+Statistics that need the drainage area of each stream (mh20, spr_mag, sum_mag,
+lf1) are only computed if a drainage area CSV is given.
+
+Example usage:
+--------------
+python compute_mhit_stats.py \
+    input_streamflow.csv \   # Input CSV (or Parquet) file path
+    output_mhit_stats.nc \   # Output NetCDF file path
+    --drainage-area area.csv \  # Optional CSV with stream_id and area_sqmi columns
+    --eras 1976-2005 \       # Optional water year eras, defaults to those of the filename
+    --stream-chunk-size 2000 # Optional number of streams to process at once
+--------------
+
+"""
+
+import os
+import sys
+import argparse
+import warnings
+from functools import cached_property
+from pathlib import Path
+import pyarrow.csv as csv
+import pyarrow.parquet as pq
+import xarray as xr
+import pandas as pd
+import numpy as np
+from luts import mhit_stat_vars_dict
+from process_streamflow_climatology import get_landcover_model_rcp_from_filename, get_eras
+
+
+MOVING_AVERAGE_DAYS = [1, 3, 7, 30, 90]
+SPRING_MONTHS = [4, 5, 6]
+SUMMER_MONTHS = [7, 8, 9]
+# percentiles of the logs of daily flows for ma4
+MA4_PERCENTILES = np.arange(5, 100, 5)
+# flows of zero have no log, so they are set to this value for ma4
+MA4_ZERO_FLOW = 0.01
+# lf1 threshold, in cfs per square mile of drainage area
+LF1_THRESHOLD = 0.1
+# thresholds of the seasonal event counts, as percentiles of the flows of the era, as in the published definitions
+SPR_FREQ_PERCENTILE = 10
+SUM_FREQ_PERCENTILE = 90
+# fl3 threshold, as a fraction of the mean flow of the era
+FL3_FRACTION = 0.05
+# number of days of the circle of Julian dates
+DAYS_PER_YEAR = 366
+
+STAT_FAMILIES = ["magnitude", "duration", "frequency", "timing", "rate"]
+AREA_STATS = ["mh20", "spr_mag", "sum_mag", "lf1"]
+
+
+def parse_arguments():
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Compute MHIT streamflow statistics by era from a daily streamflow CSV",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+
+    parser.add_argument(
+        "input_csv",
+        type=str,
+        help="Path to input CSV file containing streamflow data (or a Parquet file made from it)"
+    )
+
+    parser.add_argument(
+        "output_netcdf",
+        type=str,
+        help="Path for output NetCDF file with the statistics"
+    )
+
+    parser.add_argument(
+        "--drainage-area",
+        type=str,
+        default=None,
+        help="CSV file with stream_id and area_sqmi columns, needed for " + ", ".join(AREA_STATS)
+    )
+
+    parser.add_argument(
+        "--eras",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Water year eras to compute, e.g. 1976-2005 2046-2075 (default: the eras of the filename)"
+    )
+
+    parser.add_argument(
+        "--families",
+        type=str,
+        nargs="+",
+        choices=STAT_FAMILIES,
+        default=STAT_FAMILIES,
+        help="Families of statistics to compute"
+    )
+
+    parser.add_argument(
+        "--stream-chunk-size",
+        type=int,
+        default=2000,
+        help="Number of streams to process at once"
+    )
+
+    return parser.parse_args()
+
+
+def parse_eras(eras):
+    """Convert eras like 1976-2005 to (start date, end date) water year eras."""
+    parsed = []
+    for era in eras:
+        start_year, end_year = era.split("-")
+        parsed.append((f"{start_year}-10-01", f"{end_year}-09-30"))
+
+    return parsed
+
+
+def read_streamflow(input_path):
+    """Read a daily streamflow CSV (or Parquet) file as a pyarrow Table, with the dates as numpy datetime64."""
+    if Path(input_path).suffix == ".parquet":
+        table = pq.read_table(input_path)
+    else:
+        table = csv.read_csv(
+            input_path,
+            read_options=csv.ReadOptions(block_size=1 << 30),  # 1 GB chunks
+            convert_options=csv.ConvertOptions(strings_can_be_null=True, null_values=["", "NA", "NaN"]),
+        )
+    dates = pd.to_datetime(table["Date"].to_pandas()).to_numpy().astype("datetime64[D]")
+
+    return table, dates
+
+
+def read_drainage_area(area_csv, stream_ids):
+    """Read the drainage area of each stream in square miles, NaN for streams that are not in the file."""
+    areas = pd.read_csv(area_csv, usecols=["stream_id", "area_sqmi"])
+    areas = areas.drop_duplicates("stream_id").set_index("stream_id")["area_sqmi"]
+
+    return areas.reindex(stream_ids).to_numpy(dtype=np.float32)
+
+
+def get_calendar(dates):
+    """Get the water year and month boundaries of a daily record, as indices into the days.
+
+    Returns a dict with the index of the first day of each water year ("year_starts"),
+    the calendar month and Julian date of each day ("month", "doy"), the index of
+    the first day of each (water year, month) period ("month_starts") and the
+    calendar month of each period ("period_month").
+    """
+    dates = pd.DatetimeIndex(dates)
+    month = dates.month.to_numpy()
+    water_year = dates.year.to_numpy() + (month >= 10)
+    year_starts = np.flatnonzero(np.diff(water_year, prepend=water_year[0] - 1))
+    month_starts = np.flatnonzero(np.diff(water_year * 12 + month, prepend=-1))
+
+    return {
+        "year_starts": year_starts,
+        "month": month,
+        "doy": dates.dayofyear.to_numpy(),
+        "month_starts": month_starts,
+        "period_month": month[month_starts],
+    }
+
+
+def reduce_periods(func, values, starts, **kwargs):
+    """Reduce the values of each period (e.g. water year) over the day axis (0), given the first day of each period.
+
+    Each period is a contiguous block of days, so this is a short loop over periods that is vectorized over streams,
+    which is much faster than ufunc.reduceat over the first axis.
+    """
+    ends = np.append(starts[1:], len(values))
+
+    return np.stack([func(values[start:end], axis=0, **kwargs) for start, end in zip(starts, ends)])
+
+
+class FlowBlock:
+    """Daily flows of a block of streams (day, stream) for an era, with the intermediate arrays shared by the statistics.
+
+    The sorted flows (for percentiles), day to day changes and cumulative sums (for moving averages) are computed once,
+    when first needed.
+    """
+
+    def __init__(self, flows, calendar, area=None):
+        self.flows = flows
+        self.calendar = calendar
+        self.area = area
+
+    @cached_property
+    def sorted_flows(self):
+        return np.sort(self.flows, axis=0)
+
+    @cached_property
+    def changes(self):
+        # change in flow from the previous day, NaN for the first day of the era
+        changes = np.full(self.flows.shape, np.nan, dtype=np.float32)
+        np.subtract(self.flows[1:], self.flows[:-1], out=changes[1:])
+
+        return changes
+
+    @cached_property
+    def cumsum(self):
+        # running sums of the valid flows and running counts of the missing flows, so that a missing day only
+        # affects the moving averages of the windows that contain it
+        # float64 so that differencing the sums doesn't lose precision
+        # accumulating day by day is vectorized over streams, and much faster than np.cumsum over the first axis
+        missing = np.isnan(self.flows)
+        flows = np.where(missing, 0, self.flows)
+        cumsum = np.empty(self.flows.shape, dtype=np.float64)
+        cumsum[0] = flows[0]
+        for day in range(1, len(flows)):
+            np.add(cumsum[day - 1], flows[day], out=cumsum[day])
+        counts = np.empty(self.flows.shape, dtype=np.int32)
+        counts[0] = missing[0]
+        for day in range(1, len(missing)):
+            np.add(counts[day - 1], missing[day], out=counts[day])
+
+        return cumsum, counts
+
+    def moving_average(self, days):
+        """Trailing moving average of the daily flows, NaN for the first days - 1 days of the era.
+
+        Windows with a missing flow are NaN.
+        """
+        if days == 1:
+            return self.flows
+
+        cumsum, counts = self.cumsum
+        averages = np.full(self.flows.shape, np.nan, dtype=np.float32)
+        averages[days - 1] = np.where(counts[days - 1] > 0, np.nan, cumsum[days - 1] / days)
+        averages[days:] = np.where(counts[days:] > counts[:-days], np.nan, (cumsum[days:] - cumsum[:-days]) / days)
+
+        return averages
+
+    def percentile(self, q, transform=None):
+        """Percentiles of the daily flows of the era, interpolated between the ordered flows as in the MHIT definitions.
+
+        This is np.percentile(..., method="weibull") from the sorted flows, so one sort serves every percentile.
+        transform is an optional increasing function applied to the flows first, e.g. a log.
+        Streams with missing flows are NaN.
+        """
+        ordered = self.sorted_flows if transform is None else transform(self.sorted_flows)
+        n = len(ordered)
+        position = np.clip((n + 1) * np.asarray(q, dtype=np.float64) / 100 - 1, 0, n - 1)
+        below = np.floor(position).astype(int)
+        above = np.minimum(below + 1, n - 1)
+        weight = (position - below).reshape(position.shape + (1,))
+        values = ordered[below] + (ordered[above] - ordered[below]) * weight
+
+        # NaN sort last
+        return np.where(np.isnan(self.sorted_flows[-1]), np.nan, values)
+
+
+def mask_months(values, calendar, months):
+    """Set the values of days outside of months to NaN."""
+    return np.where(np.isin(calendar["month"], months)[:, None], values, np.nan)
+
+
+def annual_max(values, calendar):
+    """Maximum of each water year, ignoring NaN (NaN for years without values)."""
+    return reduce_periods(np.fmax.reduce, values, calendar["year_starts"])
+
+
+def annual_min(values, calendar):
+    """Minimum of each water year, ignoring NaN (NaN for years without values)."""
+    return reduce_periods(np.fmin.reduce, values, calendar["year_starts"])
+
+
+def annual_sum(values, calendar):
+    """Sum of each water year, in float64 for floats."""
+    dtype = np.float64 if values.dtype.kind == "f" else np.int32
+
+    return reduce_periods(np.sum, values, calendar["year_starts"], dtype=dtype)
+
+
+def annual_moments(values, calendar):
+    """Mean and standard deviation (ddof=1) of each water year, ignoring NaN."""
+    valid = ~np.isnan(values)
+    count = annual_sum(valid, calendar)
+    values = np.where(valid, values, 0)
+    total = annual_sum(values, calendar)
+    squares = annual_sum(values.astype(np.float64) ** 2, calendar)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = total / count
+        variance = (squares - total * mean) / (count - 1)
+
+    return mean, np.sqrt(np.maximum(variance, 0))
+
+
+def annual_median(values, calendar):
+    """Median of each water year."""
+    return reduce_periods(np.median, values, calendar["year_starts"])
+
+
+def annual_events(mask, calendar):
+    """Number of days and number of events (runs of consecutive days) where mask is True in each water year.
+
+    Runs are found for all streams at once from the days where mask turns True.
+    Events that continue into a water year count as starting on its first day.
+    """
+    starts = mask.copy()
+    starts[1:] &= ~mask[:-1]
+    starts[calendar["year_starts"]] = mask[calendar["year_starts"]]
+
+    return annual_sum(mask, calendar), annual_sum(starts, calendar)
+
+
+def annual_pulse_durations(mask, calendar):
+    """Average duration in days of the events where mask is True in each water year, NaN for years without events."""
+    n_days, n_events = annual_events(mask, calendar)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(n_events > 0, n_days / n_events, np.nan)
+
+
+def annual_dates(values, calendar, func):
+    """Julian date of the day of each water year selected by func (np.argmax or np.argmin), NaN for years without values.
+
+    NaN values are never selected, and ties go to the first day.
+    """
+    fill = -np.inf if func is np.argmax else np.inf
+    filled = np.where(np.isnan(values), fill, values)
+    days = reduce_periods(func, filled, calendar["year_starts"]) + calendar["year_starts"][:, None]
+    dates = calendar["doy"][days].astype(np.float32)
+    dates[np.isnan(annual_max(values, calendar))] = np.nan
+
+    return dates
+
+
+def circular_median(dates):
+    """Median of Julian dates (1-366) across water years (axis 0), ignoring NaN.
+
+    The dates are centred on their circular mean before taking the median, so that dates around the new year
+    (e.g. 365 and 2) are close together. This equals the usual median only when all dates lie within half a year of
+    their circular mean. The median is rounded to a whole day, so that the middle of two dates that straddle the
+    new year (e.g. 366 and 1) stays a valid Julian date.
+    """
+    angles = 2 * np.pi * (dates - 1) / DAYS_PER_YEAR
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=RuntimeWarning)
+        mean_angle = np.arctan2(np.nanmean(np.sin(angles), axis=0), np.nanmean(np.cos(angles), axis=0))
+        mean = np.remainder(mean_angle * DAYS_PER_YEAR / (2 * np.pi), DAYS_PER_YEAR)
+        centred = np.remainder(dates - 1 - mean + DAYS_PER_YEAR / 2, DAYS_PER_YEAR)
+        median = np.nanmedian(centred, axis=0)
+
+    return np.remainder(np.round(median + mean - DAYS_PER_YEAR / 2), DAYS_PER_YEAR) + 1
+
+
+def across_years(func, values):
+    """Reduce annual values across water years (axis 0), ignoring years without values."""
+    with warnings.catch_warnings():
+        # streams without any values are left as NaN
+        warnings.filterwarnings("ignore", category=RuntimeWarning)
+        return func(values, axis=0)
+
+
+def compute_magnitude_stats(block):
+    """Compute the magnitude statistics of a FlowBlock."""
+    flows, calendar, area = block.flows, block.calendar, block.area
+    stats = {}
+
+    mean, std = annual_moments(flows, calendar)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        stats["ma3"] = across_years(np.nanmean, std / mean * 100)
+
+    log_percentiles = block.percentile(MA4_PERCENTILES, lambda x: np.log10(np.where(x > 0, x, MA4_ZERO_FLOW)))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        stats["ma4"] = log_percentiles.std(axis=0, ddof=1) / log_percentiles.mean(axis=0) * 100
+
+    # mean of the (water year, month) means for each calendar month
+    period_means = reduce_periods(np.mean, flows, calendar["month_starts"], dtype=np.float64)
+    for month in range(1, 13):
+        stats[f"ma{month + 11}"] = period_means[calendar["period_month"] == month].mean(axis=0)
+
+    annual_maxima = annual_max(flows, calendar)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        stats["mh14"] = across_years(np.nanmedian, annual_maxima / annual_median(flows, calendar))
+        stats["ml17"] = across_years(np.nanmedian, annual_min(block.moving_average(7), calendar) / mean)
+
+    summer_flows = mask_months(flows, calendar, SUMMER_MONTHS)
+    summer_mean, summer_std = annual_moments(summer_flows, calendar)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        stats["sum_cv"] = across_years(np.nanmedian, summer_std / summer_mean * 100)
+
+    if area is not None:
+        stats["mh20"] = annual_maxima.mean(axis=0) / area
+        spring_maxima = annual_max(mask_months(flows, calendar, SPRING_MONTHS), calendar)
+        stats["spr_mag"] = across_years(np.nanmedian, spring_maxima) / area
+        stats["sum_mag"] = across_years(np.nanmin, summer_flows) / area
+        low_days = annual_sum(flows < LF1_THRESHOLD * area, calendar)
+        stats["lf1"] = np.where(np.isnan(area), np.nan, np.median(low_days, axis=0))
+
+    return stats
+
+
+def compute_duration_stats(block):
+    """Compute the duration statistics of a FlowBlock."""
+    flows, calendar = block.flows, block.calendar
+    stats = {}
+
+    for i, days in enumerate(MOVING_AVERAGE_DAYS):
+        averages = block.moving_average(days)
+        stats[f"dh{i + 1}"] = across_years(np.nanmean, annual_max(averages, calendar))
+        stats[f"dl{i + 1}"] = across_years(np.nanmean, annual_min(averages, calendar))
+        if days in [3, 7]:
+            spring_maxima = annual_max(mask_months(averages, calendar, SPRING_MONTHS), calendar)
+            summer_minima = annual_min(mask_months(averages, calendar, SUMMER_MONTHS), calendar)
+            stats[f"spr_dur{days}"] = across_years(np.nanmedian, spring_maxima)
+            stats[f"sum_dur{days}"] = across_years(np.nanmedian, summer_minima)
+
+    high, low = block.percentile([75, 25])
+    stats["dh15"] = across_years(np.nanmedian, annual_pulse_durations(flows > high, calendar))
+    stats["dl16"] = across_years(np.nanmedian, annual_pulse_durations(flows < low, calendar))
+
+    return stats
+
+
+def compute_frequency_stats(block):
+    """Compute the frequency statistics (event counts) of a FlowBlock."""
+    flows, calendar = block.flows, block.calendar
+    stats = {}
+
+    high, low, median = block.percentile([75, 25, 50])
+    thresholds = {
+        "fh1": ("above", high),
+        "fh5": ("above", median),
+        "fh6": ("above", 3 * median),
+        "fh7": ("above", 7 * median),
+        "fl1": ("below", low),
+        "fl3": ("below", FL3_FRACTION * flows.mean(axis=0, dtype=np.float64)),
+    }
+    # streams with missing flows have NaN thresholds, and no events would be counted, so their stats are set to NaN
+    for stat, (side, threshold) in thresholds.items():
+        mask = flows > threshold if side == "above" else flows < threshold
+        stats[stat] = np.where(np.isnan(threshold), np.nan, annual_events(mask, calendar)[1].mean(axis=0))
+
+    spring = np.isin(calendar["month"], SPRING_MONTHS)[:, None]
+    summer = np.isin(calendar["month"], SUMMER_MONTHS)[:, None]
+    spring_threshold = block.percentile(SPR_FREQ_PERCENTILE)
+    summer_threshold = block.percentile(SUM_FREQ_PERCENTILE)
+    spring_events = annual_events(spring & (flows > spring_threshold), calendar)[1]
+    summer_events = annual_events(summer & (flows < summer_threshold), calendar)[1]
+    stats["spr_freq"] = np.where(np.isnan(spring_threshold), np.nan, np.median(spring_events, axis=0))
+    stats["sum_freq"] = np.where(np.isnan(summer_threshold), np.nan, np.median(summer_events, axis=0))
+
+    return stats
+
+
+def compute_timing_stats(block):
+    """Compute the timing statistics (Julian dates) of a FlowBlock, as circular medians across water years."""
+    flows, calendar = block.flows, block.calendar
+
+    return {
+        "th1": circular_median(annual_dates(flows, calendar, np.argmax)),
+        "tl1": circular_median(annual_dates(flows, calendar, np.argmin)),
+        "spr_ord": circular_median(annual_dates(mask_months(flows, calendar, SPRING_MONTHS), calendar, np.argmax)),
+        "sum_ord": circular_median(annual_dates(mask_months(flows, calendar, SUMMER_MONTHS), calendar, np.argmin)),
+    }
+
+
+def compute_rate_stats(block):
+    """Compute the rate of change statistics of a FlowBlock from the day to day changes in flow."""
+    changes, calendar = block.changes, block.calendar
+    stats = {}
+
+    # rise and fall rates are the mean positive and negative changes of the era (so the fall rate is negative)
+    rises, falls = changes > 0, changes < 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        stats["ra1"] = np.where(rises, changes, 0).sum(axis=0, dtype=np.float64) / rises.sum(axis=0)
+        stats["ra3"] = np.where(falls, changes, 0).sum(axis=0, dtype=np.float64) / falls.sum(axis=0)
+
+    # a reversal is a rise after a fall or a fall after a rise, days without change have no direction
+    direction = np.sign(changes)
+    reversals = np.zeros(changes.shape, dtype=bool)
+    reversals[1:] = direction[1:] * direction[:-1] < 0
+    stats["ra8"] = annual_sum(reversals, calendar).mean(axis=0)
+
+    return stats
+
+
+FAMILY_FUNCTIONS = {
+    "magnitude": compute_magnitude_stats,
+    "duration": compute_duration_stats,
+    "frequency": compute_frequency_stats,
+    "timing": compute_timing_stats,
+    "rate": compute_rate_stats,
+}
+
+
+def compute_block_stats(flows, calendar, families, area=None):
+    """Compute the statistics of every family for a block of daily flows (day, stream), as float32 arrays."""
+    block = FlowBlock(flows, calendar, area)
+    stats = {}
+    for family in families:
+        stats.update(FAMILY_FUNCTIONS[family](block))
+
+    return {stat: np.asarray(values, dtype=np.float32) for stat, values in stats.items()}
+
+
+def compute_era_stats(table, dates, stream_cols, start_date, end_date, families, areas=None, stream_chunk_size=2000):
+    """Compute the statistics of one era for all streams, processing blocks of streams at once.
+
+    Returns a dict of (stream,) arrays, or None if the record doesn't cover the era.
+    """
+    start, end = np.searchsorted(dates, [np.datetime64(start_date), np.datetime64(end_date)], side="left")
+    era_dates = dates[start : end + 1]
+    expected_days = (np.datetime64(end_date) - np.datetime64(start_date)).astype(int) + 1
+    if len(era_dates) != expected_days or np.any(np.diff(era_dates) != np.timedelta64(1, "D")):
+        return None
+
+    calendar = get_calendar(era_dates)
+    era_table = table.slice(start, len(era_dates))
+    blocks = []
+    for i in range(0, len(stream_cols), stream_chunk_size):
+        cols = stream_cols[i : i + stream_chunk_size]
+        flows = np.column_stack([era_table[col].to_numpy(zero_copy_only=False) for col in cols]).astype(np.float32)
+        area = None if areas is None else areas[i : i + stream_chunk_size]
+        blocks.append(compute_block_stats(flows, calendar, families, area))
+
+    return {stat: np.concatenate([block[stat] for block in blocks]) for stat in blocks[0]}
+
+
+def stats_to_xarray(era_stats, stream_ids, landcover, model, rcp):
+    """Combine the statistics of each era into a Dataset with (era, stream_id) variables."""
+    eras = list(era_stats.keys())
+    stats = list(era_stats[eras[0]].keys())
+
+    ds = xr.Dataset(
+        {
+            stat: (("era", "stream_id"), np.stack([era_stats[era][stat] for era in eras]))
+            for stat in stats
+        },
+        coords={
+            "era": eras,
+            "stream_id": stream_ids,
+        }
+    )
+    for stat in stats:
+        ds[stat].attrs = mhit_stat_vars_dict[stat]
+
+    # add landcover, model, and rcp as dimensions with length 1, as in process_streamflow_climatology.py
+    ds = ds.expand_dims({"landcover": [landcover], "model": [model], "scenario": [rcp]})
+    ds["landcover"] = ds["landcover"].astype(object)
+    ds["model"] = ds["model"].astype(object)
+    ds["scenario"] = ds["scenario"].astype(object)
+
+    return ds
+
+
+def main():
+    """Main processing function."""
+    args = parse_arguments()
+
+    # Validate input files exist
+    for path in [args.input_csv, args.drainage_area]:
+        if path is not None and not os.path.exists(path):
+            print(f"Error: Input file not found: {path}", file=sys.stderr)
+            sys.exit(1)
+
+    # Create output directory if it doesn't exist
+    Path(args.output_netcdf).parent.mkdir(parents=True, exist_ok=True)
+
+    table, dates = read_streamflow(args.input_csv)
+    if np.any(np.diff(dates) <= np.timedelta64(0, "D")):
+        print(f"Error: Dates of {args.input_csv} are not sorted and unique", file=sys.stderr)
+        sys.exit(1)
+
+    # List of streamflow columns (all except Date)
+    stream_cols = [c for c in table.column_names if c != "Date"]
+    stream_ids = [int(c) for c in stream_cols]
+    areas = None
+    if args.drainage_area is not None:
+        areas = read_drainage_area(args.drainage_area, stream_ids)
+
+    eras = get_eras(args.input_csv) if args.eras is None else parse_eras(args.eras)
+    era_stats = {}
+    for start_date, end_date in eras:
+        era = f"{start_date[:4]}-{end_date[:4]}"
+        stats = compute_era_stats(
+            table, dates, stream_cols, start_date, end_date, args.families, areas, args.stream_chunk_size
+        )
+        if stats is None:
+            print(f"Skipping era {era}: the daily record of {args.input_csv} doesn't cover it", file=sys.stderr)
+            continue
+        era_stats[era] = stats
+        print(f"Computed era {era}")
+
+    if not era_stats:
+        print(f"Error: no eras to compute for {args.input_csv}", file=sys.stderr)
+        sys.exit(1)
+
+    landcover, model, rcp = get_landcover_model_rcp_from_filename(args.input_csv)
+    ds = stats_to_xarray(era_stats, stream_ids, landcover, model, rcp)
+    ds.to_netcdf(args.output_netcdf)
+
+    print(f"Successfully processed {args.input_csv} -> {args.output_netcdf}")
+
+
+if __name__ == "__main__":
+    main()
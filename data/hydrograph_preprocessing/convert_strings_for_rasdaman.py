@@ -6,8 +6,15 @@ This script takes a NetCDF file with string dimensions and converts specified
 string dimensions (landcover, model, scenario, era) to integer indices,
 storing the original string mappings in the dimension attributes as 'encoding'.
 
+Optionally, the data variables can be stored with a lossy encoding to shrink
+the output: int16 or int8 integers with a per-variable scale_factor and
+add_offset, or float32 rounded to a number of mantissa bits (which only saves
+space combined with the compression applied here). The maximum absolute and
+relative reconstruction errors of each variable are checked against the input
+and saved next to the output.
+
 Usage:
-    python convert_strings_for_rasdaman.py <input_file> <output_file>
+    python convert_strings_for_rasdaman.py <input_file> <output_file> [--pack int16]
 """
 
 import sys
@@ -15,6 +22,10 @@ import argparse
 from pathlib import Path
 import xarray as xr
 import numpy as np
+import pandas as pd
+
+# lossy encodings of the data variables, see get_packing_encoding()
+PACKINGS = ["int16", "int8", "bitround"]
 
 # deal with model capitalization using an explicit conversion dict:
 model_capitalization_dict = {
@@ -59,8 +70,34 @@ def parse_arguments():
         default=["landcover", "model", "scenario", "era"],
         help="List of string dimensions to convert to integers"
     )
-    
-    return parser.parse_args()
+
+    parser.add_argument(
+        "--pack",
+        choices=PACKINGS,
+        default=None,
+        help="Lossy encoding of the data variables: int16 or int8 scale/offset packing, or bitround to --keepbits mantissa bits"
+    )
+
+    parser.add_argument(
+        "--keepbits",
+        type=int,
+        choices=range(24),
+        default=None,
+        help="Number of float32 mantissa bits kept with --pack bitround"
+    )
+
+    parser.add_argument(
+        "--stream-chunk-size",
+        type=int,
+        default=10000,
+        help="Number of streams read at once for the min/max and reconstruction error passes of --pack"
+    )
+
+    args = parser.parse_args()
+    if args.pack == "bitround" and args.keepbits is None:
+        parser.error("--pack bitround needs --keepbits")
+
+    return args
 
 
 def create_encoding_mapping(values):
@@ -130,6 +167,92 @@ def convert_string_dimensions(ds, string_dims):
     return ds_converted
 
 
+def iter_stream_chunks(ds, chunk_size):
+    """Yield slices of chunk_size stream_ids, or a single slice if there is no stream_id dimension."""
+    n_streams = ds.sizes.get("stream_id", 0)
+    if n_streams == 0:
+        yield slice(None)
+        return
+    for start in range(0, n_streams, chunk_size):
+        yield slice(start, min(start + chunk_size, n_streams))
+
+
+def get_variable_ranges(ds, chunk_size=10000):
+    """Get the (min, max) of the finite values of each data variable, reading chunk_size streams at a time."""
+    ranges = {}
+    for var_name in ds.data_vars:
+        low, high = np.inf, -np.inf
+        for chunk in iter_stream_chunks(ds[var_name], chunk_size):
+            values = ds[var_name].isel(stream_id=chunk).values if "stream_id" in ds[var_name].dims else ds[var_name].values
+            values = values[np.isfinite(values)]
+            if values.size:
+                low, high = min(low, values.min()), max(high, values.max())
+        ranges[var_name] = (float(low), float(high)) if low <= high else (0.0, 0.0)
+    return ranges
+
+
+def get_packing_encoding(var_min, var_max, pack, keepbits=None):
+    """Get the netCDF encoding of a data variable stored with one of PACKINGS.
+
+    Integer packings map [var_min, var_max] onto the integers above the lowest one,
+    which is kept as the _FillValue for missing data, so the absolute error is at
+    most scale_factor / 2. Bit rounding keeps float32 and NaN as the fill value,
+    with a relative error of at most 2 ** -(keepbits + 1).
+    """
+    if pack == "bitround":
+        return {"significant_digits": keepbits, "quantize_mode": "BitRound"}
+
+    info = np.iinfo(pack)
+    steps = int(info.max) - int(info.min) - 1
+    scale_factor = (var_max - var_min) / steps if var_max > var_min else 1.0
+    add_offset = var_min - (int(info.min) + 1) * scale_factor
+    return {
+        "dtype": pack,
+        "scale_factor": np.float32(scale_factor),
+        "add_offset": np.float32(add_offset),
+        "_FillValue": np.dtype(pack).type(info.min),
+    }
+
+
+def get_packing_errors(original_ds, output_file, chunk_size=10000):
+    """Compare the saved data variables to the originals, chunk_size streams at a time.
+
+    Returns a DataFrame with the maximum absolute and relative reconstruction
+    errors of each variable, and the number of values that were lost (e.g. inf,
+    which integer packings store as missing).
+    """
+    rows = []
+    with xr.open_dataset(output_file) as saved_ds:
+        for var_name in original_ds.data_vars:
+            max_abs, max_rel, lost = 0.0, 0.0, 0
+            for chunk in iter_stream_chunks(original_ds[var_name], chunk_size):
+                if "stream_id" in original_ds[var_name].dims:
+                    original = original_ds[var_name].isel(stream_id=chunk).values
+                    saved = saved_ds[var_name].isel(stream_id=chunk).values
+                else:
+                    original = original_ds[var_name].values
+                    saved = saved_ds[var_name].values
+                lost += int((np.isfinite(original) & ~np.isfinite(saved)).sum())
+                lost += int((np.isinf(original) & (saved != original)).sum())
+                kept = np.isfinite(original) & np.isfinite(saved)
+                error = np.abs(saved[kept].astype(np.float64) - original[kept])
+                nonzero = original[kept] != 0
+                if error.size:
+                    max_abs = max(max_abs, error.max())
+                if nonzero.any():
+                    max_rel = max(max_rel, (error[nonzero] / np.abs(original[kept][nonzero])).max())
+            rows.append({
+                "variable": var_name,
+                "dtype": str(saved_ds[var_name].encoding.get("dtype")),
+                "scale_factor": saved_ds[var_name].encoding.get("scale_factor"),
+                "add_offset": saved_ds[var_name].encoding.get("add_offset"),
+                "max_abs_error": max_abs,
+                "max_rel_error": max_rel,
+                "lost": lost,
+            })
+    return pd.DataFrame(rows)
+
+
 def verify_conversion(original_ds, converted_ds, string_dims):
     """Verify that the conversion was successful."""
     print("\n=== VERIFICATION ===")
@@ -205,6 +328,8 @@ def main():
     print(f"Input file: {input_file}")
     print(f"Output file: {output_file}")
     print(f"String dimensions to convert: {args.string_dims}")
+    if args.pack is not None:
+        print(f"Data variable packing: {args.pack}")
     print()
     
     # Open input dataset
@@ -254,7 +379,15 @@ def main():
                 'complevel': 4,
                 'shuffle': True
             }
-        
+
+        # Optionally pack the data variables, using the range of each one from a pass over chunks of streams
+        if args.pack is not None:
+            print(f"Computing data variable ranges for {args.pack} packing...")
+            ranges = get_variable_ranges(ds, args.stream_chunk_size)
+            for var_name, (var_min, var_max) in ranges.items():
+                print(f"  {var_name}: min {var_min}, max {var_max}")
+                encoding[var_name].update(get_packing_encoding(var_min, var_max, args.pack, args.keepbits))
+
         ds_converted.to_netcdf(output_file, format='NETCDF4', encoding=encoding)
         print("✓ Converted dataset saved successfully")
         
@@ -289,6 +422,15 @@ def main():
         
     except Exception as e:
         print(f"ERROR verifying saved file: {e}")
+
+    # Report the reconstruction errors of packed data variables
+    if args.pack is not None:
+        print("\nChecking reconstruction errors of packed data variables...")
+        report = get_packing_errors(ds, output_file, args.stream_chunk_size)
+        report_file = output_file.with_name(f"{output_file.stem}_packing.csv")
+        report.to_csv(report_file, index=False)
+        print(report.to_string(index=False))
+        print(f"Packing report saved to: {report_file}")
     
     # Clean up
     ds.close()
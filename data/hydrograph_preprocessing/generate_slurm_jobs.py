@@ -106,6 +106,12 @@ def parse_arguments():
         action="store_true",
         help="Pass --keep-intermediate flag to processing script"
     )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Pass --stream flag to processing script, to read each CSV batch by batch without intermediate files"
+    )
     
     parser.add_argument(
         "--chunk-size",
@@ -143,6 +149,9 @@ def generate_slurm_script(csv_file, output_file, temp_dir, args, scripts_dir):
     
     if args.keep_intermediate:
         processing_cmd.append("--keep-intermediate")
+
+    if args.stream:
+        processing_cmd.append("--stream")
     
     processing_cmd_str = " \\\n    ".join(processing_cmd)
     
@@ -15,6 +15,170 @@ stat_vars_dict = {
 }
 
 
+# metadata for the MHIT statistics computed from daily streamflow by compute_mhit_stats.py
+# see stat_vars_dict in data/preprocess/luts.py for the full definitions of the published statistics
+# years are water years (October 1 through September 30), as for the eras
+mhit_stat_vars_dict = {
+    **{
+        f"dh{i + 1}": {
+            "statistic_description": f"Mean of the annual maximum {days}-day moving average flows",
+            "units": "cfs",
+        }
+        for i, days in enumerate([1, 3, 7, 30, 90])
+    },
+    **{
+        f"dl{i + 1}": {
+            "statistic_description": f"Mean of the annual minimum {days}-day moving average flows",
+            "units": "cfs",
+        }
+        for i, days in enumerate([1, 3, 7, 30, 90])
+    },
+    "dh15": {
+        "statistic_description": "Median of the annual average durations of flow events above the 75th percentile flow of the era",
+        "units": "days/year",
+    },
+    "dl16": {
+        "statistic_description": "Median of the annual average durations of flow events below the 25th percentile flow of the era",
+        "units": "days/year",
+    },
+    "spr_dur3": {
+        "statistic_description": "Median of the annual spring (April-June) maximum 3-day moving average flows",
+        "units": "cfs",
+    },
+    "spr_dur7": {
+        "statistic_description": "Median of the annual spring (April-June) maximum 7-day moving average flows",
+        "units": "cfs",
+    },
+    "sum_dur3": {
+        "statistic_description": "Median of the annual summer (July-September) minimum 3-day moving average flows",
+        "units": "cfs",
+    },
+    "sum_dur7": {
+        "statistic_description": "Median of the annual summer (July-September) minimum 7-day moving average flows",
+        "units": "cfs",
+    },
+    "ma3": {
+        "statistic_description": "Mean of the annual coefficients of variation of daily flows",
+        "units": "percent",
+    },
+    "ma4": {
+        "statistic_description": "Coefficient of variation of the 5th to 95th percentiles of the logs of daily flows of the era",
+        "units": "percent",
+    },
+    **{
+        f"ma{month + 11}": {
+            "statistic_description": f"Mean of the monthly mean flows for {name}",
+            "units": "cfs",
+        }
+        for month, name in enumerate(
+            [
+                "January",
+                "February",
+                "March",
+                "April",
+                "May",
+                "June",
+                "July",
+                "August",
+                "September",
+                "October",
+                "November",
+                "December",
+            ],
+            start=1,
+        )
+    },
+    "mh14": {
+        "statistic_description": "Median of the annual ratios of the maximum daily flow to the median daily flow",
+        "units": "dimensionless",
+    },
+    "ml17": {
+        "statistic_description": "Median of the annual ratios of the minimum 7-day moving average flow to the mean daily flow",
+        "units": "dimensionless",
+    },
+    "sum_cv": {
+        "statistic_description": "Median of the annual coefficients of variation of summer (July-September) daily flows",
+        "units": "percent",
+    },
+    "mh20": {
+        "statistic_description": "Mean of the annual maximum daily flows divided by the drainage area",
+        "units": "cfs/square_mile",
+    },
+    "spr_mag": {
+        "statistic_description": "Median of the annual spring (April-June) maximum daily flows divided by the drainage area",
+        "units": "cfs/square_mile",
+    },
+    "sum_mag": {
+        "statistic_description": "Minimum summer (July-September) daily flow of the era divided by the drainage area",
+        "units": "cfs/square_mile",
+    },
+    "lf1": {
+        "statistic_description": "Median of the annual numbers of days below 0.1 cfs per square mile of drainage area",
+        "units": "days/year",
+    },
+    "fh1": {
+        "statistic_description": "Mean of the annual numbers of flow events above the 75th percentile flow of the era",
+        "units": "events/year",
+    },
+    "fh5": {
+        "statistic_description": "Mean of the annual numbers of flow events above the median flow of the era",
+        "units": "events/year",
+    },
+    "fh6": {
+        "statistic_description": "Mean of the annual numbers of flow events above three times the median flow of the era",
+        "units": "events/year",
+    },
+    "fh7": {
+        "statistic_description": "Mean of the annual numbers of flow events above seven times the median flow of the era",
+        "units": "events/year",
+    },
+    "fl1": {
+        "statistic_description": "Mean of the annual numbers of flow events below the 25th percentile flow of the era",
+        "units": "events/year",
+    },
+    "fl3": {
+        "statistic_description": "Mean of the annual numbers of flow events below 5 percent of the mean flow of the era",
+        "units": "events/year",
+    },
+    "spr_freq": {
+        "statistic_description": "Median of the annual numbers of spring (April-June) flow events above the 10th percentile flow of the era",
+        "units": "events/year",
+    },
+    "sum_freq": {
+        "statistic_description": "Median of the annual numbers of summer (July-September) flow events below the 90th percentile flow of the era",
+        "units": "events/year",
+    },
+    "th1": {
+        "statistic_description": "Circular median of the annual Julian dates of the maximum daily flow",
+        "units": "day",
+    },
+    "tl1": {
+        "statistic_description": "Circular median of the annual Julian dates of the minimum daily flow",
+        "units": "day",
+    },
+    "spr_ord": {
+        "statistic_description": "Circular median of the annual Julian dates of the spring (April-June) maximum daily flow",
+        "units": "day",
+    },
+    "sum_ord": {
+        "statistic_description": "Circular median of the annual Julian dates of the summer (July-September) minimum daily flow",
+        "units": "day",
+    },
+    "ra1": {
+        "statistic_description": "Mean of the positive day to day changes in flow of the era",
+        "units": "cfs/day",
+    },
+    "ra3": {
+        "statistic_description": "Mean of the negative day to day changes in flow of the era",
+        "units": "cfs/day",
+    },
+    "ra8": {
+        "statistic_description": "Mean of the annual numbers of days when the day to day change in flow changes direction",
+        "units": "days/year",
+    },
+}
+
+
 # encodings for netCDF, integers required for rasdaman ingest
 encodings_lookup = {
     "landcover": {
@@ -10,6 +10,11 @@ statistics in this dataset: https://doi.org/10.5066/P9EBKREQ.
 The input data format is assumed to be consistent with the daily streamflow 
 outputs from that same dataset.
 
+With --stream, the CSV is read one block of dates at a time and each block is
+added straight to running per-era, per-day-of-year accumulators, so no
+intermediate Parquet or NetCDF files are written and memory use depends on the
+number of streams rather than the length of the record. The output is the same.
+
 Example usage:
 --------------
 python process_streamflow_climatology.py \
@@ -19,6 +24,13 @@ python process_streamflow_climatology.py \
     --keep-intermediate \    # Optional flag to keep intermediate files
     --chunk-size 2000 \     # Optional chunk size for processing
     --stream-chunk-size 10000 # Optional stream chunk size for climatology calculation
+
+python process_streamflow_climatology.py \
+    input_streamflow.csv \  # Input CSV file path
+    output_climatology.nc \  # Output NetCDF file path
+    /path/to/temp_dir \      # Not used with --stream
+    --stream \               # Read the CSV batch by batch, without intermediate files
+    --block-size-mb 16       # Optional size of the CSV blocks read at once
 --------------
 
 """
@@ -28,6 +40,7 @@ import sys
 import argparse
 import tempfile
 from pathlib import Path
+import pyarrow as pa
 import pyarrow.csv as csv
 import pyarrow.parquet as pq
 import xarray as xr
@@ -79,6 +92,19 @@ def parse_arguments():
         default=10000,
         help="Number of streams to process at once for climatology calculation"
     )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Read the CSV one block of dates at a time into running climatology accumulators, without intermediate files"
+    )
+
+    parser.add_argument(
+        "--block-size-mb",
+        type=int,
+        default=16,
+        help="Size in MB of the CSV blocks read at once with --stream; pyarrow reads up to 32 blocks ahead"
+    )
     
     return parser.parse_args()
 
@@ -173,72 +199,179 @@ def parquet_to_xarray(parquet_path, landcover, model, rcp, chunk_size=2000):
     return ds
 
 
+def get_eras(filename):
+    """Get the (start date, end date) water year eras of a file from its filename."""
+    if "historical" in filename.lower():
+        # Use historical era only
+        return [("1976-10-01", "2005-09-30")]
+
+    # Use projection eras
+    return [
+        ("2016-10-01", "2045-09-30"),
+        ("2046-10-01", "2075-09-30"),
+        ("2071-10-01", "2100-09-30"),
+    ]
+
+
 def compute_climatology(ds, stream_chunk_size=10000, filename=""):
-    """Compute daily climatology statistics by era."""
-    # Add day-of-year coordinate
-    ds = ds.assign_coords(doy=ds["time"].dt.dayofyear)
+    """Compute daily climatology statistics by era.
 
+    The daily min, mean and max of every era are computed together in one pass
+    over each chunk of streams with DoyAccumulator, instead of a groupby("doy")
+    reduction per statistic, per era and per chunk. The results are the same.
+    """
     # Define eras based on filename
-    if "historical" in filename.lower():
-        # Use historical era only
-        eras = [("1976-10-01", "2005-09-30")]
-    else:
-        # Use projection eras
-        eras = [
-            ("2016-10-01", "2045-09-30"),
-            ("2046-10-01", "2075-09-30"),
-            ("2071-10-01", "2100-09-30"),
-        ]
+    eras = get_eras(filename)
+    dates = ds["time"].values.astype("datetime64[D]")
+
+    # ds holds a single landcover, model and scenario (see parquet_to_xarray())
+    flows = ds["streamflow"].isel(landcover=0, model=0, scenario=0).transpose("time", "stream_id")
+    labels = [ds[dim].values[0] for dim in ["landcover", "model", "scenario"]]
     
     # Process in smaller chunks to reduce memory usage
     n_streams = len(ds.stream_id)
-    era_clims = {}
-    
-    for start_date, end_date in eras:
-        era = ds.sel(time=slice(start_date, end_date))
-        
-        # Initialize lists to store results
-        doy_mins, doy_means, doy_maxs = [], [], []
-        
-        # Process streams in chunks
-        for i in range(0, n_streams, stream_chunk_size):
-            end_idx = min(i + stream_chunk_size, n_streams)
-            stream_chunk = era.isel(stream_id=slice(i, end_idx))
-            
-            # Compute climatologies for this chunk
-            chunk_doy_min = stream_chunk.groupby("doy").min("time")
-            chunk_doy_mean = stream_chunk.groupby("doy").mean("time")
-            chunk_doy_max = stream_chunk.groupby("doy").max("time")
-            
-            doy_mins.append(chunk_doy_min["streamflow"])
-            doy_means.append(chunk_doy_mean["streamflow"])
-            doy_maxs.append(chunk_doy_max["streamflow"])
-        
-        # Concatenate all chunks
-        era_doy_min = xr.concat(doy_mins, dim="stream_id")
-        era_doy_mean = xr.concat(doy_means, dim="stream_id")
-        era_doy_max = xr.concat(doy_maxs, dim="stream_id")
-        
-        daily_clim = xr.Dataset(
-            {
-                "doy_min": era_doy_min,
-                "doy_mean": era_doy_mean,
-                "doy_max": era_doy_max,
-            },
+    chunk_clims = []
+    for i in range(0, n_streams, stream_chunk_size):
+        end_idx = min(i + stream_chunk_size, n_streams)
+        accumulator = DoyAccumulator(eras, end_idx - i)
+        accumulator.update(dates, flows.isel(stream_id=slice(i, end_idx)).values.astype(np.float32))
+        chunk_clims.append(accumulator.to_dataset(ds["stream_id"].values[i:end_idx], *labels))
+
+    # Combine the chunks along the stream_id dimension
+    return xr.concat(chunk_clims, dim="stream_id")
+
+
+def read_csv_columns(csv_path):
+    """Get the column names of a CSV file from its header line only."""
+    with open(csv_path, "rb") as f:
+        header = f.readline()
+    return csv.read_csv(pa.py_buffer(header)).column_names
+
+
+def iter_csv_blocks(csv_path, block_size_mb=16):
+    """Read a streamflow CSV one block of rows at a time.
+
+    Yields (dates, flows, stream_ids) for each block, with the dates as
+    datetime64[D] and the flows as a float32 (date, stream) array. Flows are
+    parsed as float64 and then cast, as in csv_to_parquet() and parquet_to_xarray().
+    """
+    flow_cols = [c for c in read_csv_columns(csv_path) if c != "Date"]
+    stream_ids = [int(c) for c in flow_cols]
+
+    read_opts = csv.ReadOptions(block_size=block_size_mb << 20, use_threads=False)
+    convert_opts = csv.ConvertOptions(
+        column_types={c: pa.float64() for c in flow_cols},
+        strings_can_be_null=True,
+        null_values=["", "NA", "NaN"]
+    )
+
+    with csv.open_csv(csv_path, read_options=read_opts, convert_options=convert_opts) as reader:
+        for batch in reader:
+            if batch.num_rows == 0:
+                continue
+            dates = pd.to_datetime(batch.column("Date").to_pandas()).to_numpy().astype("datetime64[D]")
+            flows = batch.select(flow_cols).to_tensor(null_to_nan=True).to_numpy().astype(np.float32)
+            yield dates, flows, stream_ids
+
+
+class DoyAccumulator:
+    """Running per-era, per-day-of-year min, max, sum and count of daily streamflow.
+
+    Blocks of days are added in date order, and the float32 sums are accumulated
+    one day at a time in that order, as numpy sums the time axis when xarray
+    reduces each day-of-year group, so the means are bit-for-bit the same as
+    those of groupby("doy").mean("time").
+    """
+
+    def __init__(self, eras, n_streams):
+        self.eras = [f"{start[:4]}-{end[:4]}" for start, end in eras]
+        self.bounds = [(np.datetime64(start), np.datetime64(end)) for start, end in eras]
+        shape = (len(eras), 366, n_streams)
+        self.min = np.full(shape, np.nan, dtype=np.float32)
+        self.max = np.full(shape, np.nan, dtype=np.float32)
+        self.sum = np.zeros(shape, dtype=np.float32)
+        self.count = np.zeros(shape, dtype=np.intp)
+        # days of year seen in each era
+        self.seen = np.zeros(shape[:2], dtype=bool)
+
+    def update(self, dates, flows):
+        """Add a block of days, a (date, stream) float32 array, to all of the eras that contain them.
+
+        This is a single pass over the block: it is split into pieces of consecutive
+        days that are in the same eras and in which each day of year occurs once
+        (the Jan-Sep and Oct-Dec parts of each calendar year, for water year eras).
+        Each piece is masked once and added to every era it is in, so the years
+        shared by overlapping eras are not rescanned. Pieces rather than water
+        years are the unit because a water year can have the same day of year
+        twice (e.g. day 274 is both Oct 1 after a non-leap year and Sep 30 of a
+        leap year), and adding those two days together first would change the
+        order of the float32 sums.
+        """
+        doy_index = pd.DatetimeIndex(dates).dayofyear.to_numpy() - 1
+        in_era = np.stack([(dates >= start) & (dates <= end) for start, end in self.bounds], axis=1)
+        breaks = np.flatnonzero((np.diff(doy_index) <= 0) | (in_era[1:] != in_era[:-1]).any(axis=1)) + 1
+
+        for start, end in zip(np.r_[0, breaks], np.r_[breaks, len(dates)]):
+            eras = np.flatnonzero(in_era[start])
+            if len(eras) == 0:
+                continue
+            piece = flows[start:end]
+            missing = np.isnan(piece)
+            values = np.where(missing, np.float32(0), piece)
+            present = ~missing
+            doys = doy_index[start:end]
+            if doys[-1] - doys[0] == len(doys) - 1:
+                # consecutive days are a slice of the accumulators, which is faster to update
+                doys = slice(doys[0], doys[-1] + 1)
+            for i in eras:
+                self.min[i, doys] = np.fmin(self.min[i, doys], piece)
+                self.max[i, doys] = np.fmax(self.max[i, doys], piece)
+                self.sum[i, doys] += values
+                self.count[i, doys] += present
+                self.seen[i, doys] = True
+
+    def to_dataset(self, stream_ids, landcover, model, rcp):
+        """Get the climatologies as a Dataset laid out like the output of compute_climatology()."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            # the division of np.nanmean(), with NaN for days without data
+            mean = np.true_divide(self.sum, self.count, out=self.sum.copy(), casting="unsafe")
+
+        # days of year that are in none of the eras are left out, as groupby("doy") leaves them out
+        doys = np.flatnonzero(self.seen.any(axis=0))
+        dims = ("era", "doy", "landcover", "model", "scenario", "stream_id")
+        data_vars = {}
+        for name, values in [("doy_min", self.min), ("doy_mean", mean), ("doy_max", self.max)]:
+            values = np.where(self.seen[:, :, None], values, np.nan)[:, doys]
+            data_vars[name] = (dims, values[:, :, None, None, None, :])
+
+        return xr.Dataset(
+            data_vars,
             coords={
-                "doy": era_doy_mean["doy"],
-                "stream_id": era_doy_mean["stream_id"],
+                "era": self.eras,
+                "doy": doys + 1,
+                "landcover": np.array([landcover], dtype=object),
+                "model": np.array([model], dtype=object),
+                "scenario": np.array([rcp], dtype=object),
+                "stream_id": stream_ids,
             }
         )
-        era_clims[f"{start_date[:4]}-{end_date[:4]}"] = daily_clim
-    
-    # Combine into a single dataset with an 'era' dimension
-    combined_clims = xr.concat(
-        [era_clims[era] for era in era_clims],
-        dim=pd.Index(list(era_clims.keys()), name="era")
-    )
-    
-    return combined_clims
+
+
+def stream_climatology(csv_path, block_size_mb=16):
+    """Compute the daily climatologies of a CSV file read one block at a time, without intermediate files."""
+    eras = get_eras(csv_path)
+    landcover, model, rcp = get_landcover_model_rcp_from_filename(csv_path)
+
+    accumulator = None
+    for dates, flows, stream_ids in iter_csv_blocks(csv_path, block_size_mb):
+        if accumulator is None:
+            accumulator = DoyAccumulator(eras, len(stream_ids))
+        accumulator.update(dates, flows)
+
+    if accumulator is None:
+        raise ValueError(f"No rows in {csv_path}")
+
+    return accumulator.to_dataset(stream_ids, landcover, model, rcp)
 
 
 def cleanup_files(file_paths, keep_files=False):
@@ -268,13 +401,24 @@ def main():
         print(f"Error: Input CSV file not found: {args.input_csv}", file=sys.stderr)
         sys.exit(1)
     
-    # Create temp directory if it doesn't exist
-    temp_dir = Path(args.temp_dir)
-    temp_dir.mkdir(parents=True, exist_ok=True)
-    
     # Create output directory if it doesn't exist
     output_dir = Path(args.output_netcdf).parent
     output_dir.mkdir(parents=True, exist_ok=True)
+
+    if args.stream:
+        # Read the CSV straight into the climatology accumulators, without intermediate files
+        try:
+            combined_clims = stream_climatology(args.input_csv, args.block_size_mb)
+            combined_clims.to_netcdf(args.output_netcdf)
+            print(f"Successfully processed {args.input_csv} -> {args.output_netcdf}")
+        except Exception as e:
+            print(f"Error processing file: {e}", file=sys.stderr)
+            sys.exit(1)
+        return
+
+    # Create temp directory if it doesn't exist
+    temp_dir = Path(args.temp_dir)
+    temp_dir.mkdir(parents=True, exist_ok=True)
     
     # Generate intermediate file names
     csv_name = Path(args.input_csv).stem
@@ -46,37 +46,34 @@ def parse_arguments():
     return parser.parse_args()
 
 
-def find_source_file(landcover, model, scenario, variant, source_dir):
-    """Find the source NetCDF file for given parameters."""
-    # The combined file has lowercase model names, but source files may have mixed case
-    # Try different case variations to find the actual file
-    
-    pattern_base = f"{landcover}_*_{scenario}_{variant}_doy_mmm_by_era.nc"
-    
-    # First try exact match (lowercase)
-    filename = f"{landcover}_{model}_{scenario}_{variant}_doy_mmm_by_era.nc"
-    source_path = source_dir / filename
-    
-    if source_path.exists():
-        return source_path
-    
-    # If not found, search for files matching the pattern but with different model case
-    matching_files = list(source_dir.glob(pattern_base))
-    
-    for file_path in matching_files:
-        # Extract model name from the actual filename
+def build_source_index(source_dir):
+    """Scan the source directory once and index the source NetCDF files by their parameters.
+
+    Keys are lowercase (landcover, model, scenario, variant) tuples, since the combined
+    file has lowercase model names but source files may have mixed case.
+    """
+    source_index = {}
+    for file_path in source_dir.glob("*_doy_mmm_by_era.nc"):
         parts = file_path.stem.split('_')
         if len(parts) >= 4:
-            file_model = parts[1]  # Second part should be the model
-            # Check if this matches our model (case insensitive)
-            if file_model.lower() == model.lower():
-                print(f"Found file with different case: {file_path.name} (expected: {filename})")
-                return file_path
-    
-    print(f"WARNING: Source file not found for {landcover}_{model}_{scenario}_{variant}")
-    print(f"  Tried: {filename}")
-    print(f"  Available files matching pattern: {[f.name for f in matching_files]}")
-    return None
+            key = tuple(part.lower() for part in parts[:4])
+            source_index[key] = file_path
+
+    print(f"Indexed {len(source_index)} source files in {source_dir}")
+    return source_index
+
+
+def find_source_file(landcover, model, scenario, variant, source_index):
+    """Find the source NetCDF file for given parameters."""
+    key = (landcover.lower(), model.lower(), scenario.lower(), variant.lower())
+    source_path = source_index.get(key)
+
+    if source_path is None:
+        print(f"WARNING: Source file not found for {landcover}_{model}_{scenario}_{variant}")
+    elif source_path.name != f"{landcover}_{model}_{scenario}_{variant}_doy_mmm_by_era.nc":
+        print(f"Found file with different case: {source_path.name}")
+
+    return source_path
 
 
 def get_random_sample(combined_ds, n_samples=10):
@@ -250,6 +247,10 @@ def main():
         print(f"ERROR opening combined file: {e}")
         sys.exit(1)
     
+    # Index source files once, instead of searching the directory for every sample
+    source_index = build_source_index(source_dir)
+    print()
+
     # Generate random samples
     print("Generating random samples...")
     samples = get_random_sample(combined_ds, n_samples=n_samples)
@@ -280,7 +281,7 @@ def main():
             sample['model'], 
             sample['scenario'], 
             variant,
-            source_dir
+            source_index
         )
         
         if source_file is None:
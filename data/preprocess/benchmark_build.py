@@ -0,0 +1,187 @@
+# script to time and memory-profile each stage of building a stats netCDF, on synthetic or real data
+# for each scale, a synthetic dataset with n_streams * scale streams is generated with synthetic_data.py (unless --data_dir is given),
+# and the seg output is built with each pipeline:
+#   legacy: create_empty_dataset(), populate_dataset(), sort_by_model_dimension(), convert_to_float32(), then clip and write
+#   memory: float32 stat blocks built in memory (the default build_nc.py build)
+#   stream: CSVs written straight to the netCDF on disk (build_nc.py --stream)
+# every stage reports its wall time, the peak memory allocated during the stage (with tracemalloc), and the process peak RSS
+# NOTE: with --workers > 1, memory used by the worker processes is not included
+
+import argparse
+import sys
+import os
+import time
+import resource
+import tracemalloc
+import numpy as np
+import pandas as pd
+from functions import *
+from manifest import scan_directory, manifest_files
+from geometry_ids import load_geometry_ids
+from synthetic_data import generate_dataset
+
+PIPELINES = ["legacy", "memory", "stream"]
+
+
+def arguments(argv):
+    """Parse some args"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--work_dir",
+        type=str,
+        help="directory where the synthetic datasets and outputs will be saved",
+        required=True,
+    )
+    parser.add_argument(
+        "--data_dir",
+        type=str,
+        default=None,
+        help="benchmark an existing stats directory instead of synthetic data (requires --gis_dir)",
+    )
+    parser.add_argument(
+        "--gis_dir",
+        type=str,
+        default=None,
+        help="GIS directory to use with --data_dir",
+    )
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 10], help="scales of the synthetic datasets, e.g. 1 10 100")
+    parser.add_argument("--n_streams", type=int, default=1000, help="number of streams in the 1x synthetic dataset")
+    parser.add_argument("--pipelines", type=str, nargs="+", choices=PIPELINES, default=PIPELINES, help="pipelines to benchmark")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes used to parse the CSVs")
+    parser.add_argument("--no_trace", action="store_true", help="skip tracemalloc, which slows down the stages that allocate many Python objects")
+    parser.add_argument("--results", type=str, default=None, help="optional path of a CSV to save the results to")
+
+    args = parser.parse_args()
+    if args.data_dir is not None and args.gis_dir is None:
+        parser.error("--data_dir requires --gis_dir")
+
+    return args.work_dir, args.data_dir, args.gis_dir, args.scales, args.n_streams, args.pipelines, args.workers, not args.no_trace, args.results
+
+
+class StageTimer:
+    # time each stage of a pipeline and record its peak memory
+
+    def __init__(self, label, trace=True):
+        self.label = label
+        self.trace = trace
+        self.results = []
+
+    def run(self, stage, func, *args, **kwargs):
+        # run func as one stage and return its result
+
+        if self.trace:
+            tracemalloc.start()
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        peak_mb = np.nan
+        if self.trace:
+            peak_mb = tracemalloc.get_traced_memory()[1] / 1e6
+            tracemalloc.stop()
+        # ru_maxrss is in kilobytes on Linux
+        rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+        self.results.append({**self.label, "stage": stage, "seconds": seconds, "peak_alloc_mb": peak_mb, "max_rss_mb": rss_mb})
+        print(f"{self.label['pipeline']} {self.label['scale']}x {stage}: {seconds:.2f} s, {peak_mb:.1f} MB peak\n")
+
+        return result
+
+
+def prepare_inputs(timer, data_dir, gis_dir):
+    # stages shared by all pipelines: scan and filter the CSVs, parse the coordinates, and get the clipped IDs
+
+    manifest = timer.run("scan", scan_directory, data_dir, "*.csv")
+    files = timer.run("filter", lambda: filter_files(manifest_files(manifest, "seg"), "seg"))
+    coords_dict = timer.run("coords", get_unique_coords, files)
+
+    def get_ids():
+        ids = pd.read_csv(files[0], usecols=["seg_id"])["seg_id"].astype(int).tolist()
+        shp_ids = load_geometry_ids(os.path.join(gis_dir, "Segments_subset.shp"), "seg_id_nat")
+        return ids, shp_ids
+
+    ids, shp_ids = timer.run("ids", get_ids)
+
+    return files, coords_dict, ids, shp_ids
+
+
+def run_legacy(timer, files, coords_dict, ids, shp_ids, outfile, workers):
+    # the original in-memory pipeline, one stage per function
+    # populate_dataset() has no worker pool, so workers is ignored
+
+    ds = timer.run("populate", lambda: populate_dataset(create_empty_dataset(coords_dict, ids), files))
+    ds = timer.run("metadata", populate_encodings_metadata, ds)
+    ds = timer.run("sort", sort_by_model_dimension, ds)
+    ds = timer.run("float32", convert_to_float32, ds)
+    ds = timer.run("clip", lambda: ds.isel(stream_id=get_clip_rows(ids, shp_ids)))
+    timer.run("write", ds.to_netcdf, outfile)
+
+
+def run_memory(timer, files, coords_dict, ids, shp_ids, outfile, workers):
+    # the in-memory pipeline of build_nc.py, where sorting, float32 conversion and clipping happen while populating
+
+    csv_ids, stream_ids = get_output_ids(ids, shp_ids, "seg", None)
+
+    def populate():
+        target = new_block_target(coords_dict, csv_ids, stream_ids, files)
+        run_targets([target], workers=workers)
+        return target
+
+    target = timer.run("populate", populate)
+    ds = timer.run("metadata", lambda: populate_encodings_metadata(finish_block_target(target)))
+    timer.run("write", ds.to_netcdf, outfile)
+
+
+def run_stream(timer, files, coords_dict, ids, shp_ids, outfile, workers):
+    # the streaming pipeline of build_nc.py --stream, where metadata is written up front and populating writes to disk
+
+    csv_ids, stream_ids = get_output_ids(ids, shp_ids, "seg", None)
+
+    target = timer.run(
+        "metadata", new_stream_target, outfile, coords_dict, csv_ids, stream_ids, files, populate_encodings_metadata
+    )
+    timer.run("populate", run_targets, [target], workers=workers)
+    timer.run("write", finish_stream_target, target)
+
+
+if __name__ == "__main__":
+
+    work_dir, data_dir, gis_dir, scales, n_streams, pipelines, workers, trace, results_path = arguments(sys.argv)
+
+    runners = {"legacy": run_legacy, "memory": run_memory, "stream": run_stream}
+
+    # benchmark the real data once, or each scale of the synthetic data
+    datasets = [(data_dir, gis_dir, "real")] if data_dir is not None else []
+    for scale in scales:
+        if data_dir is not None:
+            break
+        synth_dir = os.path.join(work_dir, f"synthetic_{scale}x")
+        synth_data_dir, synth_gis_dir = os.path.join(synth_dir, "stats"), os.path.join(synth_dir, "gis")
+        if not os.path.exists(synth_gis_dir):
+            print(f"Generating synthetic dataset with {n_streams * scale} streams in {synth_dir}...\n")
+            generate_dataset(synth_data_dir, synth_gis_dir, n_streams=n_streams * scale)
+        datasets.append((synth_data_dir, synth_gis_dir, scale))
+
+    results = []
+    for bench_data_dir, bench_gis_dir, scale in datasets:
+        for pipeline in pipelines:
+            out_dir = os.path.join(work_dir, f"output_{pipeline}_{scale}x")
+            os.makedirs(out_dir, exist_ok=True)
+            outfile = os.path.join(out_dir, "seg.nc")
+            if os.path.exists(outfile):
+                os.remove(outfile)
+
+            timer = StageTimer({"pipeline": pipeline, "scale": scale}, trace=trace)
+            start = time.perf_counter()
+            inputs = prepare_inputs(timer, bench_data_dir, bench_gis_dir)
+            runners[pipeline](timer, *inputs, outfile, workers)
+            timer.results.append(
+                {"pipeline": pipeline, "scale": scale, "stage": "total", "seconds": time.perf_counter() - start}
+            )
+            results += timer.results
+
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False, float_format=lambda x: f"{x:.2f}"))
+
+    if results_path is not None:
+        results.to_csv(results_path, index=False)
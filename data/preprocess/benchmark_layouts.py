@@ -0,0 +1,171 @@
+# script to benchmark read performance of the stats netCDFs in different storage layouts
+# an output built by build_nc.py (e.g. seg.nc) is copied once per layout, and each copy is timed for:
+#   single: random single stream_id reads of all stats, models, scenarios and eras (the API / rasdaman access pattern)
+#   batch:  reads of all stats for a batch of stream_ids, about the size of a HUC8
+#   scan:   full reads of single stat variables
+# use the results to pick the --layout, --chunk_streams and --complevel arguments of build_nc.py
+
+import argparse
+import sys
+import os
+import time
+import numpy as np
+import pandas as pd
+import netCDF4
+from functions import *
+
+
+def arguments(argv):
+    """Parse some args"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--nc",
+        type=str,
+        help="output netCDF built by build_nc.py to benchmark, e.g. seg.nc",
+        required=True,
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        help="directory where the copies of the netCDF in each layout will be saved",
+        required=True,
+    )
+    parser.add_argument(
+        "--layouts",
+        type=str,
+        nargs="+",
+        default=["contiguous", "slab", "stream:64", "stream:64:4", "stream:256:4", "stream:1024:4"],
+        help="layouts to benchmark, as <layout>[:<chunk_streams>[:<complevel>]], e.g. stream:64:4",
+    )
+    parser.add_argument(
+        "--n_reads",
+        type=int,
+        default=100,
+        help="number of random reads timed for each access pattern",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=300,
+        help="number of stream_ids in each batch read (roughly the number of segments in a HUC8)",
+    )
+    parser.add_argument(
+        "--n_scans",
+        type=int,
+        default=5,
+        help="number of stat variables read in full for the scan timings",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="seed for the random stream_ids and stat variables",
+    )
+    parser.add_argument(
+        "--results",
+        type=str,
+        default=None,
+        help="optional path of a CSV to save the results to",
+    )
+
+    args = parser.parse_args()
+
+    return args.nc, args.output_dir, args.layouts, args.n_reads, args.batch_size, args.n_scans, args.seed, args.results
+
+
+def parse_layout(layout):
+    # parse a layout argument like "stream:64:4" into (layout, chunk_streams, complevel)
+
+    parts = layout.split(":")
+    name = parts[0]
+    chunk_streams = int(parts[1]) if len(parts) > 1 else 64
+    complevel = int(parts[2]) if len(parts) > 2 else 0
+
+    return name, chunk_streams, complevel
+
+
+def time_reads(nc, stat_vars, selections):
+    # read all stat variables for each selection along stream_id, and return the time of each read in seconds
+
+    times = []
+    for selection in selections:
+        start = time.perf_counter()
+        for stat in stat_vars:
+            nc[stat][..., selection]
+        times.append(time.perf_counter() - start)
+
+    return np.array(times)
+
+
+def time_scans(nc, stat_vars):
+    # read each of the stat variables in full, and return the time of each read in seconds
+
+    times = []
+    for stat in stat_vars:
+        start = time.perf_counter()
+        nc[stat][:]
+        times.append(time.perf_counter() - start)
+
+    return np.array(times)
+
+
+def summarize(label, pattern, times):
+    # summarize the timings of one access pattern, in milliseconds
+
+    return {
+        "layout": label,
+        "pattern": pattern,
+        "n": len(times),
+        "median_ms": np.median(times) * 1000,
+        "p95_ms": np.percentile(times, 95) * 1000,
+        "total_s": times.sum(),
+    }
+
+
+if __name__ == "__main__":
+
+    nc_path, output_dir, layouts, n_reads, batch_size, n_scans, seed, results_path = arguments(sys.argv)
+
+    rng = np.random.default_rng(seed)
+    stat_vars = list(stat_vars_dict.keys())
+
+    with netCDF4.Dataset(nc_path, "r") as nc:
+        sizes = {dim: len(nc.dimensions[dim]) for dim in DIMS + ["stream_id"]}
+    n_streams = sizes["stream_id"]
+    batch_size = min(batch_size, n_streams)
+
+    # use the same random selections for every layout
+    singles = rng.integers(0, n_streams, n_reads).tolist()
+    batches = [np.sort(rng.choice(n_streams, batch_size, replace=False)) for _ in range(n_reads)]
+    scans = rng.choice(stat_vars, min(n_scans, len(stat_vars)), replace=False).tolist()
+
+    results = []
+    for layout in layouts:
+        name, chunk_streams, complevel = parse_layout(layout)
+        encoding = get_stat_encoding(sizes, name, chunk_streams, complevel)
+        outfile = os.path.join(output_dir, f"{os.path.splitext(os.path.basename(nc_path))[0]}_{layout.replace(':', '_')}.nc")
+
+        print(f"Writing {outfile}...\n")
+        start = time.perf_counter()
+        copy_output_layout(nc_path, outfile, encoding)
+        write_s = time.perf_counter() - start
+        size_mb = os.path.getsize(outfile) / 1e6
+
+        # reopen the file for each access pattern, so one pattern doesn't warm the chunk cache for the next
+        # NOTE: the OS page cache is not cleared, so run on files larger than memory (or drop caches) for cold read timings
+        with netCDF4.Dataset(outfile, "r") as nc:
+            single = summarize(layout, "single", time_reads(nc, stat_vars, singles))
+        with netCDF4.Dataset(outfile, "r") as nc:
+            batch = summarize(layout, "batch", time_reads(nc, stat_vars, batches))
+        with netCDF4.Dataset(outfile, "r") as nc:
+            scan = summarize(layout, "scan", time_scans(nc, scans))
+
+        for row in [single, batch, scan]:
+            row.update({"write_s": write_s, "size_mb": size_mb})
+            results.append(row)
+
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False, float_format=lambda x: f"{x:.2f}"))
+
+    if results_path is not None:
+        results.to_csv(results_path, index=False)
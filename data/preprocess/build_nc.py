@@ -1,11 +1,12 @@
 import argparse
 import sys
 import os
-from pathlib import Path
 import pandas as pd
-import geopandas as gpd
 from datetime import datetime
 from functions import *
+from manifest import read_manifest, scan_directory, write_manifest, manifest_files
+from incremental import *
+from geometry_ids import load_geometry_ids
 
 
 def arguments(argv):
@@ -34,95 +35,318 @@ def arguments(argv):
         action="store_true",
         help="process diff files only; outputs seg_diff.nc and hru_diff.nc",
     )
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="build seg.nc, hru.nc, seg_diff.nc and hru_diff.nc in one run, sharing the GIS files, manifest and worker pool; best combined with --stream, since otherwise all four datasets are held in memory",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="update existing outputs in place, rewriting only the slabs whose CSVs were added, changed or removed since they were built",
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default=None,
+        help="path to a CSV manifest (JSON or Parquet) written by manifest.py; if not given, data_dir is scanned and the manifest is saved to output_dir",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="write each CSV straight to the output netCDFs instead of building the datasets in memory; memory use stays flat",
+    )
+    parser.add_argument(
+        "--id_cache_dir",
+        type=str,
+        default=None,
+        help="directory where the shapefile geometry IDs are cached; defaults to <output_dir>/id_cache",
+    )
+    parser.add_argument(
+        "--no_id_cache",
+        action="store_true",
+        help="read the geometry IDs from the shapefiles without caching them",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of worker processes used to parse the CSVs; 1 parses them serially",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="write the outputs in the compact layout, with a single run dimension listing only the landcover / model / scenario / era combinations that have CSVs, instead of the dense cube",
+    )
+    parser.add_argument(
+        "--layout",
+        type=str,
+        choices=LAYOUTS,
+        default=None,
+        help="storage layout of the stat variables in the outputs: contiguous, slab (one chunk per landcover / model / scenario / era) or stream (chunks of --chunk_streams stream_ids covering everything else); defaults to contiguous for in-memory builds and slab for --stream builds",
+    )
+    parser.add_argument(
+        "--chunk_streams",
+        type=int,
+        default=64,
+        help="number of stream_ids per chunk with --layout stream",
+    )
+    parser.add_argument(
+        "--complevel",
+        type=int,
+        default=0,
+        choices=range(10),
+        help="zlib compression level (with the shuffle filter) of the stat variables; 0 disables compression, which needs a chunked layout",
+    )
+    parser.add_argument(
+        "--pack",
+        type=str,
+        choices=PACKINGS,
+        default=None,
+        help="lossy encoding of the stat variables: int16 or int8 scale / offset packing, or bitround to --keepbits mantissa bits (which only saves space with --complevel); the reconstruction errors of each stat are saved next to each output, e.g. seg_packing.csv",
+    )
+    parser.add_argument(
+        "--keepbits",
+        type=int,
+        default=None,
+        choices=range(24),
+        help="number of float32 mantissa bits kept with --pack bitround",
+    )
 
     args = parser.parse_args()
+    if args.complevel > 0 and (args.layout == "contiguous" or (args.layout is None and not args.stream)):
+        parser.error("--complevel needs a chunked --layout (slab or stream)")
+    if args.pack == "bitround" and args.keepbits is None:
+        parser.error("--pack bitround needs --keepbits")
     data_dir = args.data_dir
     gis_dir = args.gis_dir
     output_dir = args.output_dir
     diff = args.diff
+    workers = args.workers
+    manifest_path = args.manifest
+    stream = args.stream
+    build_all = args.all
+    incremental = args.incremental
+    if args.no_id_cache:
+        id_cache_dir = None
+    else:
+        id_cache_dir = args.id_cache_dir or os.path.join(output_dir, "id_cache")
+    storage = {
+        "layout": args.layout,
+        "chunk_streams": args.chunk_streams,
+        "complevel": args.complevel,
+        "compact": args.compact,
+        "packing": args.pack,
+        "keepbits": args.keepbits,
+    }
 
-    return data_dir, gis_dir, output_dir, diff
+    return data_dir, gis_dir, output_dir, diff, workers, manifest_path, stream, build_all, incremental, storage, id_cache_dir
 
 
-if __name__ == "__main__":
+def prepare_target(type, diff, manifest, shp_ids, hru_xwalk, output_dir, stream, incremental, storage):
+    # set up the build target for one output (seg, hru, seg_diff or hru_diff)
+    # type is either "seg" or "hru"
+
+    label = "stream segment" if type == "seg" else "watershed"
 
-    data_dir, gis_dir, output_dir, diff = arguments(sys.argv)
+    # list and filter CSV files
+    files = filter_files(manifest_files(manifest, type), type, diff=diff)
 
-    print(f"Reading hydro stats CSVs from {data_dir}...\n")
+    # get geometry IDs from first file (assumes first file has complete geometry)
+    id_col = "seg_id" if type == "seg" else "hru_id"
+    ids = pd.read_csv(files[0], usecols=[id_col])[id_col].astype(int).tolist()
 
-    # list CSV files
-    seg_files = list(Path(data_dir).glob("dynamic*seg*.csv"))
-    seg_files += list(Path(data_dir).glob("static*seg*.csv"))
+    # crosswalk and clip the geometry IDs up front, so that rows outside the shapefile are never stored
+    # every CSV is then matched to these IDs by its own ID column, so CSVs don't need to have the same row order
+    csv_ids, stream_ids = get_output_ids(ids, shp_ids, type, hru_xwalk)
 
-    hru_files = list(Path(data_dir).glob("dynamic*hru*.csv"))
-    hru_files += list(Path(data_dir).glob("static*hru*.csv"))
+    # get unique coordinates
+    coords_dict = get_unique_coords(files)
 
-    # filter files
-    seg_files = filter_files(seg_files, "seg", diff=diff)
-    hru_files = filter_files(hru_files, "hru", diff=diff)
+    outfile = os.path.join(output_dir, f"{type}_diff.nc" if diff else f"{type}.nc")
+    populate_metadata = populate_diff_metadata if diff else populate_encodings_metadata
+    manifest_rows = get_manifest_rows(manifest, files)
+
+    compact = storage["compact"]
+    if incremental and compact:
+        print(f"Incremental updates are not supported for the compact layout, rebuilding {outfile}...\n")
+        incremental = False
+
+    target = None
+    if incremental:
+        # rewrite only the slabs of the CSVs that changed since the existing output was built
+        target = new_incremental_target(outfile, coords_dict, csv_ids, stream_ids, files, populate_metadata, manifest_rows)
+        if target is not None:
+            target["incremental"] = True
+
+    if target is None and stream:
+        # write each CSV straight to the netCDF on disk
+        print(f"Streaming {len(files)} {label} statistic CSVs to {outfile}...\n")
+        target = new_stream_target(outfile, coords_dict, csv_ids, stream_ids, files, populate_metadata, compact)
+    elif target is None:
+        # build the dataset in memory directly from the data in the CSVs
+        print(f"Building float32 dataset from {len(files)} {label} statistic CSVs...\n")
+        target = new_block_target(coords_dict, csv_ids, stream_ids, files, compact)
+
+    target.update(
+        {
+            "type": type,
+            "outfile": outfile,
+            "populate_metadata": populate_metadata,
+            "manifest_rows": manifest_rows,
+            "storage": storage,
+        }
+    )
+    if "previous_storage" in target and storage["layout"] is None and storage["complevel"] == 0:
+        # without --layout or --complevel, outputs rewritten by --incremental keep the layout they were built with
+        target["storage"] = {**storage, **target["previous_storage"]}
+
+    return target
+
+
+def get_target_encoding(target, default_layout):
+    # get the storage settings of the stat variables of a build target's output (see get_stat_encoding())
+
+    storage = target["storage"]
+    if "runs" in target:
+        sizes = {"run": len(target["runs"])}
+    else:
+        sizes = {dim: len(target["coord_index"][dim]) for dim in DIMS}
+    sizes["stream_id"] = len(target["id_index"][1])
+    layout = storage["layout"] or default_layout
+
+    return get_stat_encoding(sizes, layout, storage["chunk_streams"], storage["complevel"])
+
+
+def get_target_quality(target):
+    # get the data quality report of a build target (see get_quality_report()), and write it next to the output
+    # e.g. seg_quality.csv next to seg.nc; for incremental updates, the rows of the CSVs that weren't reread are kept
+
+    outfile = target["outfile"]
+    report = get_quality_report(target.get("quality", []))
+    report_path = f"{os.path.splitext(outfile)[0]}_quality.csv"
+
+    if target.get("incremental") and os.path.exists(report_path):
+        previous = pd.read_csv(report_path)
+        reread = [file.name for file in target["files"]]
+        keep = previous["file"].isin(target["manifest_rows"]["name"]) & ~previous["file"].isin(reread)
+        report = pd.concat([previous[keep], report], ignore_index=True).sort_values(["file", "stat"], ignore_index=True)
+
+    report.to_csv(report_path, index=False)
+
+    totals = report[QUALITY_COUNTS].sum()
+    print(
+        f"Found {totals['sentinel']} sentinel, {totals['nan']} NaN and {totals['inf']} inf values, "
+        f"and {totals['missing_column']} missing stat columns, in the CSVs of {outfile}; see {report_path}\n"
+    )
+
+    return report
+
+
+def finish_target(target):
+    # close the netCDF of a streaming or incremental build target, or add metadata to an in-memory one and write it
+    # streamed outputs are written in the slab layout, so they are copied to the requested layout once complete
+    # outputs updated by --incremental keep the layout they were built with, unless --layout or --complevel is given
+    # the manifest of the CSVs used is saved alongside the output, so that it can be updated with --incremental later
+    # the data quality counts of each stat are added as variable attributes, and saved per CSV in a report alongside the output
+    # with --pack, the stats are packed last, once the output has its final layout
+
+    outfile = target["outfile"]
+    storage = target["storage"]
+    quality_attrs = get_quality_attrs(get_target_quality(target))
+
+    if "nc" in target:
+        for stat, attrs in quality_attrs.items():
+            target["nc"][stat].setncatts(attrs)
+        if target.get("incremental"):
+            finish_incremental_target(target, outfile)
+            print(f"Finished updating {outfile}...\n")
+        else:
+            finish_stream_target(target)
+            print(f"Finished writing {outfile}...\n")
+
+        if target.get("incremental") and "tmpfile" not in target:
+            # updated in place, so it only needs a new layout if one was requested
+            relayout = storage["layout"] is not None or storage["complevel"] > 0
+        else:
+            relayout = storage["layout"] not in [None, "slab"] or storage["complevel"] > 0
+
+        if relayout:
+            print(f"Rewriting {outfile} with the {storage['layout'] or 'slab'} layout...\n")
+            set_output_layout(outfile, get_target_encoding(target, "slab"))
+    else:
+        ds = finish_block_target(target)
+        print("Adding variable and dimension encodings metadata ...\n")
+        ds = target["populate_metadata"](ds)
+        for stat, attrs in quality_attrs.items():
+            ds[stat].attrs.update(attrs)
+        print(f"Writing populated netCDF to {outfile}...\n")
+        encoding = get_target_encoding(target, "contiguous")
+        ds.to_netcdf(outfile, encoding={stat: encoding for stat in stat_vars_dict.keys()})
+        del ds
+
+    if storage["packing"] is not None:
+        print(f"Packing the stats of {outfile} as {storage['packing']}...\n")
+        set_output_packing(outfile, storage["packing"], storage["keepbits"])
+
+    write_manifest(target["manifest_rows"], output_manifest_path(outfile))
+
+    return
+
+
+if __name__ == "__main__":
+
+    data_dir, gis_dir, output_dir, diff, workers, manifest_path, stream, build_all, incremental, storage, id_cache_dir = arguments(sys.argv)
+
+    # read the file manifest if one was given, otherwise scan the data directory once and save the manifest with the outputs
+    if manifest_path is not None:
+        print(f"Reading hydro stats CSV manifest from {manifest_path}...\n")
+        manifest = read_manifest(manifest_path)
+    else:
+        # the hashes of the CSVs that have not changed since the last build (same size and mtime) are reused
+        saved_manifest_path = os.path.join(output_dir, "manifest.json")
+        previous = read_manifest(saved_manifest_path) if os.path.exists(saved_manifest_path) else None
+        print(f"Scanning hydro stats CSVs in {data_dir}...\n")
+        manifest = scan_directory(data_dir, "*.csv", previous=previous)
+        write_manifest(manifest, saved_manifest_path)
 
     print(f"Reading GIS files from {gis_dir}...\n")
 
     # get seg/hru shapefiles to extract IDs
+    # only the IDs are needed from the seg/hru shapefiles; they are cached as .npy files after the first read
+    shp_ids = {}
     seg_shp_path = os.path.join(gis_dir, "Segments_subset.shp")
-    seg_shp = gpd.read_file(seg_shp_path)
+    shp_ids["seg"] = load_geometry_ids(seg_shp_path, "seg_id_nat", id_cache_dir)
     hru_shp_path = os.path.join(gis_dir, "HRU_subset.shp")
-    hru_shp = gpd.read_file(hru_shp_path)
+    shp_ids["hru"] = load_geometry_ids(hru_shp_path, "hru_id_nat", id_cache_dir)
     # get crosswalk to fix HRU IDs
     hru_xwalk = pd.read_csv(
         os.path.join(gis_dir, "nhm_hru_id_crosswalk.csv"),
         dtype={"hru_id": int, "hru_id_nat": int},
     )
 
-    print(f"Parsing geometry IDs and model / scenario / era coordinates...\n")
+    # with --all, build regular and diff outputs in one run; otherwise build only the outputs selected by --diff
+    diffs = [False, True] if build_all else [diff]
+    builds = [(type, d) for d in diffs for type in ["seg", "hru"]]
 
-    # get geometry IDs from first file (assumes first file has complete geometry)
-    seg_ids = pd.read_csv(seg_files[0]).seg_id.astype(int).tolist()
-    hru_ids = pd.read_csv(hru_files[0]).hru_id.astype(int).tolist()
+    if build_all:
+        # set up all four outputs first, then parse the CSVs of all of them through one shared worker pool
+        print(f"Parsing geometry IDs and model / scenario / era coordinates...\n")
+        targets = [
+            prepare_target(type, d, manifest, shp_ids[type], hru_xwalk, output_dir, stream, incremental, storage) for type, d in builds
+        ]
+        run_targets(targets, workers=workers)
+        for target in targets:
+            finish_target(target)
+        del targets
 
-    # get unique coordinates
-    geom_coords_dict = {}
-    geom_coords_dict["seg"] = get_unique_coords(seg_files)
-    geom_coords_dict["hru"] = get_unique_coords(hru_files)
-
-    # create empty netCDFs and populate with the data from CSVs
-
-    print("Creating empty netCDF dataset to hold stream segment statistics...\n")
-    seg_ds = create_empty_dataset(geom_coords_dict["seg"], seg_ids)
-    print(
-        f"Populating dataset from {len(seg_files)} stream segment statistic CSVs...\n"
-    )
-    seg_ds = populate_dataset(seg_ds, seg_files)
-    print("Adding variable and dimension encodings metadata ...\n")
-    seg_ds = populate_diff_metadata(seg_ds) if diff else populate_encodings_metadata(seg_ds)
-    print("Sorting model dimension ...\n")
-    seg_ds = sort_by_model_dimension(seg_ds)
-    print("Converting data variables and dimensions to float32 ...\n")
-    seg_ds = convert_to_float32(seg_ds)
-    print(f"Clipping dataset to the extent of {seg_shp_path} ...\n")
-    seg_ds = clip_dataset(seg_ds, seg_shp, "seg")
-    seg_outfile = os.path.join(output_dir, "seg_diff.nc" if diff else "seg.nc")
-    print(f"Writing populated netCDF to {seg_outfile}...\n")
-    seg_ds.to_netcdf(seg_outfile)
-    del seg_ds
-
-    print("Creating empty netCDF dataset to hold watershed statistics...\n")
-    hru_ds = create_empty_dataset(geom_coords_dict["hru"], hru_ids)
-    print(f"Populating dataset from {len(hru_files)} watershed statistic CSVs...\n")
-    hru_ds = populate_dataset(hru_ds, hru_files)
-    print("Adding variable and dimension encodings metadata ...\n")
-    hru_ds = populate_diff_metadata(hru_ds) if diff else populate_encodings_metadata(hru_ds)
-    print("Sorting model dimension ...\n")
-    hru_ds = sort_by_model_dimension(hru_ds)
-    print("Converting data variables and dimensions to float32 ...\n")
-    hru_ds = convert_to_float32(hru_ds)
-    print("Crosswalking HRU IDs to match shapefile ...\n")
-    hru_ds = crosswalk_hrus(hru_ds, hru_xwalk)
-    print(f"Clipping dataset to the extent of {hru_shp_path} ...\n")
-    hru_ds = clip_dataset(hru_ds, hru_shp, "hru")
-    hru_outfile = os.path.join(output_dir, "hru_diff.nc" if diff else "hru.nc")
-    print(f"Writing populated netCDF to {hru_outfile}...\n")
-    hru_ds.to_netcdf(hru_outfile)
-    del hru_ds
+    else:
+        # build the outputs one after the other, so only one is held in memory at a time
+        for type, d in builds:
+            print(f"Parsing geometry IDs and model / scenario / era coordinates...\n")
+            target = prepare_target(type, d, manifest, shp_ids[type], hru_xwalk, output_dir, stream, incremental, storage)
+            run_targets([target], workers=workers)
+            finish_target(target)
+            del target
 
     print("Processing finished at ", datetime.now(), "\n")
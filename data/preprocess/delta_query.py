@@ -0,0 +1,165 @@
+# on-demand "projected vs baseline" differences from the stats netCDFs built by build_nc.py (seg.nc, hru.nc)
+# or the combined netCDFs written by seg_correct_and_combine.py, using the difference_method of each stat in luts.py:
+#   ratio: target / baseline, as in the *_diff.csv files (so baseline * delta gives the target back)
+#   absolute: target - baseline
+#   circular: smallest signed difference in days (-183 to 183) for the Julian date stats in JULIAN_DATE_VARS
+# only the two (landcover, model, scenario, era) slabs needed are read, and results are memoized per
+# (var, baseline, target) in an LRU cache, so repeated queries (e.g. for different streams) don't read the file again
+#
+# example:
+#     with DeltaQuery("seg.nc") as query:
+#         da = query.delta("ma12", target={"landcover": "static", "model": "CCSM4", "scenario": "rcp45", "era": "2046_2075"})
+# the baseline defaults to Maurer historical 1976-2005, and takes any labels it doesn't set (here landcover) from the target
+# the derived sources of virtual combined outputs (seg_correct_and_combine.py --virtual) are computed with CombinedReader
+
+from functools import lru_cache
+import numpy as np
+import xarray as xr
+import netCDF4
+from functions import DIMS, set_auto_unpack, read_values
+from luts import *
+from seg_correct_and_combine import BASELINE, JULIAN_DATE_VARS, SOURCE_ENCODING, MONTHLY_VARS
+from virtual_source import CombinedReader
+
+
+def encode_label(dim, label):
+    # get the encoded coordinate value of a label, e.g. ("era", "2046_2075") or ("era", "2046-2075") -> 2
+    # encoded values are passed through
+
+    if dim == "source":
+        lookup = {name: code for code, name in SOURCE_ENCODING.items()}
+    else:
+        lookup = {**{name: code for code, name in reverse_encodings_lookup[dim].items()}, **encodings_lookup[dim]}
+    if label in lookup:
+        return lookup[label]
+    if label in lookup.values():
+        return label
+
+    raise KeyError(f"Unknown {dim}: {label}")
+
+
+def get_delta_method(var):
+    # get the difference method of a stat: circular for Julian dates, otherwise the difference_method in luts.py
+
+    if var in JULIAN_DATE_VARS:
+        return "circular"
+    if var == "ma99":
+        # ma99 (in the combined outputs only) is a mean of monthly flows
+        return "ratio"
+
+    return stat_vars_dict[var]["difference_method"]
+
+
+def compute_delta(method, baseline, target):
+    # difference between target and baseline values with one of the methods of get_delta_method()
+
+    if method == "ratio":
+        with np.errstate(divide="ignore", invalid="ignore"):
+            delta = target / baseline
+        # there is no ratio for a zero baseline
+        return np.where(baseline == 0, np.nan, delta)
+    if method == "circular":
+        return np.remainder(target - baseline + 183, 366) - 183
+    if method == "absolute":
+        return target - baseline
+
+    raise ValueError(f"Unknown difference method: {method}")
+
+
+class DeltaQuery:
+    # compute differences between two slabs of a stats netCDF on demand, memoizing the results
+
+    def __init__(self, path, cache_size=128, block_streams=1024):
+        self.nc = netCDF4.Dataset(path, "r")
+        set_auto_unpack(self.nc)
+        self.stream_ids = self.nc["stream_id"][:]
+
+        # outputs in the compact layout store each (landcover, model, scenario, era) slab as a run
+        self.compact = "run" in self.nc.dimensions
+        self.dims = ["source"] if "source" in self.nc.dimensions else []
+        self.dims += DIMS
+        self.coords = {dim: self.nc[dim][:].tolist() for dim in self.dims}
+
+        # virtual combined outputs don't store the derived sources, which are read through a CombinedReader
+        # in blocks of block_streams stream_ids, and come after the stored sources in the source coordinate
+        self.reader = None
+        if "derived_sources" in self.nc.ncattrs():
+            self.reader = CombinedReader(path, cache_size=len(MONTHLY_VARS) + 1)
+            source_codes = {name: code for code, name in SOURCE_ENCODING.items()}
+            self.coords["source"] += [source_codes[name] for name in self.reader.derived]
+        self.block_streams = block_streams
+
+        self.read_delta = lru_cache(maxsize=cache_size)(self._read_delta)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.read_delta.cache_clear()
+        if self.reader is not None:
+            self.reader.close()
+        self.nc.close()
+
+    def get_slab_index(self, labels):
+        # get the index of the slab with the given (encoded) labels in the stat variables
+
+        missing = [dim for dim in self.dims if dim not in labels]
+        if missing:
+            raise KeyError(f"Missing labels for {missing}")
+        try:
+            positions = tuple(self.coords[dim].index(labels[dim]) for dim in self.dims)
+        except ValueError:
+            raise KeyError(f"No slab for {labels}") from None
+        if self.compact:
+            run = self.nc["run_index"][positions[len(self.dims) - len(DIMS) :]]
+            if run < 0:
+                raise KeyError(f"No run for {labels}")
+            return positions[: len(self.dims) - len(DIMS)] + (int(run),)
+
+        return positions
+
+    def read_slab(self, var, labels):
+        # read the values of one variable for one slab, for all stream_ids
+
+        index = self.get_slab_index(labels)
+        if self.reader is not None and index[0] >= self.nc.dimensions["source"].size:
+            source = SOURCE_ENCODING[int(self.coords["source"][index[0]])]
+            blocks = [
+                self.reader.read(var, source, self.stream_ids[start : start + self.block_streams])[index[1:]]
+                for start in range(0, len(self.stream_ids), self.block_streams)
+            ]
+            return np.concatenate(blocks)
+
+        return read_values(self.nc[var], index + (slice(None),))
+
+    def _read_delta(self, var, baseline, target):
+        # difference between the target and baseline slabs of var for all stream_ids
+        # baseline and target are tuples of (dim, encoded label) pairs, so they can be cached
+
+        values = compute_delta(get_delta_method(var), self.read_slab(var, dict(baseline)), self.read_slab(var, dict(target)))
+        # the cached array is shared between queries, so make it read-only
+        values.setflags(write=False)
+
+        return values
+
+    def delta(self, var, target, baseline=None, streams=None):
+        # difference of var between the target and baseline slabs, as a DataArray along stream_id
+        # target and baseline are dicts of labels for each dim, e.g. {"landcover": "static", "model": "CCSM4", ...};
+        # the baseline defaults to BASELINE, and labels missing from it are taken from the target
+        # streams optionally selects stream_ids
+
+        if var not in self.nc.variables:
+            raise KeyError(f"{var} is not in the file")
+        baseline = {**target, **(BASELINE if baseline is None else baseline)}
+        key = lambda labels: tuple(sorted((dim, encode_label(dim, label)) for dim, label in labels.items()))
+
+        values = self.read_delta(var, key(baseline), key(target))
+        da = xr.DataArray(values, dims=["stream_id"], coords={"stream_id": self.stream_ids}, name=var)
+        da.attrs = {"difference_method": get_delta_method(var), "baseline": str(baseline), "target": str(target)}
+        if streams is not None:
+            da = da.sel(stream_id=streams)
+
+        return da
@@ -0,0 +1,230 @@
+# script to compute ensemble delta summaries from a combined netCDF written by seg_correct_and_combine.py (e.g. seg_combined.nc)
+# for every landcover / future scenario / future era combination with data, the projected values (gcm_diff_applied_to_maurer)
+# of each GCM are compared to the Maurer historical baseline (original_gcm), and the deltas are summarized across models:
+#   min, mean and max (as in fetch_stats_from_rasdaman_coverage.ipynb), optional percentiles,
+#   and the number of models with data, with a positive delta and with a negative delta (sign agreement)
+# the baseline value of each variable is also saved as <var>_hist
+# all combinations are computed in one pass over the file, in blocks of stream_ids, and written to a Parquet file
+# with one row per (landcover, scenario, era, stream_id)
+
+import argparse
+import sys
+import warnings
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from luts import *
+from geometry_ids import load_geometry_ids
+from virtual_source import CombinedReader
+from seg_correct_and_combine import MONTHLY_VARS, BASELINE
+
+# how each variable is compared to the baseline, as in VARS_META of fetch_stats_from_rasdaman_coverage.ipynb:
+#   pct: percent change from the baseline, abs: difference, circular: smallest signed difference in days of the year
+SUMMARY_DELTAS = {
+    **{var: "pct" for var in MONTHLY_VARS},
+    "dh1": "pct",
+    "dl1": "pct",
+    "dh15": "abs",
+    "dl16": "abs",
+    "fh1": "abs",
+    "fl1": "abs",
+    "th1": "circular",
+    "tl1": "circular",
+    "ma99": "pct",
+}
+
+PROJECTED_SOURCE = "gcm_diff_applied_to_maurer"
+BASELINE_SOURCE = "original_gcm"
+
+
+def arguments(argv):
+    """Parse some args"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nc", type=str, help="combined netCDF written by seg_correct_and_combine.py", required=True)
+    parser.add_argument("--output", type=str, help="path of the Parquet file to write", required=True)
+    parser.add_argument(
+        "--vars",
+        type=str,
+        nargs="+",
+        choices=list(SUMMARY_DELTAS.keys()),
+        default=list(SUMMARY_DELTAS.keys()),
+        help="variables to summarize",
+    )
+    parser.add_argument(
+        "--percentiles",
+        type=float,
+        nargs="*",
+        default=[],
+        help="percentiles of the deltas across models to add, e.g. 10 90",
+    )
+    parser.add_argument("--decimals", type=int, default=2, help="number of decimals to round the summaries to")
+    parser.add_argument(
+        "--shp",
+        type=str,
+        default=None,
+        help="optional shapefile to subset the streams to, e.g. seg_h8_outlets.shp",
+    )
+    parser.add_argument("--id_col", type=str, default="seg_id_nat", help="ID column of --shp")
+    parser.add_argument("--block_streams", type=int, default=4096, help="number of stream_ids read at a time")
+
+    args = parser.parse_args()
+    if any(q < 0 or q > 100 for q in args.percentiles):
+        parser.error("--percentiles must be between 0 and 100")
+
+    return args.nc, args.output, args.vars, args.percentiles, args.decimals, args.shp, args.id_col, args.block_streams
+
+
+def percentile_label(q):
+    # column label of a percentile, e.g. 10 -> p10, 2.5 -> p2_5
+
+    return "p" + f"{q:g}".replace(".", "_")
+
+
+def compute_deltas(method, projected, baseline):
+    # compare projected values to the baseline with one of the SUMMARY_DELTAS methods
+    # baseline is broadcast against projected
+
+    if method == "pct":
+        # avoid dividing by zero for streams with no baseline flow
+        denom = np.where(baseline != 0, baseline, np.float32(0.0001))
+        return (projected - baseline) / denom * 100
+    if method == "circular":
+        # see shp/modulo.md
+        return np.remainder(projected - baseline + 183, 366) - 183
+    if method == "abs":
+        return projected - baseline
+
+    raise ValueError(f"Unknown delta method: {method}")
+
+
+def summarize_deltas(deltas, percentiles):
+    # summarize deltas across the model axis (1)
+    # returns a dict of arrays with the model axis removed
+
+    with warnings.catch_warnings():
+        # streams and combinations without any model data are left as NaN
+        warnings.filterwarnings("ignore", category=RuntimeWarning)
+        summary = {
+            "min_d": np.nanmin(deltas, axis=1),
+            "avg_d": np.nanmean(deltas, axis=1),
+            "max_d": np.nanmax(deltas, axis=1),
+        }
+        for q in percentiles:
+            summary[f"{percentile_label(q)}_d"] = np.nanpercentile(deltas, q, axis=1)
+
+    summary["n_models"] = np.isfinite(deltas).sum(axis=1).astype(np.int16)
+    summary["n_pos"] = (deltas > 0).sum(axis=1).astype(np.int16)
+    summary["n_neg"] = (deltas < 0).sum(axis=1).astype(np.int16)
+
+    return summary
+
+
+def get_future_positions(reader):
+    # get the positions of the future scenarios and eras in the file, i.e. all but the baseline scenario and era
+
+    positions = {}
+    for dim in ["scenario", "era"]:
+        baseline = encodings_lookup[dim][BASELINE[dim]]
+        positions[dim] = np.flatnonzero(reader.coords[dim] != baseline)
+
+    return positions
+
+
+def summarize_block(reader, variables, stream_ids, future, percentiles, decimals):
+    # summarize every variable for a block of stream_ids
+    # returns a dict of columns with dims (landcover, scenario, era, stream_id), and the number of models with data
+    # for each (landcover, scenario, era) combination
+
+    b_model, b_scenario, b_era = reader.baseline
+    columns = {}
+    n_models = 0
+    for var in variables:
+        projected = reader.read(var, PROJECTED_SOURCE, stream_ids)
+        projected = projected[:, :, future["scenario"]][:, :, :, future["era"]]
+        baseline = reader.read(var, BASELINE_SOURCE, stream_ids)[:, b_model, b_scenario, b_era, :]
+
+        deltas = compute_deltas(SUMMARY_DELTAS[var], projected, baseline[:, None, None, None, :])
+        summary = summarize_deltas(deltas, percentiles)
+        n_models = np.maximum(n_models, summary["n_models"].max(axis=-1))
+
+        for stat, values in summary.items():
+            if values.dtype.kind == "f":
+                values = values.round(decimals)
+            columns[f"{var}_{stat}"] = values
+        # the baseline is the same for every scenario and era
+        hist = np.broadcast_to(baseline[:, None, None, :], summary["min_d"].shape)
+        columns[f"{var}_hist"] = hist.round(decimals)
+
+    return columns, n_models
+
+
+def block_to_table(reader, columns, n_models, stream_ids, future, keep):
+    # flatten the summary columns of a block to a table with one row per (landcover, scenario, era, stream_id),
+    # keeping only the combinations with model data and the streams in keep
+
+    coords = {
+        "landcover": reader.coords["landcover"],
+        "scenario": reader.coords["scenario"][future["scenario"]],
+        "era": reader.coords["era"][future["era"]],
+    }
+
+    tables = []
+    for combination in zip(*np.nonzero(n_models)):
+        row = {
+            dim: [reverse_encodings_lookup[dim][int(coords[dim][i])]] * int(keep.sum())
+            for dim, i in zip(["landcover", "scenario", "era"], combination)
+        }
+        row["stream_id"] = stream_ids[keep]
+        for name, values in columns.items():
+            row[name] = values[combination][keep]
+        tables.append(pa.table(row))
+
+    return tables
+
+
+def summarize_ensemble(nc_path, outfile, variables, percentiles=(), decimals=2, shp_ids=None, block_streams=4096):
+    # compute the ensemble delta summaries of every combination and write them to outfile
+    # returns the number of rows written
+
+    # ma99 of a derived source is computed from the derived monthly variables, so keep a block of each in the cache
+    reader = CombinedReader(nc_path, cache_size=len(MONTHLY_VARS) + 1)
+    if reader.baseline is None:
+        print(f"Error: the {BASELINE} baseline is not in the coordinates of {nc_path}.")
+        sys.exit(1)
+    future = get_future_positions(reader)
+
+    writer = None
+    n_rows = 0
+    n_streams = len(reader.stream_ids)
+    for start in range(0, n_streams, block_streams):
+        stream_ids = reader.stream_ids[start : start + block_streams]
+        keep = np.ones(len(stream_ids), dtype=bool) if shp_ids is None else np.isin(stream_ids, shp_ids)
+        if not keep.any():
+            continue
+
+        columns, n_models = summarize_block(reader, variables, stream_ids, future, percentiles, decimals)
+        for table in block_to_table(reader, columns, n_models, stream_ids, future, keep):
+            if writer is None:
+                writer = pq.ParquetWriter(outfile, table.schema)
+            writer.write_table(table)
+            n_rows += table.num_rows
+        print(f"Summarized stream_ids {start} to {start + len(stream_ids)} of {n_streams}...")
+
+    if writer is not None:
+        writer.close()
+    reader.close()
+
+    return n_rows
+
+
+if __name__ == "__main__":
+
+    nc_path, outfile, variables, percentiles, decimals, shp_path, id_col, block_streams = arguments(sys.argv)
+
+    shp_ids = None
+    if shp_path is not None:
+        shp_ids = load_geometry_ids(shp_path, id_col)
+
+    print(f"Summarizing ensemble deltas of {nc_path}...\n")
+    n_rows = summarize_ensemble(nc_path, outfile, variables, percentiles, decimals, shp_ids, block_streams)
+    print(f"\nWrote {n_rows} rows to {outfile}.\n")
@@ -1,7 +1,33 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import netCDF4
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import xarray as xr
 from luts import *
+from manifest import parse_filename
+
+# dimensions of the stats cubes, excluding stream_id
+DIMS = ["landcover", "model", "scenario", "era"]
+
+# data quality counts kept for each stat of each CSV, see read_stats_csv()
+QUALITY_COUNTS = ["sentinel", "nan", "inf", "missing_column"]
+
+# storage layouts of the stat variables in the output netCDFs
+# contiguous: no chunking (what xarray writes by default)
+# slab: one chunk per (landcover, model, scenario, era) slab, covering all stream_ids (what --stream writes)
+# stream: chunks of chunk_streams stream_ids, covering all landcovers, models, scenarios and eras
+LAYOUTS = ["contiguous", "slab", "stream"]
+
+# lossy encodings of the stat variables in the output netCDFs, see get_packing()
+# int16 / int8: scale_factor and add_offset packing into 16 or 8 bit integers, with the lowest integer as the _FillValue
+# bitround: float32 with the mantissa rounded to a number of bits, which leaves zeros that compress well with zlib
+PACKINGS = ["int16", "int8", "bitround"]
+# attributes of packed stats that describe their storage rather than their values
+PACKING_ATTRS = ["scale_factor", "add_offset", "keepbits", "max_abs_error", "max_rel_error"]
 
 
 def filter_files(files, type, diff=False):
@@ -40,18 +66,17 @@ def get_unique_coords(files):
     eras = []
 
     for file in files:
-        parts = file.name.split("_")
-        try:
-            landcover, model, scenario, variant, era = (
-                parts[0],
-                parts[1],
-                parts[2],
-                parts[3],
-                "_".join([parts[5], parts[6].split(".")[0]]),
-            )
-        except:
+        coords = parse_filename(file.name)
+        if coords is None or coords["kind"] != "stats":
             print(f"Error parsing file: {file.name}")
             continue
+        landcover, model, scenario, variant, era = (
+            coords["landcover"],
+            coords["model"],
+            coords["scenario"],
+            coords["variant"],
+            coords["era"],
+        )
 
         landcovers.append(landcover)
         models.append(model)
@@ -132,18 +157,11 @@ def populate_dataset(ds, files):
 
     for file in files:
         # parse filename to find coords where data should go
-        try:
-            parts = file.name.split("_")
-            landcover, model, scenario, era = (
-                parts[0],
-                parts[1],
-                parts[2],
-                "_".join([parts[5], parts[6].split(".")[0]]),
-            )
-        except:
-            print(f"Error parsing file: {file.name}")
+        coords = parse_file_coords(file)
+        if coords is None:
             print(f"Data will not be written to netCDF.")
             continue
+        landcover, model, scenario, era = coords
 
         # only read in the columns we want, and use actual NaNs
         # this allows for missing columns in the CSV
@@ -206,6 +224,930 @@ def populate_dataset(ds, files):
     return ds
 
 
+def get_coord_index(dict):
+    # map each coordinate string parsed from the file names to its integer position along the output dimensions
+    # positions follow the encoded integer values, so every dimension (including model) is already sorted
+
+    coord_index = {}
+    for dim, key in zip(DIMS, ["landcovers", "models", "scenarios", "eras"]):
+        values = sorted(dict[key], key=lambda x: encodings_lookup[dim][x])
+        coord_index[dim] = {value: i for i, value in enumerate(values)}
+
+    return coord_index
+
+
+def allocate_stat_blocks(coord_index, n_streams):
+    # allocate a float32 block of NaNs for every stat variable
+    # the blocks are stacked along a leading stat axis, so cube[i] is the block for the i-th stat in stat_vars_dict
+    # this lets each CSV be written into every block with a single assignment
+
+    shape = (len(stat_vars_dict),) + tuple(len(coord_index[dim]) for dim in DIMS) + (n_streams,)
+    cube = np.full(shape, np.nan, dtype=np.float32)
+
+    return cube
+
+
+def parse_file_coords(file):
+    # parse filename into its (landcover, model, scenario, era) strings
+    # returns None if the filename can't be parsed
+
+    coords = parse_filename(file.name)
+    if coords is None or coords["kind"] != "stats":
+        print(f"Error parsing file: {file.name}")
+        return None
+
+    return tuple(coords[dim] for dim in DIMS)
+
+
+def get_file_positions(coords, coord_index):
+    # convert parsed (landcover, model, scenario, era) strings to integer positions in the stat blocks
+    # returns None if one of the coords is not in the blocks
+
+    try:
+        positions = tuple(coord_index[dim][coord] for dim, coord in zip(DIMS, coords))
+    except KeyError:
+        print(f"Error: one of {', '.join(coords)} are invalid.")
+        return None
+
+    return positions
+
+
+def read_stats_csv(file, id_col):
+    # read the geometry IDs and stat columns of a CSV
+    # returns an int64 array of the IDs in id_col (None if the column is missing or incomplete),
+    # a float32 array of shape (stat, row) ordered as in stat_vars_dict,
+    # and an int64 array of shape (stat, QUALITY_COUNTS) with the data quality counts of each stat
+    # only the stat_vars_dict columns are parsed; missing columns are filled with NaN,
+    # and the stat_sentinels fill values and inf are replaced with NaN as each column is converted
+    # values are parsed as float64 and then cast, so they are rounded to float32 exactly as before
+
+    stat_vars = list(stat_vars_dict.keys())
+    column_types = {stat: pa.float64() for stat in stat_vars}
+    column_types[id_col] = pa.int64()
+
+    # read the header to tell columns missing from the CSV apart from columns that are present but empty
+    with open(file) as f:
+        header = {name.strip().strip('"') for name in f.readline().split(",")}
+
+    table = pacsv.read_csv(
+        file,
+        convert_options=pacsv.ConvertOptions(
+            column_types=column_types,
+            include_columns=[id_col] + stat_vars,
+            include_missing_columns=True,
+        ),
+    )
+
+    ids = table.column(id_col)
+    if ids.null_count > 0:
+        ids = None
+    else:
+        ids = ids.cast(pa.int64()).to_numpy()
+
+    values = np.empty((len(stat_vars), table.num_rows), dtype=np.float32)
+    counts = np.zeros((len(stat_vars), len(QUALITY_COUNTS)), dtype=np.int64)
+    for i, stat in enumerate(stat_vars):
+        if stat not in header:
+            values[i] = np.nan
+            counts[i, 3] = 1
+            continue
+        row = values[i]
+        row[:] = table.column(stat).to_numpy()
+        # empty cells are NaN here, so the NaN count is of values that were missing in the CSV itself
+        sentinel = np.isin(row, stat_sentinels)
+        nan = np.isnan(row)
+        inf = np.isinf(row)
+        counts[i, :3] = np.count_nonzero(sentinel), np.count_nonzero(nan), np.count_nonzero(inf)
+        row[sentinel | inf] = np.nan
+
+    return ids, values, counts
+
+
+def read_stats_file(file):
+    # read a single stats CSV and return its parsed coords along with its geometry IDs, values and data quality counts
+    # this is a top-level function so that it can be sent to worker processes
+
+    coords = parse_file_coords(file)
+    if coords is None:
+        return None, None, None, None
+
+    id_col = "seg_id" if parse_filename(file.name)["geometry"] == "seg" else "hru_id"
+    ids, values, counts = read_stats_csv(file, id_col)
+
+    return coords, ids, values, counts
+
+
+def get_id_index(csv_ids):
+    # build a sorted index of the geometry IDs kept in an output, as they appear in the CSVs (i.e. before any crosswalk)
+    # csv_ids[i] is the ID of the i-th output stream_id; returns the sorted IDs and the output position of each
+
+    csv_ids = np.asarray(csv_ids, dtype=np.int64)
+    order = np.argsort(csv_ids, kind="stable")
+
+    return csv_ids[order], order
+
+
+def get_id_positions(stream_ids, ids, id_index=None):
+    # position of each of ids in stream_ids, which can be in any order, or -1 for IDs that are not in stream_ids
+    # id_index is get_id_index(stream_ids), for callers that look up many blocks of ids in the same stream_ids
+
+    sorted_ids, order = get_id_index(stream_ids) if id_index is None else id_index
+    ids = np.asarray(ids, dtype=np.int64)
+    if len(order) == 0:
+        return np.full(len(ids), -1, dtype=np.int64)
+
+    idx = np.searchsorted(sorted_ids, ids)
+    idx[idx == len(sorted_ids)] = 0
+    found = sorted_ids[idx] == ids
+
+    return np.where(found, order[idx], -1)
+
+
+def align_stats_rows(file, ids, values, id_index):
+    # scatter the rows of a parsed CSV to the output positions of their geometry IDs
+    # rows with IDs that are not in the output (e.g. outside the shapefile) are dropped before anything is stored,
+    # and output IDs missing from the CSV are left as NaN, so the CSV rows can be in any order
+    # returns a float32 array of shape (stat, stream_id)
+
+    sorted_ids, order = id_index
+    slab = np.full((values.shape[0], len(order)), np.nan, dtype=np.float32)
+    if len(order) == 0:
+        return slab
+
+    idx = np.searchsorted(sorted_ids, ids)
+    idx[idx == len(sorted_ids)] = 0
+    found = sorted_ids[idx] == ids
+    slab[:, order[idx[found]]] = values[:, found]
+
+    n_missing = len(order) - np.count_nonzero(found)
+    if n_missing > 0:
+        print(f"Warning: {n_missing} stream_ids in dataset are missing from {file.name} and will be NaN.")
+
+    return slab
+
+
+def check_stats_slab(file, coords, ids, coord_index):
+    # get the integer positions of a parsed CSV in the stat blocks
+    # returns None if the CSV can't be written, i.e. its filename couldn't be parsed or its geometry IDs couldn't be read
+
+    if coords is None:
+        print(f"Data will not be written to netCDF.")
+        return None
+
+    positions = get_file_positions(coords, coord_index)
+    if positions is None:
+        print(f"Data will not be written to netCDF.")
+        return None
+
+    if ids is None:
+        print(f"Error: geometry ID column is missing or incomplete in {file.name}.")
+        print(f"Data will not be written to netCDF.")
+        return None
+
+    return positions
+
+
+def bounded_map(executor, func, items, max_pending):
+    # like executor.map(func, items), but with at most max_pending items submitted at a time, so that the results
+    # waiting to be consumed (e.g. parsed CSVs) don't pile up in memory when the workers are faster than the consumer
+
+    pending = deque()
+    for item in items:
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+        pending.append(executor.submit(func, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def run_targets(targets, workers=1):
+    # read the CSVs of every build target and write each one to its target as soon as it has been parsed
+    # a target is a dict with the "files" to read, the "coord_index" and "id_index" of its stat blocks, and a "write" function
+    # each CSV is aligned to the output stream_ids by geometry ID before it is written
+    # the data quality counts of each CSV that is written are kept in the target's "quality" list, see get_quality_report()
+    # with workers > 1, CSVs of all targets are parsed in one shared process pool and only the writing of each slab happens here,
+    # with at most 2 * workers CSVs parsed ahead of the writing
+
+    jobs = [(target, file) for target in targets for file in target["files"]]
+    files = [file for _, file in jobs]
+
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = bounded_map(executor, read_stats_file, files, 2 * workers)
+    else:
+        executor = None
+        results = map(read_stats_file, files)
+
+    try:
+        for (target, file), (coords, ids, values, counts) in zip(jobs, results):
+            positions = check_stats_slab(file, coords, ids, target["coord_index"])
+            if positions is not None:
+                target["write"](positions, align_stats_rows(file, ids, values, target["id_index"]))
+                target.setdefault("quality", []).append((file.name, coords, counts))
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    return
+
+
+def get_runs(files, coord_index):
+    # get the sorted integer positions of every (landcover, model, scenario, era) combination that has a CSV
+    # these are the runs stored by the compact layout; files that can't be parsed are skipped (and reported when read)
+
+    runs = set()
+    for file in files:
+        coords = parse_filename(file.name)
+        if coords is None or coords["kind"] != "stats":
+            continue
+        if all(coords[dim] in coord_index[dim] for dim in DIMS):
+            runs.add(tuple(coord_index[dim][coords[dim]] for dim in DIMS))
+
+    return sorted(runs)
+
+
+def get_quality_report(quality):
+    # build a data quality report from the "quality" list of a build target, with one row per stat of each CSV
+    # the sentinel, nan and inf columns count values in the CSV, and missing_column is 1 if the stat column was missing
+
+    stat_vars = list(stat_vars_dict.keys())
+    columns = ["file"] + DIMS + ["stat"] + QUALITY_COUNTS
+    if not quality:
+        return pd.DataFrame(columns=columns)
+
+    frames = []
+    for name, coords, counts in quality:
+        df = pd.DataFrame(counts, columns=QUALITY_COUNTS)
+        df.insert(0, "stat", stat_vars)
+        for i, dim in enumerate(DIMS):
+            df.insert(i, dim, coords[i])
+        df.insert(0, "file", name)
+        frames.append(df)
+
+    return pd.concat(frames, ignore_index=True)[columns]
+
+
+def get_quality_attrs(report):
+    # sum the data quality counts of each stat in a report, as variable attributes, e.g. {"dh1": {"n_sentinel": 12, ...}}
+
+    totals = report.groupby("stat")[QUALITY_COUNTS].sum()
+    attrs = {}
+    for stat in stat_vars_dict.keys():
+        counts = totals.loc[stat] if stat in totals.index else pd.Series(0, index=QUALITY_COUNTS)
+        attrs[stat] = {f"n_{count}": int(counts[count]) for count in QUALITY_COUNTS}
+
+    return attrs
+
+
+def new_block_target(dict, csv_ids, stream_ids, files, compact=False):
+    # create a build target that writes each CSV into in-memory stat blocks
+    # csv_ids are the geometry IDs of the output as they appear in the CSVs, and stream_ids the output stream_id coordinate
+    # (they differ for crosswalked HRUs); only CSV rows with IDs in csv_ids are stored
+    # with compact=True, the blocks only have a slot for each run (combination with a CSV), see stat_blocks_to_dataset()
+
+    coord_index = get_coord_index(dict)
+    target = {
+        "files": files,
+        "coord_index": coord_index,
+        "id_index": get_id_index(csv_ids),
+        "stream_ids": stream_ids,
+    }
+
+    if compact:
+        runs = get_runs(files, coord_index)
+        run_index = {positions: i for i, positions in enumerate(runs)}
+        cube = np.full((len(stat_vars_dict), len(runs), len(stream_ids)), np.nan, dtype=np.float32)
+
+        def write(positions, values):
+            cube[:, run_index[positions], :] = values
+
+        target["runs"] = runs
+    else:
+        cube = allocate_stat_blocks(coord_index, len(stream_ids))
+
+        def write(positions, values):
+            landcover, model, scenario, era = positions
+            cube[:, landcover, model, scenario, era, :] = values
+
+    target.update({"cube": cube, "write": write})
+
+    return target
+
+
+def finish_block_target(target):
+    # wrap the populated stat blocks of a build target in an xarray Dataset
+
+    return stat_blocks_to_dataset(target["cube"], target["coord_index"], target["stream_ids"], target.get("runs"))
+
+
+def stat_blocks_to_dataset(cube, coord_index, stream_ids, runs=None):
+    # wrap the stat blocks in an xarray Dataset without copying them
+    # dimensions are encoded as float32 and stream_id as int32, matching the output of convert_to_float32()
+    # if runs is given, the blocks are in the compact layout with shape (stat, run, stream_id), see runs_to_dataset()
+
+    stat_vars = list(stat_vars_dict.keys())
+    dim_coords = {
+        dim: np.array(encode(list(coord_index[dim].keys()), dim), dtype=np.float32) for dim in DIMS
+    }
+    stream_ids = np.array(stream_ids, dtype=np.int32)
+
+    if runs is not None:
+        ds = runs_to_dataset(
+            {stat: cube[i] for i, stat in enumerate(stat_vars)}, np.array(runs).reshape(-1, len(DIMS)), dim_coords, stream_ids
+        )
+    else:
+        coords = {dim: ([dim], values) for dim, values in dim_coords.items()}
+        coords["stream_id"] = (["stream_id"], stream_ids)
+        ds = xr.Dataset(
+            {stat: (DIMS + ["stream_id"], cube[i]) for i, stat in enumerate(stat_vars)},
+            coords=coords,
+        )
+
+    # use luts dicts to add global metadata to the dataset; for serialization during file writing, each item needs to be a string or list, can't be a dict
+    ds = ds.assign_attrs(
+        {
+            "Data Source": str(data_source_dict),
+            "CMIP5 GCM Metadata": str(gcm_metadata_dict),
+        }
+    )
+
+    return ds
+
+
+def runs_to_dataset(data_vars, runs, dim_coords, stream_ids):
+    # build a dataset in the compact layout, where only the combinations of the run dimensions that have data are stored
+    # data_vars maps each variable to an array of shape (run, stream_id), runs is an integer array with the position of
+    # each run along each of the run dimensions, and dim_coords maps each run dimension to its coordinate values
+    # the dataset has:
+    #   run_<dim>: the label of each run along each run dimension, e.g. run_model
+    #   run_index: the run of each combination of the run dimensions, or -1 if it has no data
+    #   available: 1 where a combination has data, so availability can be checked without reading any data
+    # e.g. ds.isel(run=int(ds.run_index.sel(landcover=0, model=3, scenario=1, era=2))) selects a run by label
+
+    run_dims = list(dim_coords.keys())
+    shape = tuple(len(values) for values in dim_coords.values())
+    run_index = np.full(shape, -1, dtype=np.int32)
+    run_index[tuple(runs.T)] = np.arange(len(runs), dtype=np.int32)
+
+    coords = {dim: ([dim], values) for dim, values in dim_coords.items()}
+    coords["run"] = (["run"], np.arange(len(runs), dtype=np.int32))
+    for i, dim in enumerate(run_dims):
+        coords[f"run_{dim}"] = (["run"], np.asarray(dim_coords[dim])[runs[:, i]])
+    coords["stream_id"] = (["stream_id"], stream_ids)
+    coords["run_index"] = (run_dims, run_index)
+    coords["available"] = (run_dims, (run_index >= 0).astype(np.int8))
+
+    return xr.Dataset({var: (["run", "stream_id"], values) for var, values in data_vars.items()}, coords=coords)
+
+
+def compact_dataset(ds):
+    # convert a dataset from the dense layout to the compact layout, keeping only the combinations with any data
+    # every dimension of the data variables except stream_id becomes a run dimension, e.g. a "source" dimension as well
+
+    data_vars = list(ds.data_vars)
+    run_dims = [dim for dim in ds[data_vars[0]].dims if dim != "stream_id"]
+
+    available = np.zeros(tuple(ds.sizes[dim] for dim in run_dims), dtype=bool)
+    for var in data_vars:
+        available |= ds[var].notnull().any("stream_id").transpose(*run_dims).values
+    runs = np.argwhere(available)
+
+    compact = runs_to_dataset(
+        {var: ds[var].transpose(*run_dims, "stream_id").values[tuple(runs.T)] for var in data_vars},
+        runs,
+        {dim: ds[dim].values for dim in run_dims},
+        ds["stream_id"].values,
+    )
+    for var in data_vars:
+        compact[var].attrs = ds[var].attrs
+    for dim in run_dims:
+        compact[dim].attrs = ds[dim].attrs
+        compact[f"run_{dim}"].attrs = ds[dim].attrs
+
+    return compact.assign_attrs(ds.attrs)
+
+
+def expand_runs(ds):
+    # convert a dataset from the compact layout back to the dense layout, with NaN for the combinations without data
+
+    run_dims = list(ds["run_index"].dims)
+    run_index = ds["run_index"].values
+    missing = run_index < 0
+    take = np.where(missing, 0, run_index)
+
+    data_vars = {}
+    for var in ds.data_vars:
+        values = ds[var].transpose("run", "stream_id").values[take]
+        values[missing] = np.nan
+        data_vars[var] = (run_dims + ["stream_id"], values, ds[var].attrs)
+
+    coords = {dim: ds[dim] for dim in run_dims + ["stream_id"]}
+
+    return xr.Dataset(data_vars, coords=coords, attrs=ds.attrs)
+
+
+def select_run(ds, **labels):
+    # select the run of a compact dataset by the labels of its run dimensions, e.g. select_run(ds, landcover=0, model=3, ...)
+    # returns None if there is no data for that combination
+
+    run = int(ds["run_index"].sel(labels))
+    if run < 0:
+        return None
+
+    return ds.isel(run=run)
+
+
+def build_dataset(dict, stream_ids, files, workers=1):
+    # build a float32 dataset with sorted dimensions directly from the CSVs
+    # this replaces create_empty_dataset(), populate_dataset(), sort_by_model_dimension() and convert_to_float32()
+    # but only ever holds one float32 copy of the data in memory
+
+    target = new_block_target(dict, stream_ids, stream_ids, files)
+    run_targets([target], workers=workers)
+
+    return finish_block_target(target)
+
+
+def get_metadata_template(coord_index, populate_metadata, runs=None):
+    # build a dataset with all the output dimensions, variables and metadata, but with zero stream_ids
+    # populate_metadata is either populate_encodings_metadata() or populate_diff_metadata()
+    # if runs is given, the template is in the compact layout
+
+    if runs is not None:
+        shape = (len(runs),)
+    else:
+        shape = tuple(len(coord_index[dim]) for dim in DIMS)
+    cube = np.empty((len(stat_vars_dict),) + shape + (0,), dtype=np.float32)
+    ds = stat_blocks_to_dataset(cube, coord_index, [], runs)
+
+    return populate_metadata(ds)
+
+
+def get_stat_encoding(sizes, layout="slab", chunk_streams=64, complevel=0):
+    # get the storage settings of the stat variables for one of LAYOUTS, given the output dimension sizes
+    # with complevel > 0, chunks are compressed with zlib and the shuffle filter
+    # the returned dict can be used both as an xarray to_netcdf() encoding and as netCDF4 createVariable() keyword arguments
+
+    # outputs in the compact layout have a single run dimension in place of DIMS
+    dims = ["run"] if "run" in sizes else DIMS
+    n_streams = max(sizes["stream_id"], 1)
+    if layout == "contiguous":
+        encoding = {"contiguous": True}
+    elif layout == "slab":
+        encoding = {"contiguous": False, "chunksizes": (1,) * len(dims) + (n_streams,)}
+    elif layout == "stream":
+        chunksizes = tuple(max(sizes[dim], 1) for dim in dims) + (min(chunk_streams, n_streams),)
+        encoding = {"contiguous": False, "chunksizes": chunksizes}
+    else:
+        raise ValueError(f"Unknown layout: {layout}; must be one of {LAYOUTS}")
+
+    if complevel > 0:
+        if layout == "contiguous":
+            raise ValueError("Compression requires a chunked layout")
+        encoding.update({"zlib": True, "complevel": complevel, "shuffle": True})
+
+    return encoding
+
+
+def create_stream_output(outfile, template, stream_ids, encoding=None):
+    # create a netCDF4 file with the full output structure and metadata, but no data yet
+    # stat variables are filled with NaN until written, and stored as in encoding (see get_stat_encoding())
+    # by default they are chunked by (landcover, model, scenario, era) slab (or run), so that each CSV is written to its own chunks
+
+    stat_vars = list(stat_vars_dict.keys())
+    sizes = dict(template.sizes)
+    sizes["stream_id"] = len(stream_ids)
+
+    # list non-dimension coordinates (e.g. run_model in the compact layout) in "coordinates" attributes, as xarray does,
+    # on the stat variables they share dimensions with, or globally otherwise
+    stat_dims = set(template[stat_vars[0]].dims)
+    extra_coords = [name for name in template.coords if name not in template.dims]
+    stat_coords = [name for name in extra_coords if set(template[name].dims) <= stat_dims]
+    global_coords = [name for name in extra_coords if name not in stat_coords]
+
+    nc = netCDF4.Dataset(outfile, "w", format="NETCDF4")
+    nc.setncatts(template.attrs)
+    if global_coords:
+        nc.setncattr("coordinates", " ".join(global_coords))
+
+    for dim, size in sizes.items():
+        nc.createDimension(dim, size)
+
+    # write the coordinates (and the run_index and available maps of the compact layout) from the template
+    for name, var in template.variables.items():
+        if name in stat_vars:
+            continue
+        if name == "stream_id":
+            coord = nc.createVariable("stream_id", "i4", ("stream_id",))
+            coord[:] = np.asarray(stream_ids, dtype=np.int32)
+            continue
+        fill_value = np.nan if var.dtype.kind == "f" else None
+        coord = nc.createVariable(name, var.dtype, var.dims, fill_value=fill_value)
+        coord.setncatts(var.attrs)
+        coord[:] = var.values
+
+    if encoding is None:
+        encoding = get_stat_encoding(sizes, "slab")
+    for stat in stat_vars:
+        var = nc.createVariable(stat, "f4", template[stat].dims, fill_value=np.nan, **encoding)
+        var.setncatts(template[stat].attrs)
+        if stat_coords:
+            var.setncattr("coordinates", " ".join(stat_coords))
+
+    return nc
+
+
+def copy_output_layout(infile, outfile, encoding, block_streams=4096):
+    # copy an output netCDF to a new file with the stat variables stored as in encoding (see get_stat_encoding())
+    # data is copied in blocks of stream_ids, writing every stat of a block before moving on to the next block,
+    # so that with a stream layout the chunks of all stats of the same stream_ids end up close together in the file
+
+    stat_vars = list(stat_vars_dict.keys())
+
+    src = netCDF4.Dataset(infile, "r")
+    src.set_auto_mask(False)
+    dst = netCDF4.Dataset(outfile, "w", format="NETCDF4")
+    dst.setncatts({k: src.getncattr(k) for k in src.ncattrs()})
+
+    for dim in src.dimensions:
+        dst.createDimension(dim, len(src.dimensions[dim]))
+
+    for name, var in src.variables.items():
+        if name in stat_vars:
+            continue
+        fill_value = var.getncattr("_FillValue") if "_FillValue" in var.ncattrs() else None
+        coord = dst.createVariable(name, var.dtype, var.dimensions, fill_value=fill_value)
+        coord.setncatts({k: var.getncattr(k) for k in var.ncattrs() if k != "_FillValue"})
+        coord[:] = var[:]
+
+    for stat in stat_vars:
+        var = dst.createVariable(stat, "f4", src[stat].dimensions, fill_value=np.nan, **encoding)
+        var.setncatts({k: src[stat].getncattr(k) for k in src[stat].ncattrs() if k != "_FillValue"})
+
+    # copy whole chunks at a time
+    if "chunksizes" in encoding:
+        chunk_streams = encoding["chunksizes"][-1]
+        block_streams = max(block_streams // chunk_streams, 1) * chunk_streams
+
+    n_streams = len(src.dimensions["stream_id"])
+    for start in range(0, n_streams, block_streams):
+        end = min(start + block_streams, n_streams)
+        for stat in stat_vars:
+            dst[stat][..., start:end] = src[stat][..., start:end]
+
+    src.close()
+    dst.close()
+
+    return
+
+
+def set_output_layout(outfile, encoding):
+    # rewrite an output netCDF in place with the stat variables stored as in encoding
+
+    tmpfile = f"{outfile}.tmp"
+    copy_output_layout(outfile, tmpfile, encoding)
+    os.replace(tmpfile, outfile)
+
+    return
+
+
+def get_output_stats(nc):
+    # names of the stat variables of an output netCDF: the float variables along stream_id that aren't coordinates
+    # (the stats of stat_vars_dict, plus e.g. ma99 in the combined outputs)
+
+    return [
+        name
+        for name, var in nc.variables.items()
+        if var.dimensions[-1:] == ("stream_id",)
+        and name not in nc.dimensions
+        and (var.dtype.kind == "f" or "scale_factor" in var.ncattrs())
+    ]
+
+
+def get_var_encoding(var):
+    # get the storage settings of a netCDF4 variable as createVariable() keyword arguments, to keep them when rewriting it
+
+    chunking = var.chunking()
+    if chunking == "contiguous":
+        return {"contiguous": True}
+
+    encoding = {"contiguous": False, "chunksizes": tuple(chunking)}
+    filters = var.filters() or {}
+    if filters.get("zlib"):
+        encoding.update({"zlib": True, "complevel": filters["complevel"], "shuffle": filters["shuffle"]})
+
+    return encoding
+
+
+def get_output_storage(nc):
+    # get the layout and complevel (and chunk_streams for the stream layout) that the stats of an output netCDF
+    # were written with, as in the storage settings of build_nc.py (see get_stat_encoding())
+
+    var = nc[get_output_stats(nc)[0]]
+    chunking = var.chunking()
+    if chunking == "contiguous":
+        return {"layout": "contiguous", "complevel": 0}
+
+    filters = var.filters() or {}
+    complevel = filters["complevel"] if filters.get("zlib") else 0
+    if all(size == 1 for size in chunking[:-1]) and chunking[-1] == max(nc.dimensions["stream_id"].size, 1):
+        return {"layout": "slab", "complevel": complevel}
+
+    return {"layout": "stream", "chunk_streams": chunking[-1], "complevel": complevel}
+
+
+def set_auto_unpack(nc):
+    # read the stats of an output netCDF as stored, without masked arrays, except for packed stats (see pack_output()),
+    # whose fill values have to be masked to be read as NaN by read_values()
+
+    nc.set_auto_mask(False)
+    for var in nc.variables.values():
+        if "scale_factor" in var.ncattrs():
+            var.set_auto_mask(True)
+
+    return
+
+
+def read_values(var, index=slice(None)):
+    # read a stat variable of a netCDF opened with set_auto_unpack(), with NaN for missing values whether it is packed or not
+
+    values = var[index]
+    if np.ma.isMaskedArray(values):
+        values = values.astype(np.float32).filled(np.nan)
+
+    return values
+
+
+def get_stat_ranges(nc, stats, block_streams=4096):
+    # streaming pass over the stats of an output netCDF, in blocks of stream_ids
+    # returns a dict of {stat: (min, max)} of the finite values of each stat, with NaN for stats without any
+
+    ranges = {stat: (np.inf, -np.inf) for stat in stats}
+    n_streams = len(nc.dimensions["stream_id"])
+    for start in range(0, n_streams, block_streams):
+        end = min(start + block_streams, n_streams)
+        for stat in stats:
+            values = read_values(nc[stat], (Ellipsis, slice(start, end)))
+            values = values[np.isfinite(values)]
+            if values.size:
+                low, high = ranges[stat]
+                ranges[stat] = (min(low, values.min()), max(high, values.max()))
+
+    return {stat: (low, high) if low <= high else (np.nan, np.nan) for stat, (low, high) in ranges.items()}
+
+
+def get_packing(packing, var_min, var_max, keepbits=None):
+    # get the storage of one stat for one of PACKINGS, given the range of its values from get_stat_ranges()
+    # int16 / int8 values are mapped linearly onto the integers above the lowest one, which is kept as the _FillValue,
+    # rounding to the nearest step, so the absolute reconstruction error is at most scale_factor / 2
+
+    if packing == "bitround":
+        if keepbits is None or not 0 <= keepbits <= 23:
+            raise ValueError("bitround packing needs a number of mantissa bits to keep between 0 and 23")
+        return {"dtype": np.dtype("f4"), "fill_value": np.float32(np.nan), "keepbits": keepbits}
+    if packing not in PACKINGS:
+        raise ValueError(f"Unknown packing: {packing}; must be one of {PACKINGS}")
+
+    dtype = np.dtype(packing)
+    info = np.iinfo(dtype)
+    if np.isnan(var_min):
+        var_min, var_max = 0.0, 0.0
+    # steps between the first and last usable integer, info.min + 1 and info.max
+    steps = int(info.max) - int(info.min) - 1
+    scale_factor = (float(var_max) - float(var_min)) / steps if var_max > var_min else 1.0
+    add_offset = float(var_min) - (int(info.min) + 1) * scale_factor
+
+    return {
+        "dtype": dtype,
+        "fill_value": dtype.type(info.min),
+        "scale_factor": np.float32(scale_factor),
+        "add_offset": np.float32(add_offset),
+    }
+
+
+def bitround(values, keepbits):
+    # round float32 values to keepbits bits of mantissa (round to nearest, ties to even), leaving NaN and inf as they are
+    # the zeroed trailing bits compress much better, and the relative error is at most 2 ** -(keepbits + 1)
+
+    values = np.asarray(values, dtype=np.float32)
+    dropbits = 23 - keepbits
+    if dropbits == 0:
+        return values.copy()
+
+    bits = values.view(np.uint32)
+    mask = np.uint32((0xFFFFFFFF >> dropbits) << dropbits)
+    half = np.uint32((1 << (dropbits - 1)) - 1)
+    rounded = ((bits + ((bits >> np.uint32(dropbits)) & np.uint32(1)) + half) & mask).view(np.float32)
+
+    return np.where(np.isfinite(values), rounded, values)
+
+
+def pack_values(values, packing):
+    # pack float values with a storage from get_packing(); non-finite values are stored as the fill value
+
+    if "keepbits" in packing:
+        return bitround(values, packing["keepbits"])
+
+    info = np.iinfo(packing["dtype"])
+    values = np.asarray(values, dtype=np.float64)
+    finite = np.isfinite(values)
+    steps = np.rint((np.where(finite, values, 0) - packing["add_offset"]) / packing["scale_factor"])
+    packed = np.clip(steps, info.min + 1, info.max).astype(packing["dtype"])
+    packed[~finite] = packing["fill_value"]
+
+    return packed
+
+
+def unpack_values(packed, packing):
+    # unpack values packed by pack_values() to float32, as netCDF4 and xarray do when reading them
+
+    if "keepbits" in packing:
+        return packed
+
+    unpacked = packed.astype(np.float32) * packing["scale_factor"] + packing["add_offset"]
+    unpacked[packed == packing["fill_value"]] = np.nan
+
+    return unpacked
+
+
+def get_packing_errors(values, unpacked):
+    # maximum absolute and relative reconstruction errors of a block of packed values,
+    # and the number of values that aren't reconstructed at all (e.g. inf, which integer packings store as missing)
+
+    finite = np.isfinite(values)
+    lost = int((finite & ~np.isfinite(unpacked)).sum() + (np.isinf(values) & (unpacked != values)).sum())
+    kept = finite & np.isfinite(unpacked)
+    error = np.abs(unpacked[kept].astype(np.float64) - values[kept])
+    nonzero = values[kept] != 0
+    relative = error[nonzero] / np.abs(values[kept][nonzero].astype(np.float64))
+
+    return (
+        error.max() if error.size else 0.0,
+        relative.max() if relative.size else 0.0,
+        lost,
+    )
+
+
+def pack_output(infile, outfile, packing, keepbits=None, block_streams=4096):
+    # copy an output netCDF to a new file with its stats stored with one of PACKINGS, keeping their chunking and compression
+    # the range of each stat is found in a first streaming pass, and the packed values are written in a second one,
+    # comparing each block with its reconstruction
+    # returns a report with the storage and the maximum absolute and relative reconstruction errors of each stat
+
+    src = netCDF4.Dataset(infile, "r")
+    set_auto_unpack(src)
+    stats = get_output_stats(src)
+    if any(attr in src[stat].ncattrs() for stat in stats for attr in ["scale_factor", "keepbits"]):
+        src.close()
+        raise ValueError(f"{infile} is already packed")
+
+    ranges = get_stat_ranges(src, stats, block_streams)
+    packings = {stat: get_packing(packing, *ranges[stat], keepbits) for stat in stats}
+
+    dst = netCDF4.Dataset(outfile, "w", format="NETCDF4")
+    dst.setncatts({k: src.getncattr(k) for k in src.ncattrs()})
+    for dim in src.dimensions:
+        dst.createDimension(dim, len(src.dimensions[dim]))
+
+    for name, var in src.variables.items():
+        if name in stats:
+            continue
+        fill_value = var.getncattr("_FillValue") if "_FillValue" in var.ncattrs() else None
+        coord = dst.createVariable(name, var.dtype, var.dimensions, fill_value=fill_value)
+        coord.setncatts({k: var.getncattr(k) for k in var.ncattrs() if k != "_FillValue"})
+        coord[:] = var[:]
+
+    for stat in stats:
+        storage = packings[stat]
+        var = dst.createVariable(
+            stat, storage["dtype"], src[stat].dimensions, fill_value=storage["fill_value"], **get_var_encoding(src[stat])
+        )
+        var.setncatts({k: src[stat].getncattr(k) for k in src[stat].ncattrs() if k != "_FillValue"})
+        var.setncatts({k: storage[k] for k in ["scale_factor", "add_offset", "keepbits"] if k in storage})
+        # the values are packed here, so that missing values are written as the fill value
+        var.set_auto_maskandscale(False)
+
+    errors = {stat: (0.0, 0.0, 0) for stat in stats}
+    n_streams = len(src.dimensions["stream_id"])
+    for start in range(0, n_streams, block_streams):
+        end = min(start + block_streams, n_streams)
+        for stat in stats:
+            values = read_values(src[stat], (Ellipsis, slice(start, end)))
+            packed = pack_values(values, packings[stat])
+            dst[stat][..., start:end] = packed
+            block_errors = get_packing_errors(values, unpack_values(packed, packings[stat]))
+            errors[stat] = (
+                max(errors[stat][0], block_errors[0]),
+                max(errors[stat][1], block_errors[1]),
+                errors[stat][2] + block_errors[2],
+            )
+
+    rows = []
+    for stat in stats:
+        storage = packings[stat]
+        rows.append(
+            {
+                "stat": stat,
+                "packing": packing,
+                "dtype": storage["dtype"].name,
+                "keepbits": storage.get("keepbits"),
+                "scale_factor": storage.get("scale_factor"),
+                "add_offset": storage.get("add_offset"),
+                "min": ranges[stat][0],
+                "max": ranges[stat][1],
+                "max_abs_error": errors[stat][0],
+                "max_rel_error": errors[stat][1],
+                "lost": errors[stat][2],
+            }
+        )
+        dst[stat].setncatts({"max_abs_error": errors[stat][0], "max_rel_error": errors[stat][1]})
+
+    src.close()
+    dst.close()
+
+    return pd.DataFrame(rows)
+
+
+def set_output_packing(outfile, packing, keepbits=None):
+    # rewrite an output netCDF in place with its stats packed (see pack_output()),
+    # and write the reconstruction errors of each stat next to it, e.g. seg_packing.csv next to seg.nc
+
+    tmpfile = f"{outfile}.tmp"
+    report = pack_output(outfile, tmpfile, packing, keepbits)
+    os.replace(tmpfile, outfile)
+    report_path = f"{os.path.splitext(outfile)[0]}_packing.csv"
+    report.to_csv(report_path, index=False)
+
+    worst = report.loc[report["max_rel_error"].idxmax()] if len(report) else None
+    if worst is not None:
+        print(
+            f"Packed the stats of {outfile} as {packing}; the largest relative reconstruction error is "
+            f"{worst['max_rel_error']:.3g} ({worst['stat']}); see {report_path}\n"
+        )
+
+    return report
+
+
+def netcdf_target(nc, coord_index, csv_ids, files, runs=None):
+    # create a build target that writes each CSV into an open netCDF4 dataset
+    # csv_ids are the geometry IDs of the dataset's stream_ids as they appear in the CSVs
+    # if runs is given, the dataset is in the compact layout and each CSV is written to its run
+
+    stat_vars = list(stat_vars_dict.keys())
+    run_index = None if runs is None else {positions: i for i, positions in enumerate(runs)}
+
+    def write(positions, values):
+        index = positions if run_index is None else (run_index[positions],)
+        for i, stat in enumerate(stat_vars):
+            nc[stat][index + (slice(None),)] = values[i]
+
+    target = {
+        "files": files,
+        "coord_index": coord_index,
+        "id_index": get_id_index(csv_ids),
+        "nc": nc,
+        "write": write,
+    }
+    if runs is not None:
+        target["runs"] = runs
+
+    return target
+
+
+def new_stream_target(outfile, dict, csv_ids, stream_ids, files, populate_metadata, compact=False):
+    # create a build target that writes each CSV straight to a new netCDF on disk
+    # csv_ids are the geometry IDs of the output as they appear in the CSVs, and stream_ids the output stream_id coordinate
+    # with compact=True, the output is in the compact layout (see runs_to_dataset())
+
+    coord_index = get_coord_index(dict)
+    runs = get_runs(files, coord_index) if compact else None
+    template = get_metadata_template(coord_index, populate_metadata, runs)
+    nc = create_stream_output(outfile, template, stream_ids)
+
+    return netcdf_target(nc, coord_index, csv_ids, files, runs)
+
+
+def finish_stream_target(target):
+    # close the netCDF of a streaming build target
+
+    target["nc"].close()
+
+    return
+
+
+def stream_dataset(outfile, dict, csv_ids, stream_ids, files, populate_metadata, workers=1):
+    # build the output netCDF on disk without ever holding the full dataset in memory
+    # each CSV is read, its rows are written to its (landcover, model, scenario, era) slab, and then it is freed
+
+    target = new_stream_target(outfile, dict, csv_ids, stream_ids, files, populate_metadata)
+    try:
+        run_targets([target], workers=workers)
+    finally:
+        finish_stream_target(target)
+
+    return
+
+
 def populate_encodings_metadata(ds):
     # for each dimension, add the encoding lookup dict from reverse_encodings_lookup
     # e.g., for "model", add reverse_encodings_lookup["model"] as metadata under the "encodings" attribute for that dimension
@@ -213,6 +1155,9 @@ def populate_encodings_metadata(ds):
     # NOTE: era names were hyphenated in the metadata for consistency; see luts.py for details
     for dim in ["landcover", "model", "scenario", "era"]:
         ds[dim].attrs["encoding"] = str(reverse_encodings_lookup[dim])
+        # datasets in the compact layout also label each run
+        if f"run_{dim}" in ds:
+            ds[f"run_{dim}"].attrs["encoding"] = str(reverse_encodings_lookup[dim])
 
     # for each variable, add the statistic metadata from stat_vars_dict
     for var in stat_vars_dict.keys():
@@ -224,6 +1169,8 @@ def populate_encodings_metadata(ds):
 def populate_diff_metadata(ds):
     for dim in ["landcover", "model", "scenario", "era"]:
         ds[dim].attrs["encoding"] = str(reverse_encodings_lookup[dim])
+        if f"run_{dim}" in ds:
+            ds[f"run_{dim}"].attrs["encoding"] = str(reverse_encodings_lookup[dim])
 
     for var in stat_vars_dict.keys():
         method = stat_vars_dict[var]["difference_method"]
@@ -259,19 +1206,36 @@ def convert_to_float32(ds):
     return ds
 
 
-def crosswalk_hrus(ds, df):
-    xwalk_dict = {k: v for k, v in zip(df["hru_id"], df["hru_id_nat"])}
-    new_ids = [xwalk_dict.get(k) for k in ds["stream_id"].values.tolist()]
-    ds["stream_id"] = new_ids
-    return ds
+def crosswalk_ids(stream_ids, df):
+    # map HRU IDs to their national HRU IDs using the crosswalk table; IDs missing from the crosswalk become -1
+
+    xwalk = pd.Series(df["hru_id_nat"].values, index=df["hru_id"].values)
+    new_ids = pd.Series(stream_ids).map(xwalk).fillna(-1)
+
+    return new_ids.to_numpy(dtype=np.int64)
+
+
+def get_clip_rows(stream_ids, shp_ids):
+    # get the positions of the stream_ids that are in the geometry IDs of the shapefile, in their original order
+    # shp_ids is the sorted array of shapefile IDs from geometry_ids.load_geometry_ids()
+
+    stream_ids = np.asarray(stream_ids, dtype=np.int64)
+    if len(shp_ids) == 0:
+        return np.array([], dtype=np.int64)
+
+    idx = np.searchsorted(shp_ids, stream_ids)
+    idx[idx == len(shp_ids)] = 0
+
+    return np.flatnonzero(shp_ids[idx] == stream_ids)
+
 
+def get_output_ids(csv_ids, shp_ids, type, hru_xwalk):
+    # crosswalk (for HRUs) and clip the geometry IDs read from a CSV to the sorted shapefile IDs
+    # returns the kept IDs as they appear in the CSVs, and the matching output stream_ids
+    # this is done before any data is read, so rows outside the shapefile are never stored
 
-def clip_dataset(ds, shp, type):
-    # clip the dataset to the actual data extent using geometry IDs
+    csv_ids = np.asarray(csv_ids, dtype=np.int64)
+    stream_ids = crosswalk_ids(csv_ids, hru_xwalk) if type == "hru" else csv_ids
+    rows = get_clip_rows(stream_ids, shp_ids)
 
-    if type == "seg":
-        ds = ds.sel(stream_id=ds.stream_id.isin(shp.seg_id_nat.astype(str).tolist()))
-        return ds
-    elif type == "hru":
-        ds = ds.sel(stream_id=ds.stream_id.isin(shp.hru_id_nat.astype(str).tolist()))
-        return ds
\ No newline at end of file
+    return csv_ids[rows], stream_ids[rows]
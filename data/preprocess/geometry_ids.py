@@ -0,0 +1,50 @@
+# functions to read the geometry IDs of the seg and hru shapefiles, which are all build_nc.py needs from them
+# only the ID column of the attribute table is read (no geometries), and the sorted IDs are cached as .npy files,
+# keyed by the hash of the attribute table, so later builds can memory-map them instead of reading the shapefile again
+
+import os
+import numpy as np
+import geopandas as gpd
+from manifest import hash_file
+
+
+def get_id_cache_path(shp_path, id_col, cache_dir):
+    # path of the cached IDs of a shapefile, e.g. <cache_dir>/Segments_subset_seg_id_nat_<hash>.npy
+    # the hash is of the .dbf attribute table, where the IDs are stored, so the cache is invalidated whenever it changes
+
+    root, _ = os.path.splitext(shp_path)
+    digest = hash_file(f"{root}.dbf")[:16]
+
+    return os.path.join(cache_dir, f"{os.path.basename(root)}_{id_col}_{digest}.npy")
+
+
+def read_shapefile_ids(shp_path, id_col):
+    # read the IDs in id_col of a shapefile, without reading the geometries or any other columns
+    # returns a sorted int64 array of the unique IDs
+
+    df = gpd.read_file(shp_path, columns=[id_col], ignore_geometry=True)
+
+    return np.unique(df[id_col].to_numpy(dtype=np.int64))
+
+
+def load_geometry_ids(shp_path, id_col, cache_dir=None):
+    # get the sorted unique IDs in id_col of a shapefile, from the cache if possible
+    # if cache_dir is None, the IDs are read from the shapefile every time
+
+    if cache_dir is None:
+        return read_shapefile_ids(shp_path, id_col)
+
+    cache_path = get_id_cache_path(shp_path, id_col, cache_dir)
+    if os.path.exists(cache_path):
+        print(f"Loading cached {id_col} IDs from {cache_path}...\n")
+        return np.load(cache_path, mmap_mode="r")
+
+    print(f"Reading {id_col} IDs from {shp_path} and caching them to {cache_path}...\n")
+    ids = read_shapefile_ids(shp_path, id_col)
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary file first, so that an interrupted build never leaves a partial cache
+    tmp_path = f"{cache_path}.tmp.npy"
+    np.save(tmp_path, ids)
+    os.replace(tmp_path, cache_path)
+
+    return ids
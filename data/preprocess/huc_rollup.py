@@ -0,0 +1,155 @@
+# script to build a HUC8-indexed stats cube from the segment stats, using the outlet segment of each HUC8
+# the outlets come from seg_h8_outlets.shp (made by shp/find_huc_outlets.ipynb), where h8_outlet flags the outlet
+# segments and huc8 is the HUC8 of each segment. As in shp/merge_huc8_with_stats.ipynb, HUC8s with several outlets
+# use the one with the highest Maurer historical ma99 (static landcover), which is most likely the main stem
+# (ma99 is computed from the monthly flow variables for the outputs that do not store it, and outputs without the
+# Maurer historical baseline, like seg_diff.nc, use the first outlet of each HUC8 in the shapefile)
+# the outlet of each HUC8 is looked up once as an index array into the stream_ids, and every stat, source, landcover,
+# model, scenario and era is then gathered at those positions, so the output has the same dimensions as the input,
+# with huc8 in place of stream_id (and a source dimension for every input, of length 1 for seg.nc and seg_diff.nc)
+
+import argparse
+import sys
+import os
+import numpy as np
+import xarray as xr
+import netCDF4
+import geopandas as gpd
+from functions import DIMS, PACKING_ATTRS, set_auto_unpack, get_output_stats, get_id_positions
+from luts import *
+from virtual_source import CombinedReader
+from seg_correct_and_combine import SOURCE_ENCODING, MONTHLY_VARS, BASELINE, get_positions, mean_monthly_block
+from parquet_export import get_sources, read_block
+
+
+def arguments(argv):
+    """Parse some args"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nc", type=str, help="segment stats netCDF, e.g. seg_combined.nc or seg.nc", required=True)
+    parser.add_argument("--outlets_shp", type=str, help="segments with HUC8 outlet flags, e.g. seg_h8_outlets.shp", required=True)
+    parser.add_argument("--output", type=str, help="path of the HUC8 netCDF to write, e.g. huc8_combined.nc", required=True)
+    parser.add_argument("--id_col", type=str, default="seg_id_nat", help="segment ID column of --outlets_shp")
+    parser.add_argument("--flag_col", type=str, default="h8_outlet", help="outlet flag column of --outlets_shp")
+    parser.add_argument("--zone_col", type=str, default="huc8", help="HUC8 column of --outlets_shp")
+    parser.add_argument(
+        "--rank_var",
+        type=str,
+        default="ma99",
+        help="stat used to choose between several outlets of a HUC8 (highest Maurer historical value wins), "
+        "ma99 is computed from ma12-ma23 if the netCDF does not store it",
+    )
+
+    args = parser.parse_args()
+
+    return args.nc, args.outlets_shp, args.output, args.id_col, args.flag_col, args.zone_col, args.rank_var
+
+
+def read_outlets(outlets_shp, id_col, flag_col, zone_col):
+    # read the outlet segments of each HUC8 from the attribute table of the outlets shapefile
+    # returns a DataFrame with the id_col and zone_col of each outlet
+
+    segments = gpd.read_file(outlets_shp, columns=[id_col, flag_col, zone_col], ignore_geometry=True)
+    outlets = segments[segments[flag_col].fillna(0).astype(bool)]
+    outlets = outlets.dropna(subset=[zone_col])
+
+    return outlets[[id_col, zone_col]].astype({id_col: np.int64, zone_col: str}).reset_index(drop=True)
+
+
+def get_rank_values(nc, reader, rank_var, positions):
+    # get the Maurer historical baseline values of rank_var (static landcover) at the stream positions
+    # returns None if the baseline is not in the coordinates of nc (e.g. seg_diff.nc)
+
+    labels = {"landcover": "static", **BASELINE}
+    index = tuple(get_positions([encodings_lookup[dim][labels[dim]]], nc[dim][:].tolist())[0] for dim in DIMS)
+    if min(index) < 0:
+        return None
+
+    if rank_var in nc.variables:
+        values = read_block(nc, reader, rank_var, "original_gcm", positions)
+    else:
+        # ma99 of the outputs that do not store it, as in seg_correct_and_combine.py
+        values = mean_monthly_block([read_block(nc, reader, var, "original_gcm", positions) for var in MONTHLY_VARS])
+
+    return values[index]
+
+
+def get_outlet_index(nc, reader, outlets, id_col, zone_col, rank_var):
+    # get the outlet of each HUC8 as a position in the stream_ids of nc
+    # outlets that are not in nc are skipped, and HUC8s with several outlets use the one with the highest rank_var
+    # returns the sorted HUC8 IDs and the stream position of the outlet of each
+
+    positions = get_id_positions(nc["stream_id"][:], outlets[id_col].to_numpy())
+    found = positions >= 0
+    outlets = outlets[found].assign(position=positions[found])
+    if len(outlets) == 0:
+        return np.array([], dtype=str), np.array([], dtype=int)
+
+    unique = np.unique(outlets["position"])
+    rank = get_rank_values(nc, reader, rank_var, unique)
+    if rank is None:
+        print(f"Warning: the Maurer historical baseline is not in the netCDF, using the first outlet of each {zone_col}.")
+        rank = np.full(len(unique), np.nan)
+    outlets = outlets.assign(rank=outlets["position"].map(dict(zip(unique, rank))))
+
+    # NaN ranks sort last, so an outlet with data is always preferred, and ties keep the order of the shapefile
+    outlets = outlets.sort_values("rank", ascending=False, na_position="last", kind="stable").drop_duplicates(zone_col)
+    outlets = outlets.sort_values(zone_col)
+
+    return outlets[zone_col].to_numpy(dtype=str), outlets["position"].to_numpy()
+
+
+def rollup_outlets(nc_path, outlets, id_col="seg_id_nat", zone_col="huc8", rank_var="ma99"):
+    # gather every stat of nc_path at the outlet of each HUC8
+    # returns a dataset with dims (source, landcover, model, scenario, era, huc8)
+
+    name = os.path.splitext(os.path.basename(nc_path))[0]
+    nc = netCDF4.Dataset(nc_path, "r")
+    set_auto_unpack(nc)
+    # keep the derived monthly variables cached for the derived ma99
+    reader = CombinedReader(nc_path, cache_size=len(MONTHLY_VARS) + 1) if "source" in nc.dimensions else None
+    if rank_var not in nc.variables and not (rank_var == "ma99" and all(var in nc.variables for var in MONTHLY_VARS)):
+        print(f"Error: {rank_var} is not in {nc_path}, choose another --rank_var.")
+        sys.exit(1)
+
+    zone_ids, positions = get_outlet_index(nc, reader, outlets, id_col, zone_col, rank_var)
+    # the gather reads increasing positions, and the values are then put back in HUC8 order
+    unique, inverse = np.unique(positions, return_inverse=True)
+
+    sources = get_sources(nc, name)
+    stats = get_output_stats(nc)
+    dims = ["source"] + DIMS + [zone_col]
+    data_vars = {}
+    for stat in stats:
+        values = np.stack([read_block(nc, reader, stat, source, unique)[..., inverse] for source in sources])
+        attrs = {k: nc[stat].getncattr(k) for k in nc[stat].ncattrs() if k not in ["_FillValue"] + PACKING_ATTRS}
+        data_vars[stat] = (dims, values, attrs)
+
+    source_codes = {v: k for k, v in SOURCE_ENCODING.items()}
+    coords = {
+        "source": ("source", np.array([source_codes[source] for source in sources], dtype=np.float32)),
+        zone_col: (zone_col, zone_ids),
+        "outlet_stream_id": (zone_col, nc["stream_id"][positions]),
+    }
+    for dim in DIMS:
+        coords[dim] = (dim, nc[dim][:], {k: nc[dim].getncattr(k) for k in nc[dim].ncattrs() if k != "_FillValue"})
+    attrs = {k: nc.getncattr(k) for k in nc.ncattrs() if k not in ["derived_sources", "coordinates"]}
+
+    ds = xr.Dataset(data_vars, coords=coords, attrs=attrs)
+    ds["source"].attrs["encoding"] = str(SOURCE_ENCODING)
+
+    if reader is not None:
+        reader.close()
+    nc.close()
+
+    return ds
+
+
+if __name__ == "__main__":
+
+    nc_path, outlets_shp, outfile, id_col, flag_col, zone_col, rank_var = arguments(sys.argv)
+
+    outlets = read_outlets(outlets_shp, id_col, flag_col, zone_col)
+    print(f"Gathering the stats of {nc_path} at {len(outlets)} outlet segments...\n")
+    ds = rollup_outlets(nc_path, outlets, id_col, zone_col, rank_var)
+    ds.to_netcdf(outfile)
+    print(f"Wrote {len(ds[zone_col])} {zone_col}s to {outfile}.\n")
@@ -0,0 +1,185 @@
+# reader for the netCDF cubes of the pipeline (seg.nc, hru.nc, the *_diff.nc outputs in the dense or compact layout,
+# the combined outputs of seg_correct_and_combine.py and the daily climatologies of data/hydrograph_preprocessing)
+# that selects by label instead of by encoded coordinate value
+# the "encoding" attribute of each dimension (e.g. "{0: 'dynamic', 1: 'static'}") is parsed once with ast.literal_eval,
+# which only accepts Python literals (unlike eval(), it never runs code from the file),
+# and the positions of labels are cached, so a selection is a single isel() instead of .sel() lookups on float coordinates
+# labels are the names in the encodings, matched case-insensitively and with eras as either 2046-2075 or 2046_2075;
+# encoded values (e.g. model=3) and plain coordinate values (e.g. stream_id, doy) can be used too
+#
+# example:
+#     with HydroCube("seg.nc") as cube:
+#         da = cube.select("dh1", model=["CCSM4", "MIROC5"], scenario="rcp85", era="2046-2075", stream_id=stream_ids)
+# a scalar label drops its dimension, and a list or array of labels keeps it in the order given
+# in the compact layout the runs are expanded, with NaN for combinations without a run, so results look the same
+# the derived sources of a virtual combined output are not stored, so read those with virtual_source.CombinedReader
+
+import ast
+import numbers
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+def parse_encoding(encoding):
+    # parse an "encoding" attribute into a dict of {code: label}
+
+    parsed = ast.literal_eval(encoding) if isinstance(encoding, str) else encoding
+    if not isinstance(parsed, dict):
+        raise ValueError(f"Not an encoding: {encoding}")
+
+    return {int(code): label for code, label in parsed.items()}
+
+
+def normalize_label(label):
+    # normalize a label for matching, e.g. "2046_2075" -> "2046-2075", "MIROC-ESM" -> "miroc-esm"
+
+    return str(label).lower().replace("_", "-")
+
+
+class HydroCube:
+    # lazily opened stats or climatology cube, with cached label lookups
+
+    def __init__(self, path, **kwargs):
+        # kwargs are passed on to xr.open_dataset(), e.g. chunks={} to use dask
+        self.path = path
+        self.ds = xr.open_dataset(path, **kwargs)
+        self.compact = "run_index" in self.ds
+        self.encodings = {
+            dim: parse_encoding(self.ds[dim].attrs["encoding"])
+            for dim in self.ds.dims
+            if dim in self.ds.coords and "encoding" in self.ds[dim].attrs
+        }
+        self.run_index = self.ds["run_index"].values if self.compact else None
+
+        self.get_lookup = lru_cache(maxsize=None)(self._get_lookup)
+        self.get_index = lru_cache(maxsize=None)(self._get_index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.get_lookup.cache_clear()
+        self.get_index.cache_clear()
+        self.ds.close()
+
+    @property
+    def variables(self):
+        # names of the data variables, e.g. the stats or doy_min / doy_mean / doy_max
+
+        return list(self.ds.data_vars)
+
+    def labels(self, dim):
+        # decoded labels along a dimension, in file order
+
+        values = self.ds[dim].values
+        if dim in self.encodings:
+            return [self.encodings[dim][int(value)] for value in values]
+
+        return values.tolist()
+
+    def _get_lookup(self, dim):
+        # dict of {label: position} for a labelled dimension, with the normalized labels and the coordinate values
+
+        lookup = {}
+        for position, (value, label) in enumerate(zip(self.ds[dim].values.tolist(), self.labels(dim))):
+            lookup[value] = position
+            lookup[normalize_label(label)] = position
+
+        return lookup
+
+    def _get_index(self, dim):
+        # pandas index of the coordinate values of an unlabelled dimension, for vectorized lookups
+
+        return pd.Index(self.ds[dim].values)
+
+    def positions(self, dim, labels):
+        # positions of one or more labels along a dimension, as an array of ints
+        # raises KeyError for labels that aren't in the file
+
+        if dim not in self.ds.dims:
+            raise KeyError(f"{dim} is not a dimension of {self.path}")
+
+        if dim in self.encodings or self.ds[dim].dtype.kind in "OUS":
+            # labelled dimensions are short, e.g. model or era
+            labels = list(labels) if isinstance(labels, (list, tuple)) else np.atleast_1d(labels).tolist()
+            lookup = self.get_lookup(dim)
+            # numpy scalars (e.g. np.int64 or np.float32 coordinate values) are numbers too
+            keys = [label if isinstance(label, numbers.Number) else normalize_label(label) for label in labels]
+            missing = [label for label, key in zip(labels, keys) if key not in lookup]
+            positions = np.array([lookup.get(key, -1) for key in keys], dtype=int)
+        else:
+            labels = np.atleast_1d(labels)
+            positions = self.get_index(dim).get_indexer(labels)
+            missing = labels[positions < 0].tolist()
+
+        if missing:
+            hint = ""
+            if dim == "source" and "derived_sources" in self.ds.attrs:
+                hint = " (derived sources are computed on read, see virtual_source.CombinedReader)"
+            raise KeyError(f"No {dim} {missing[:10]} in {self.path}{hint}")
+
+        return positions
+
+    def get_indexers(self, labels):
+        # isel() indexers for a dict of {dim: label(s)}: an int for a scalar label, which drops the dimension,
+        # or an array of ints for a list or array of labels
+
+        indexers = {}
+        for dim, label in labels.items():
+            positions = self.positions(dim, label)
+            indexers[dim] = int(positions[0]) if np.ndim(label) == 0 else positions
+
+        return indexers
+
+    def expand_runs(self, ds, indexers):
+        # select the runs of the (landcover, model, scenario, era) combinations of the indexers in a compact dataset,
+        # so the result has the same dimensions as a dense dataset
+
+        run_dims = self.ds["run_index"].dims
+        runs = self.run_index
+        kept = []
+        for dim in run_dims:
+            indexer = indexers.get(dim, slice(None))
+            runs = runs[(slice(None),) * len(kept) + (indexer,)]
+            if not isinstance(indexer, int):
+                kept.append(dim)
+
+        ds = ds.drop_vars([var for var in ds.coords if var.startswith("run_") or var == "available"])
+        ds = ds.isel(run=xr.DataArray(np.where(runs < 0, 0, runs), dims=kept)).drop_vars("run")
+        # combinations without a run have no data
+        ds = ds.where(xr.DataArray(runs >= 0, dims=kept))
+
+        return ds.assign_coords({dim: self.ds[dim][indexers.get(dim, slice(None))] for dim in run_dims})
+
+    def select(self, variables=None, **labels):
+        # select one variable (returns a DataArray), a list of variables or all of them (returns a Dataset)
+        # by the labels of any of the dimensions, e.g. select("dh1", model=["CCSM4"], scenario="rcp85", stream_id=ids)
+
+        ds = self.ds[self.variables if variables is None else variables]
+        if isinstance(variables, str):
+            ds = ds.to_dataset()
+        indexers = self.get_indexers(labels)
+        if self.compact:
+            run_indexers = {dim: indexers.pop(dim) for dim in self.ds["run_index"].dims if dim in indexers}
+            ds = self.expand_runs(ds.isel(indexers), run_indexers)
+        else:
+            ds = ds.isel(indexers)
+
+        return ds[variables] if isinstance(variables, str) else ds
+
+    def decode(self, obj):
+        # replace the encoded coordinates of a selection with their labels, e.g. for plotting or tables
+
+        coords = {}
+        for dim, encoding in self.encodings.items():
+            if dim in obj.coords:
+                values = obj[dim].values
+                labels = [encoding[int(value)] for value in np.atleast_1d(values)]
+                coords[dim] = (obj[dim].dims, np.array(labels if values.ndim else labels[0], dtype=object))
+
+        return obj.assign_coords(coords)
@@ -0,0 +1,172 @@
+# functions to incrementally update the stats netCDFs built by build_nc.py
+# a manifest of the CSVs used to build each output is saved alongside it (e.g. seg_manifest.json next to seg.nc)
+# on the next build with --incremental, that manifest is compared with the current one, and only the
+# (landcover, model, scenario, era) slabs whose CSVs were added, changed or removed are rewritten
+
+import os
+import numpy as np
+import netCDF4
+from functions import *
+from manifest import read_manifest
+
+
+def output_manifest_path(outfile):
+    # path of the manifest saved alongside an output netCDF, e.g. seg.nc -> seg_manifest.json
+
+    root, _ = os.path.splitext(outfile)
+    return f"{root}_manifest.json"
+
+
+def get_manifest_rows(manifest, files):
+    # subset the manifest to the rows of the given files
+
+    names = [file.name for file in files]
+    return manifest[manifest["name"].isin(names)].reset_index(drop=True)
+
+
+def compare_manifests(previous, current):
+    # compare the manifest saved with an output to the current one
+    # returns the names of files that were added or changed, and the rows of the previous manifest whose files were removed
+    # files are compared by content hash if both manifests have one, otherwise by size and mtime
+
+    previous_rows = {row["name"]: row for row in previous.to_dict("records")}
+
+    changed = []
+    for row in current.to_dict("records"):
+        old = previous_rows.get(row["name"])
+        if old is None:
+            changed.append(row["name"])
+        elif row["hash"] and old["hash"]:
+            if row["hash"] != old["hash"]:
+                changed.append(row["name"])
+        elif row["size"] != old["size"] or row["mtime"] != old["mtime"]:
+            changed.append(row["name"])
+
+    removed = previous[~previous["name"].isin(current["name"])]
+
+    return changed, removed
+
+
+def read_output_coords(nc):
+    # decode the dimension coordinates of an output netCDF back to the strings used in the CSV filenames
+    # returns a dict in the same format as get_unique_coords() (without variants)
+
+    keys = {"landcover": "landcovers", "model": "models", "scenario": "scenarios", "era": "eras"}
+    coords_dict = {}
+    for dim in DIMS:
+        decode = {v: k for k, v in encodings_lookup[dim].items()}
+        coords_dict[keys[dim]] = [decode[int(v)] for v in nc[dim][:]]
+
+    return coords_dict
+
+
+def get_row_positions(rows, coord_index):
+    # get the integer positions of manifest rows in the stat blocks, skipping rows with coords that are not in coord_index
+
+    positions = []
+    for row in rows.to_dict("records"):
+        coords = tuple(row[dim] for dim in DIMS)
+        if all(coord in coord_index[dim] for dim, coord in zip(DIMS, coords)):
+            positions.append(tuple(coord_index[dim][coord] for dim, coord in zip(DIMS, coords)))
+
+    return positions
+
+
+def copy_slabs(old_nc, target, old_coord_index, skip):
+    # copy every slab of an existing output into a new streaming target, mapping old positions to new positions
+    # slabs at the (old) positions in skip, and slabs whose coords are no longer in the target, are not copied
+
+    stat_vars = list(stat_vars_dict.keys())
+    new_coord_index = target["coord_index"]
+    nc = target["nc"]
+
+    # map old integer positions to new integer positions for each dimension, or -1 if the coord was dropped
+    mapping = {
+        dim: [new_coord_index[dim].get(coord, -1) for coord in old_coord_index[dim]] for dim in DIMS
+    }
+
+    for old_positions in np.ndindex(*(len(old_coord_index[dim]) for dim in DIMS)):
+        if old_positions in skip:
+            continue
+        new_positions = tuple(mapping[dim][i] for dim, i in zip(DIMS, old_positions))
+        if -1 in new_positions:
+            continue
+        for stat in stat_vars:
+            nc[stat][new_positions] = old_nc[stat][old_positions]
+
+    return
+
+
+def new_incremental_target(outfile, dict, csv_ids, stream_ids, files, populate_metadata, current):
+    # create a build target that updates an existing output in place, writing only the CSVs that changed
+    # csv_ids and stream_ids are as in new_stream_target(), and current is the manifest of the files used for this output
+    # returns None if the output can't be updated incrementally and needs a full rebuild
+
+    manifest_path = output_manifest_path(outfile)
+    if not (os.path.exists(outfile) and os.path.exists(manifest_path)):
+        print(f"No existing {outfile} and {manifest_path} to update, doing a full rebuild...\n")
+        return None
+
+    previous = read_manifest(manifest_path)
+    changed, removed = compare_manifests(previous, current)
+    changed_files = [file for file in files if file.name in changed]
+    print(
+        f"Incremental update of {outfile}: {len(changed_files)} added or changed CSVs, {len(removed)} removed CSVs...\n"
+    )
+
+    coord_index = get_coord_index(dict)
+    old_nc = netCDF4.Dataset(outfile, "r")
+
+    # outputs in the compact layout can't be updated slab by slab
+    if "run" in old_nc.dimensions:
+        print(f"{outfile} is in the compact layout, doing a full rebuild...\n")
+        old_nc.close()
+        return None
+
+    # packed outputs can't be either, since new values may fall outside the packed range
+    if any(attr in old_nc[stat].ncattrs() for stat in stat_vars_dict.keys() for attr in ["scale_factor", "keepbits"]):
+        print(f"{outfile} is packed, doing a full rebuild...\n")
+        old_nc.close()
+        return None
+
+    old_coord_index = get_coord_index(read_output_coords(old_nc))
+
+    # if the geometry IDs changed, every slab has to be rewritten anyway
+    if not np.array_equal(old_nc["stream_id"][:], stream_ids):
+        print(f"Geometry IDs of {outfile} have changed, doing a full rebuild...\n")
+        old_nc.close()
+        return None
+
+    if old_coord_index == coord_index:
+        # same coordinates: rewrite the changed slabs in place, and clear the slabs of removed CSVs
+        old_nc.close()
+        nc = netCDF4.Dataset(outfile, "a")
+        for positions in get_row_positions(removed, coord_index):
+            for stat in stat_vars_dict.keys():
+                nc[stat][positions] = np.nan
+        target = netcdf_target(nc, coord_index, csv_ids, changed_files)
+    else:
+        # new or dropped coordinates (e.g. a new model or era): write a new file with the new coordinates,
+        # copying the unchanged slabs from the existing output, then replace it once the changed CSVs are written
+        print(f"Coordinates of {outfile} have changed, copying unchanged slabs to a new file...\n")
+        tmpfile = f"{outfile}.tmp"
+        target = new_stream_target(tmpfile, dict, csv_ids, stream_ids, changed_files, populate_metadata)
+        # the new file is written in the slab layout, so keep how the existing output was stored to lay it out again
+        target["previous_storage"] = get_output_storage(old_nc)
+        changed_rows = current[current["name"].isin(changed)]
+        skip = set(get_row_positions(removed, old_coord_index) + get_row_positions(changed_rows, old_coord_index))
+        copy_slabs(old_nc, target, old_coord_index, skip)
+        old_nc.close()
+        target["tmpfile"] = tmpfile
+
+    return target
+
+
+def finish_incremental_target(target, outfile):
+    # close the netCDF of an incremental build target, replacing the output if a new file was written
+
+    finish_stream_target(target)
+    if "tmpfile" in target:
+        os.replace(target["tmpfile"], outfile)
+
+    return
@@ -408,6 +408,11 @@ encodings_lookup = {
 }
 
 
+# sentinel fill values used in the statistics CSVs; these are replaced with NaN when the CSVs are read
+# -99999 marks missing statistics, and -999999 marks missing events in the difference CSVs
+stat_sentinels = [-99999, -999999]
+
+
 # reverse encodings for netCDF attributes
 reverse_encodings_lookup = {
     "landcover": {
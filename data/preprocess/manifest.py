@@ -0,0 +1,222 @@
+# script and functions to build a manifest (catalog) of the hydrologic data files in a directory
+# the directory is scanned once, and every filename is parsed once into typed columns
+# other steps (build_nc.py, the QC notebooks, etc.) can then read the manifest and look files up without globbing and re-parsing
+
+import argparse
+import sys
+import os
+import fnmatch
+import hashlib
+import json
+from pathlib import Path
+import pandas as pd
+
+# columns of the manifest, and their dtypes
+MANIFEST_DTYPES = {
+    "name": object,
+    "path": object,
+    "kind": object,  # "stats", "daily", or "climatology"
+    "geometry": object,  # "seg" or "hru"
+    "landcover": object,
+    "model": object,
+    "scenario": object,
+    "variant": object,
+    "era": object,  # None for daily flow and climatology files, which span all eras
+    "diff": bool,
+    "size": "int64",
+    "mtime": "float64",
+    "hash": object,  # None if files were not hashed
+}
+
+# default columns used to key the manifest for lookups
+MANIFEST_KEYS = ["kind", "geometry", "landcover", "model", "scenario", "era", "diff"]
+
+
+def arguments(argv):
+    """Parse some args"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--data_dir",
+        type=str,
+        help="directory where hydrologic stats or daily flow files are located",
+        required=True,
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        help="path of the manifest to write; use a .json or .parquet extension",
+        required=True,
+    )
+    parser.add_argument(
+        "--pattern",
+        type=str,
+        default="*.csv",
+        help="glob pattern used to select files in data_dir",
+    )
+    parser.add_argument(
+        "--no_hash",
+        action="store_true",
+        help="skip computing content hashes (faster, but incremental rebuilds can only compare sizes and mtimes)",
+    )
+
+    args = parser.parse_args()
+    data_dir = args.data_dir
+    manifest_path = args.manifest
+    pattern = args.pattern
+    hash_files = not args.no_hash
+
+    return data_dir, manifest_path, pattern, hash_files
+
+
+def parse_filename(name):
+    # parse a filename into a dict of coordinates; returns None if the filename doesn't follow a known naming scheme
+    # stats files:       <landcover>_<model>_<scenario>_<variant>_<seg|hru>_<start>_<end>[_diff].csv
+    # daily flow files:  <landcover>_<model>_<scenario>_<variant>_nsegment_summary_seg_outflow.csv
+    # climatology files: <landcover>_<model>_<scenario>_<variant>_doy_mmm_by_era.nc
+
+    parts = name.split(".")[0].split("_")
+    if len(parts) < 5:
+        return None
+
+    landcover, model, scenario, variant = parts[:4]
+    rest = parts[4:]
+
+    if rest[0] in ["seg", "hru"] and len(rest) >= 3:
+        kind, geometry, era = "stats", rest[0], "_".join(rest[1:3])
+        diff = "diff" in rest[3:]
+    elif rest[:2] == ["nsegment", "summary"]:
+        kind, geometry, era, diff = "daily", "seg", None, False
+    elif rest == ["doy", "mmm", "by", "era"]:
+        kind, geometry, era, diff = "climatology", "seg", None, False
+    else:
+        return None
+
+    return {
+        "kind": kind,
+        "geometry": geometry,
+        "landcover": landcover,
+        "model": model,
+        "scenario": scenario,
+        "variant": variant,
+        "era": era,
+        "diff": diff,
+    }
+
+
+def hash_file(path, block_size=1 << 23):
+    # compute the sha256 hash of a file's contents, reading it in 8 MB blocks
+
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+
+    return h.hexdigest()
+
+
+def typed_manifest(rows):
+    # build a manifest DataFrame with the expected columns and dtypes from a list of row dicts
+
+    manifest = pd.DataFrame(rows, columns=list(MANIFEST_DTYPES.keys()))
+    manifest = manifest.astype(MANIFEST_DTYPES)
+    # keep missing strings as None (not NaN) so they survive the round trip through JSON
+    for col, dtype in MANIFEST_DTYPES.items():
+        if dtype is object:
+            manifest[col] = manifest[col].where(manifest[col].notna(), None)
+
+    return manifest.sort_values("name", ignore_index=True)
+
+
+def scan_directory(data_dir, pattern="*.csv", previous=None, hash_files=True):
+    # scan data_dir once and return a manifest with one row per file matching pattern
+    # if a previous manifest is given, hashes are reused for files whose size and mtime have not changed
+
+    previous_rows = {}
+    if previous is not None:
+        previous_rows = {row["name"]: row for row in previous.to_dict("records")}
+
+    rows = []
+    with os.scandir(data_dir) as entries:
+        for entry in entries:
+            if not entry.is_file() or not fnmatch.fnmatch(entry.name, pattern):
+                continue
+
+            coords = parse_filename(entry.name)
+            if coords is None:
+                print(f"Error parsing file: {entry.name}")
+                continue
+
+            stat = entry.stat()
+            row = {
+                "name": entry.name,
+                "path": os.path.abspath(entry.path),
+                **coords,
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "hash": None,
+            }
+
+            if hash_files:
+                old = previous_rows.get(entry.name)
+                if old is not None and old["size"] == row["size"] and old["mtime"] == row["mtime"] and old["hash"]:
+                    row["hash"] = old["hash"]
+                else:
+                    row["hash"] = hash_file(entry.path)
+
+            rows.append(row)
+
+    return typed_manifest(rows)
+
+
+def write_manifest(manifest, manifest_path):
+    # write the manifest to JSON or Parquet, depending on the file extension
+
+    if Path(manifest_path).suffix == ".parquet":
+        manifest.to_parquet(manifest_path, index=False)
+    else:
+        with open(manifest_path, "w") as f:
+            json.dump(manifest.astype(object).to_dict("records"), f, indent=2)
+
+
+def read_manifest(manifest_path):
+    # read a manifest written by write_manifest()
+
+    if Path(manifest_path).suffix == ".parquet":
+        rows = pd.read_parquet(manifest_path).to_dict("records")
+    else:
+        with open(manifest_path) as f:
+            rows = json.load(f)
+
+    return typed_manifest(rows)
+
+
+def index_manifest(manifest, keys=MANIFEST_KEYS):
+    # build a dict for O(1) lookups of manifest rows, keyed by a tuple of the values in the key columns
+    # e.g. index[("stats", "seg", "static", "CCSM4", "rcp45", "2016_2045", False)]
+
+    return {tuple(row[k] for k in keys): row for row in manifest.to_dict("records")}
+
+
+def manifest_files(manifest, geometry, kind="stats"):
+    # list the paths of all files of a given kind and geometry type in the manifest
+    # this replaces globbing the data directory for e.g. "dynamic*seg*.csv" and "static*seg*.csv"
+
+    rows = manifest[(manifest["kind"] == kind) & (manifest["geometry"] == geometry)]
+
+    return [Path(p) for p in rows["path"]]
+
+
+if __name__ == "__main__":
+
+    data_dir, manifest_path, pattern, hash_files = arguments(sys.argv)
+
+    previous = None
+    if os.path.exists(manifest_path):
+        print(f"Reading previous manifest from {manifest_path}...\n")
+        previous = read_manifest(manifest_path)
+
+    print(f"Scanning {data_dir} for files matching {pattern}...\n")
+    manifest = scan_directory(data_dir, pattern, previous=previous, hash_files=hash_files)
+
+    print(f"Writing manifest of {len(manifest)} files to {manifest_path}...\n")
+    write_manifest(manifest, manifest_path)
@@ -0,0 +1,170 @@
+# script to export the stats netCDFs to Hive-partitioned Parquet datasets, for querying with DuckDB or pyarrow
+# without xarray and the float-encoded coordinates, e.g. in DuckDB:
+#     SELECT stream_id, model, dh1 FROM read_parquet('seg_combined/*/*/*/*.parquet', hive_partitioning = true)
+#     WHERE source = 'gcm_diff' AND scenario = 'rcp85' AND dh1 > 1.2
+# each netCDF (seg.nc, hru.nc, seg_diff.nc, hru_diff.nc, seg_combined.nc, compact or not) is written to
+# <output_dir>/<name>/source=<source>/scenario=<scenario>/era=<era>/part-0.parquet, with the columns
+# stream_id, landcover, model (decoded) and one float32 column per stat
+# rows follow the stream_id order of the netCDF, then landcover and model, and are written in row groups of blocks
+# of stream_ids, so the row group statistics of stream_id let filtered scans skip most of each file when the
+# stream_ids of the netCDF are sorted
+# rows of models without data for a scenario and era (e.g. Maurer for the future scenarios) are left out
+# outputs without a source dimension are written as source=original_gcm, or source=gcm_diff for the *_diff.nc outputs
+
+import argparse
+import sys
+import os
+import shutil
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import netCDF4
+from functions import DIMS, set_auto_unpack, read_values, get_output_stats
+from luts import *
+from virtual_source import CombinedReader
+from seg_correct_and_combine import SOURCE_ENCODING, MONTHLY_VARS
+
+
+def arguments(argv):
+    """Parse some args"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--nc",
+        type=str,
+        nargs="+",
+        help="netCDFs to export, e.g. seg.nc hru.nc seg_diff.nc hru_diff.nc seg_combined.nc",
+        required=True,
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        help="directory where a partitioned dataset will be written for each netCDF",
+        required=True,
+    )
+    parser.add_argument(
+        "--block_streams",
+        type=int,
+        default=1024,
+        help="number of stream_ids read at a time, and written to each row group",
+    )
+
+    args = parser.parse_args()
+
+    return args.nc, args.output_dir, args.block_streams
+
+
+def get_sources(nc, name):
+    # get the sources of a netCDF: all of them for a combined output (including derived ones),
+    # otherwise gcm_diff for the *_diff outputs and original_gcm for the rest
+
+    if "source" in nc.dimensions:
+        return list(SOURCE_ENCODING.values())
+    if name.endswith("_diff"):
+        return ["gcm_diff"]
+
+    return ["original_gcm"]
+
+
+def read_block(nc, reader, var, source, block):
+    # read the values of one variable and source for a block of stream_ids as a dense
+    # (landcover, model, scenario, era, stream_id) array, whatever the layout of the netCDF
+
+    if reader is not None:
+        # combined outputs, where derived sources are computed on read
+        return reader.read(var, source, nc["stream_id"][block])
+    if "run" not in nc.dimensions:
+        return read_values(nc[var], (Ellipsis, block))
+
+    # compact outputs: expand the runs to the dense cube, with NaN for the combinations without data
+    run_index = nc["run_index"][:]
+    values = read_values(nc[var], (slice(None), block))[np.where(run_index < 0, 0, run_index)]
+    values[run_index < 0] = np.nan
+
+    return values
+
+
+def block_to_tables(coords, stream_ids, values):
+    # split the stats of a block into a table for each (scenario, era) partition
+    # values maps each stat to a dense (landcover, model, scenario, era, stream_id) array
+    # returns a dict of {(scenario, era): table}, with rows in the order of stream_ids, then landcover and model
+
+    stats = list(values.keys())
+    n_landcovers, n_models = len(coords["landcover"]), len(coords["model"])
+    landcovers = np.array([reverse_encodings_lookup["landcover"][int(v)] for v in coords["landcover"]])
+    models = np.array([reverse_encodings_lookup["model"][int(v)] for v in coords["model"]])
+
+    tables = {}
+    for s, scenario in enumerate(coords["scenario"]):
+        for e, era in enumerate(coords["era"]):
+            # (stream_id, landcover, model) order, so the rows of each stream_id are contiguous
+            columns = {stat: np.moveaxis(values[stat][:, :, s, e, :], -1, 0).reshape(-1) for stat in stats}
+            keep = np.zeros(len(stream_ids) * n_landcovers * n_models, dtype=bool)
+            for column in columns.values():
+                keep |= ~np.isnan(column)
+            if not keep.any():
+                continue
+
+            table = {
+                "stream_id": np.repeat(stream_ids, n_landcovers * n_models)[keep],
+                "landcover": np.tile(np.repeat(landcovers, n_models), len(stream_ids))[keep],
+                "model": np.tile(models, len(stream_ids) * n_landcovers)[keep],
+            }
+            table.update({stat: column[keep] for stat, column in columns.items()})
+            key = (reverse_encodings_lookup["scenario"][int(scenario)], reverse_encodings_lookup["era"][int(era)])
+            tables[key] = pa.table(table)
+
+    return tables
+
+
+def export_netcdf(nc_path, output_dir, block_streams=1024):
+    # export one netCDF to a partitioned Parquet dataset in <output_dir>/<name>, replacing any previous export
+    # returns the number of rows written
+
+    name = os.path.splitext(os.path.basename(nc_path))[0]
+    dataset_dir = os.path.join(output_dir, name)
+    if os.path.exists(dataset_dir):
+        shutil.rmtree(dataset_dir)
+
+    nc = netCDF4.Dataset(nc_path, "r")
+    set_auto_unpack(nc)
+    # keep the derived monthly variables of a block cached for the derived ma99
+    reader = CombinedReader(nc_path, cache_size=len(MONTHLY_VARS) + 1) if "source" in nc.dimensions else None
+    stats = get_output_stats(nc)
+    coords = {dim: nc[dim][:] for dim in DIMS}
+
+    writers = {}
+    n_rows = 0
+    n_streams = len(nc.dimensions["stream_id"])
+    for source in get_sources(nc, name):
+        for start in range(0, n_streams, block_streams):
+            block = slice(start, min(start + block_streams, n_streams))
+            values = {stat: read_block(nc, reader, stat, source, block) for stat in stats}
+            for (scenario, era), table in block_to_tables(coords, nc["stream_id"][block], values).items():
+                key = (source, scenario, era)
+                if key not in writers:
+                    partition_dir = os.path.join(dataset_dir, f"source={source}", f"scenario={scenario}", f"era={era}")
+                    os.makedirs(partition_dir, exist_ok=True)
+                    writers[key] = pq.ParquetWriter(
+                        os.path.join(partition_dir, "part-0.parquet"), table.schema, write_statistics=True
+                    )
+                writers[key].write_table(table)
+                n_rows += table.num_rows
+        print(f"Exported the {source} source of {nc_path}...")
+
+    for writer in writers.values():
+        writer.close()
+    if reader is not None:
+        reader.close()
+    nc.close()
+
+    return n_rows
+
+
+if __name__ == "__main__":
+
+    nc_paths, output_dir, block_streams = arguments(sys.argv)
+
+    for nc_path in nc_paths:
+        print(f"Exporting {nc_path} to {output_dir}...\n")
+        n_rows = export_netcdf(nc_path, output_dir, block_streams)
+        print(f"Wrote {n_rows} rows.\n")
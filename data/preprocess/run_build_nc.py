@@ -15,8 +15,21 @@ def arguments(argv):
     parser.add_argument("--build_nc_script", type=str, help="location of build_nc.py", required=True)
     parser.add_argument("--build_json_script", type=str, help="location of build_ingest_json.py", required=True)
     parser.add_argument("--diff", action="store_true", help="process diff files only; outputs seg_diff.nc and hru_diff.nc")
+    parser.add_argument("--workers", type=int, default=24, help="number of worker processes build_nc.py uses to parse the CSVs")
+    parser.add_argument("--all", action="store_true", help="build seg.nc, hru.nc, seg_diff.nc and hru_diff.nc in one job")
+    parser.add_argument("--stream", action="store_true", help="write each CSV straight to the output netCDFs instead of building the datasets in memory")
+    parser.add_argument("--incremental", action="store_true", help="update existing outputs, rewriting only the slabs whose CSVs changed")
+    parser.add_argument("--compact", action="store_true", help="write the outputs with a run dimension listing only the combinations that have data")
+    parser.add_argument("--layout", type=str, default=None, help="storage layout of the outputs passed to build_nc.py (contiguous, slab or stream)")
+    parser.add_argument("--chunk_streams", type=int, default=None, help="number of stream_ids per chunk passed to build_nc.py with --layout stream")
+    parser.add_argument("--complevel", type=int, default=None, help="zlib compression level passed to build_nc.py")
+    parser.add_argument("--combine_script", type=str, default=None, help="location of seg_correct_and_combine.py; if given with --all, seg_combined.nc is also built")
+    parser.add_argument("--pack", type=str, default=None, help="lossy encoding of the stats passed to build_nc.py and seg_correct_and_combine.py (int16, int8 or bitround)")
+    parser.add_argument("--keepbits", type=int, default=None, help="number of mantissa bits kept with --pack bitround")
 
     args = parser.parse_args()
+    if args.combine_script is not None and not args.all:
+        parser.error("--combine_script requires --all, to build both seg.nc and seg_diff.nc")
     data_dir = args.data_dir
     gis_dir = args.gis_dir
     output_dir = args.output_dir
@@ -25,8 +38,19 @@ def arguments(argv):
     build_nc_script = args.build_nc_script
     build_json_script = args.build_json_script
     diff = args.diff
+    workers = args.workers
+    build_all = args.all
+    stream = args.stream
+    incremental = args.incremental
+    compact = args.compact
+    layout = args.layout
+    chunk_streams = args.chunk_streams
+    complevel = args.complevel
+    combine_script = args.combine_script
+    pack = args.pack
+    keepbits = args.keepbits
 
-    return data_dir, gis_dir, output_dir, conda_init_script, conda_env_name, build_nc_script, build_json_script, diff
+    return data_dir, gis_dir, output_dir, conda_init_script, conda_env_name, build_nc_script, build_json_script, diff, workers, build_all, stream, incremental, compact, layout, chunk_streams, complevel, combine_script, pack, keepbits
 
 
 def write_sbatch_head(sbatch_out_fp, conda_init_script, conda_env_name):
@@ -66,6 +90,17 @@ def write_sbatch(
     gis_dir,
     output_dir,
     diff=False,
+    workers=1,
+    build_all=False,
+    stream=False,
+    incremental=False,
+    compact=False,
+    layout=None,
+    chunk_streams=None,
+    complevel=None,
+    combine_script=None,
+    pack=None,
+    keepbits=None,
 ):
     """Write an sbatch script for building the netCDFs
 
@@ -74,19 +109,49 @@ def write_sbatch(
         sbatch_out_fp (path_like): path to where sbatch stdout should be written
         sbatch_head (dict): string for sbatch head script
         diff (bool): if True, pass --diff to build_nc_script
+        workers (int): number of worker processes to pass to build_nc_script
+        build_all (bool): if True, pass --all to build_nc_script
+        stream (bool): if True, pass --stream to build_nc_script
+        incremental (bool): if True, pass --incremental to build_nc_script
+        compact (bool): if True, pass --compact to build_nc_script
+        layout (str): storage layout to pass to build_nc_script, or None for its default
+        chunk_streams (int): number of stream_ids per chunk to pass to build_nc_script, or None for its default
+        complevel (int): compression level to pass to build_nc_script, or None for its default
+        combine_script (path_like): path to seg_correct_and_combine.py to run after build_nc_script, or None to skip it
+        pack (str): lossy encoding of the stats to pass to build_nc_script and combine_script, or None to keep float32
+        keepbits (int): number of mantissa bits to pass with pack="bitround", or None
 
     Returns:
         None, writes the commands to sbatch_fp
     """
-    diff_flag = " --diff" if diff else ""
+    flags = " --diff" if diff else ""
+    flags += " --all" if build_all else ""
+    flags += " --stream" if stream else ""
+    flags += " --incremental" if incremental else ""
+    flags += " --compact" if compact else ""
+    flags += f" --layout {layout}" if layout is not None else ""
+    flags += f" --chunk_streams {chunk_streams}" if chunk_streams is not None else ""
+    flags += f" --complevel {complevel}" if complevel is not None else ""
+    pack_flags = f" --pack {pack}" if pack is not None else ""
+    pack_flags += f" --keepbits {keepbits}" if keepbits is not None else ""
+    flags += pack_flags
     pycommands = "\n"
     pycommands += (
         f"python {build_nc_script} "
         f"--data_dir {data_dir} "
         f"--gis_dir {gis_dir} "
-        f"--output_dir {output_dir}"
-        f"{diff_flag};"
+        f"--output_dir {output_dir} "
+        f"--workers {workers}"
+        f"{flags};"
     )
+    if combine_script is not None:
+        pycommands += (
+            f"python {combine_script} "
+            f"--seg {os.path.join(output_dir, 'seg.nc')} "
+            f"--seg_diff {os.path.join(output_dir, 'seg_diff.nc')} "
+            f"--output {os.path.join(output_dir, 'seg_combined.nc')}"
+            f"{pack_flags};"
+        )
     pycommands += (
         f"python {build_json_script} "
         f"--output_dir {output_dir} "
@@ -118,7 +183,7 @@ def submit_sbatch(sbatch_fp):
 
 if __name__ == "__main__":
 
-    data_dir, gis_dir, output_dir, conda_init_script, conda_env_name, build_nc_script, build_json_script, diff = arguments(sys.argv)
+    data_dir, gis_dir, output_dir, conda_init_script, conda_env_name, build_nc_script, build_json_script, diff, workers, build_all, stream, incremental, compact, layout, chunk_streams, complevel, combine_script, pack, keepbits = arguments(sys.argv)
 
     # create the output directory if it doesn't exist
     Path(output_dir).mkdir(exist_ok=True, parents=True)
@@ -129,5 +194,5 @@ if __name__ == "__main__":
 
     # write sbatch head + commands, then submit job
     sbatch_head = write_sbatch_head(sbatch_out_fp, conda_init_script, conda_env_name)
-    write_sbatch(sbatch_fp, sbatch_out_fp, sbatch_head, build_nc_script, build_json_script, data_dir, gis_dir, output_dir, diff=diff)
+    write_sbatch(sbatch_fp, sbatch_out_fp, sbatch_head, build_nc_script, build_json_script, data_dir, gis_dir, output_dir, diff=diff, workers=workers, build_all=build_all, stream=stream, incremental=incremental, compact=compact, layout=layout, chunk_streams=chunk_streams, complevel=complevel, combine_script=combine_script, pack=pack, keepbits=keepbits)
     submit_sbatch(sbatch_fp)
\ No newline at end of file
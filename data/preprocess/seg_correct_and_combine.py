@@ -0,0 +1,268 @@
+# script to apply the GCM change signals of seg_diff.nc to the Maurer historical baseline of seg.nc,
+# and write seg_combined.nc with the original, diff and corrected values stacked along a "source" dimension
+# this is the seg_correct_and_combine.ipynb workflow, but the outputs are read and written in blocks of stream_ids,
+# one variable at a time, so only a few variables' worth of a block is ever in memory
+# the coordinates of the output are the (sorted) coordinates of seg.nc, so no re-sorting is needed before ingest
+# with --virtual, only the original_gcm and gcm_diff sources are stored, and gcm_diff_applied_to_maurer is computed
+# on read for just the selected streams by virtual_source.py
+# with --pack, the stats of the output are then packed (see functions.pack_output()), and seg and seg_diff can be packed too
+
+import argparse
+import sys
+import numpy as np
+import xarray as xr
+import netCDF4
+from functions import *
+
+JULIAN_DATE_VARS = {"spr_ord", "sum_ord", "th1", "tl1"}
+DAYS_PER_YEAR_VARS = {"dh15", "dl16", "lf1", "ra8"}
+MONTHLY_VARS = ["ma12", "ma13", "ma14", "ma15", "ma16", "ma17", "ma18", "ma19", "ma20", "ma21", "ma22", "ma23"]
+
+SOURCE_ENCODING = {0: "original_gcm", 1: "gcm_diff", 2: "gcm_diff_applied_to_maurer"}
+# sources that can be computed from the others on read, and left out of the output with --virtual
+DERIVED_SOURCES = ["gcm_diff_applied_to_maurer"]
+
+# Maurer historical 1976-2005 is the baseline applied to all GCM change signals
+BASELINE = {"model": "Maurer", "scenario": "historical", "era": "1976_2005"}
+
+# the value used for missing data in the diff CSVs, masked here in case seg_diff.nc was built before build_nc.py did so
+FILL_VALUE = -999999
+
+
+def arguments(argv):
+    """Parse some args"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seg", type=str, help="seg.nc built by build_nc.py", required=True)
+    parser.add_argument("--seg_diff", type=str, help="seg_diff.nc built by build_nc.py --diff", required=True)
+    parser.add_argument("--output", type=str, help="path of the combined netCDF to write, e.g. seg_combined.nc", required=True)
+    parser.add_argument("--block_streams", type=int, default=4096, help="number of stream_ids read and written at a time")
+    parser.add_argument(
+        "--virtual",
+        action="store_true",
+        help="store only the original_gcm and gcm_diff sources; gcm_diff_applied_to_maurer is computed on read by virtual_source.py",
+    )
+    parser.add_argument(
+        "--pack",
+        type=str,
+        default=None,
+        choices=PACKINGS,
+        help="lossy encoding of the stats of the output: int16 or int8 scale / offset packing, or bitround to --keepbits mantissa bits",
+    )
+    parser.add_argument("--keepbits", type=int, default=None, help="number of mantissa bits kept with --pack bitround (0 to 23)")
+
+    args = parser.parse_args()
+    if args.pack == "bitround" and args.keepbits is None:
+        parser.error("--pack bitround needs --keepbits")
+
+    return args.seg, args.seg_diff, args.output, args.block_streams, args.virtual, args.pack, args.keepbits
+
+
+def get_positions(values, target_values):
+    # get the position of each of values in target_values, or -1 if it is not there
+
+    lookup = {value: i for i, value in enumerate(target_values)}
+    return np.array([lookup.get(value, -1) for value in values], dtype=int)
+
+
+def get_diff_positions(seg, seg_diff):
+    # map the (landcover, model, scenario, era) coordinates of seg_diff to their positions in seg
+    # returns (diff_rows, seg_rows), a tuple of index arrays for each, so that seg_block[seg_rows] = diff_block[diff_rows]
+    # coordinates of seg_diff that are not in seg are dropped, as with reindex_like()
+
+    diff_rows, seg_rows = [], []
+    for dim in DIMS:
+        positions = get_positions(seg_diff[dim][:].tolist(), seg[dim][:].tolist())
+        diff_rows.append(np.flatnonzero(positions >= 0))
+        seg_rows.append(positions[positions >= 0])
+
+    return np.ix_(*diff_rows), np.ix_(*seg_rows)
+
+
+def get_baseline_positions(seg):
+    # get the (model, scenario, era) positions of the Maurer historical baseline in seg (or a combined output)
+    # returns None if the baseline is not in the coordinates
+
+    positions = []
+    for dim in ["model", "scenario", "era"]:
+        position = get_positions([encodings_lookup[dim][BASELINE[dim]]], seg[dim][:].tolist())[0]
+        if position < 0:
+            return None
+        positions.append(position)
+
+    return tuple(positions)
+
+
+def apply_change_signal(var, base, delta, difference_method):
+    # apply the change signal delta of one variable to the baseline values base, broadcasting base across delta
+    # ratio signals are multiplied, and absolute signals are added, with Julian dates wrapped around to stay within [1, 366]
+
+    if difference_method == "ratio":
+        result = base * delta
+    elif var in JULIAN_DATE_VARS:
+        # subtract 1 before and add 1 after the modulo so that day 0 is never an output
+        result = np.remainder(base + delta - 1, 366) + 1
+    else:
+        result = base + delta
+    # number-of-days-per-year variables cannot physically exceed 366
+    if var in DAYS_PER_YEAR_VARS:
+        result = np.clip(result, None, 366)
+
+    return result
+
+
+def correct_block(var, seg_block, diff_block, baseline, difference_method):
+    # apply the change signals of one variable to the baseline for a block of stream_ids
+    # seg_block and diff_block have dims (landcover, model, scenario, era, stream_id), with the diff reindexed to seg
+
+    # the baseline is (landcover, stream_id), and is broadcast across the model, scenario and era dims of the diff
+    base = seg_block[:, baseline[0], baseline[1], baseline[2], :]
+    corrected = apply_change_signal(var, base[:, None, None, None, :], diff_block, difference_method)
+
+    # fill the baseline slot with the baseline values, unless a change signal was applied to it
+    slot = corrected[:, baseline[0], baseline[1], baseline[2], :]
+    corrected[:, baseline[0], baseline[1], baseline[2], :] = np.where(np.isnan(slot), base, slot)
+
+    return corrected
+
+
+def combine_block(var, seg_block, diff_block, diff_rows, seg_rows, baseline, difference_method, n_sources=3):
+    # stack the original, reindexed diff and (unless n_sources is 2) corrected values of one variable for a block of stream_ids
+    # returns an array with dims (source, landcover, model, scenario, era, stream_id)
+
+    diff_block = np.where((diff_block == FILL_VALUE) | ~np.isfinite(diff_block), np.nan, diff_block)
+
+    combined = np.full((n_sources,) + seg_block.shape, np.nan, dtype=np.float32)
+    combined[0] = seg_block
+    combined[1][seg_rows] = diff_block[diff_rows]
+    if n_sources > 2:
+        combined[2] = correct_block(var, seg_block, combined[1], baseline, difference_method)
+
+    return combined
+
+
+def mean_monthly_block(monthly):
+    # mean annual flow, as the mean of the blocks of the monthly flow variables (in the order of MONTHLY_VARS)
+    # the mean is taken with xarray, to match the mean of ma99 in the notebook exactly
+
+    return xr.concat([xr.DataArray(block) for block in monthly], dim="month").mean("month").values
+
+
+def create_combined_output(outfile, seg, seg_diff, variables, virtual=False):
+    # create the combined netCDF with the coordinates and metadata of seg, plus the source dimension, but no data yet
+    # with virtual=True, the DERIVED_SOURCES are left out of the source dimension and listed in the derived_sources attribute
+
+    sources = [code for code, name in SOURCE_ENCODING.items() if not (virtual and name in DERIVED_SOURCES)]
+
+    nc = netCDF4.Dataset(outfile, "w", format="NETCDF4")
+    nc.setncatts({k: seg.getncattr(k) for k in seg.ncattrs()})
+    if virtual:
+        nc.setncattr("derived_sources", " ".join(DERIVED_SOURCES))
+
+    nc.createDimension("source", len(sources))
+    source = nc.createVariable("source", "f4", ("source",), fill_value=np.nan)
+    source.setncattr("encoding", str(SOURCE_ENCODING))
+    source[:] = np.array(sources, dtype=np.float32)
+
+    for dim in DIMS + ["stream_id"]:
+        nc.createDimension(dim, len(seg.dimensions[dim]))
+        fill_value = np.nan if seg[dim].dtype.kind == "f" else None
+        coord = nc.createVariable(dim, seg[dim].dtype, (dim,), fill_value=fill_value)
+        coord.setncatts({k: seg[dim].getncattr(k) for k in seg[dim].ncattrs() if k != "_FillValue"})
+        coord[:] = seg[dim][:]
+
+    dims = ("source",) + tuple(DIMS) + ("stream_id",)
+    for var in variables:
+        out = nc.createVariable(var, "f4", dims, fill_value=np.nan)
+        out.setncatts({k: seg[var].getncattr(k) for k in seg[var].ncattrs() if k not in ["_FillValue"] + PACKING_ATTRS})
+        out.setncattr("difference_method", seg_diff[var].getncattr("difference_method"))
+
+    ma99 = nc.createVariable("ma99", "f4", dims, fill_value=np.nan)
+    ma99.setncatts(
+        {
+            "difference_method": "",
+            "description": "Mean annual flow, calculated as the mean of monthly flow variables (ma12-ma23)",
+            "units": seg["ma12"].getncattr("units"),
+        }
+    )
+
+    return nc
+
+
+def check_inputs(seg, seg_diff):
+    # check that seg and seg_diff can be combined: dense layouts, sorted coordinates, and the same stream_ids
+
+    for nc, name in [(seg, "seg"), (seg_diff, "seg_diff")]:
+        if "run" in nc.dimensions:
+            print(f"Error: {name} is in the compact layout; rebuild it without --compact to combine it.")
+            sys.exit(1)
+    for dim in DIMS:
+        if np.any(np.diff(seg[dim][:]) <= 0):
+            print(f"Error: the {dim} coordinate of seg is not sorted; rebuild it with build_nc.py.")
+            sys.exit(1)
+    if not np.array_equal(seg["stream_id"][:], seg_diff["stream_id"][:]):
+        print("Error: seg and seg_diff have different stream_ids; build them from the same GIS files.")
+        sys.exit(1)
+    if get_baseline_positions(seg) is None:
+        print(f"Error: the {BASELINE} baseline is not in the coordinates of seg, can't apply the change signals.")
+        sys.exit(1)
+
+    return
+
+
+def combine_outputs(seg_path, seg_diff_path, outfile, block_streams=4096, virtual=False):
+    # write the combined netCDF, one block of stream_ids and one variable at a time
+
+    seg = netCDF4.Dataset(seg_path, "r")
+    seg_diff = netCDF4.Dataset(seg_diff_path, "r")
+    set_auto_unpack(seg)
+    set_auto_unpack(seg_diff)
+    check_inputs(seg, seg_diff)
+
+    variables = [var for var in stat_vars_dict.keys() if var in seg.variables]
+    diff_rows, seg_rows = get_diff_positions(seg, seg_diff)
+    baseline = get_baseline_positions(seg)
+    difference_methods = {var: seg_diff[var].getncattr("difference_method") for var in variables}
+
+    nc = create_combined_output(outfile, seg, seg_diff, variables, virtual)
+    n_sources = len(nc.dimensions["source"])
+    gcm_diff = list(SOURCE_ENCODING.values()).index("gcm_diff")
+    n_streams = len(seg.dimensions["stream_id"])
+    for start in range(0, n_streams, block_streams):
+        block = slice(start, min(start + block_streams, n_streams))
+        monthly = {}
+        for var in variables:
+            combined = combine_block(
+                var,
+                read_values(seg[var], (Ellipsis, block)),
+                read_values(seg_diff[var], (Ellipsis, block)),
+                diff_rows,
+                seg_rows,
+                baseline,
+                difference_methods[var],
+                n_sources,
+            )
+            nc[var][..., block] = combined
+            if var in MONTHLY_VARS:
+                monthly[var] = combined
+        # ma99 is not defined for the change signals
+        ma99 = mean_monthly_block([monthly[var] for var in MONTHLY_VARS])
+        ma99[gcm_diff] = np.nan
+        nc["ma99"][..., block] = ma99
+        print(f"Combined stream_ids {block.start} to {block.stop} of {n_streams}...")
+
+    nc.close()
+    seg.close()
+    seg_diff.close()
+
+    return
+
+
+if __name__ == "__main__":
+
+    seg_path, seg_diff_path, outfile, block_streams, virtual, packing, keepbits = arguments(sys.argv)
+
+    print(f"Applying the change signals of {seg_diff_path} to {seg_path}...\n")
+    combine_outputs(seg_path, seg_diff_path, outfile, block_streams, virtual)
+    if packing is not None:
+        set_output_packing(outfile, packing, keepbits)
+    print(f"\nWrote {outfile}.\n")
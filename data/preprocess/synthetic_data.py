@@ -0,0 +1,168 @@
+# script and functions to generate a synthetic hydrologic stats dataset for testing and benchmarking build_nc.py locally
+# writes stats CSVs with the same naming scheme and columns as the real data, e.g. static_CCSM4_rcp45_r1i1p1_seg_2016_2045.csv,
+# plus the GIS files build_nc.py reads (Segments_subset.shp, HRU_subset.shp and nhm_hru_id_crosswalk.csv)
+
+import argparse
+import sys
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import geopandas as gpd
+from luts import *
+
+HISTORICAL_ERA = "1976_2005"
+FUTURE_ERAS = ["2016_2045", "2046_2075", "2071_2100"]
+FUTURE_SCENARIOS = ["rcp45", "rcp85", "rcp26", "rcp60"]
+
+
+def arguments(argv):
+    """Parse some args"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--data_dir",
+        type=str,
+        help="directory where the synthetic stats CSVs will be saved",
+        required=True,
+    )
+    parser.add_argument(
+        "--gis_dir",
+        type=str,
+        help="directory where the synthetic GIS files will be saved",
+        required=True,
+    )
+    parser.add_argument("--n_streams", type=int, default=1000, help="number of stream segments (and HRUs) in each CSV")
+    parser.add_argument("--scale", type=int, default=1, help="multiplier for n_streams, e.g. 10 or 100")
+    parser.add_argument("--n_models", type=int, default=5, help="number of GCMs (Maurer is always included, historical only)")
+    parser.add_argument("--n_scenarios", type=int, default=2, help="number of future scenarios (1-4)")
+    parser.add_argument("--n_eras", type=int, default=3, help="number of future eras (1-3)")
+    parser.add_argument("--n_stats", type=int, default=len(stat_vars_dict), help="number of stat columns in each CSV")
+    parser.add_argument("--nodata_rate", type=float, default=0.01, help="fraction of values set to -99999")
+    parser.add_argument("--missing_column_rate", type=float, default=0.01, help="probability that a stat column is missing from a CSV")
+    parser.add_argument("--clip_rate", type=float, default=0.9, help="fraction of IDs in the CSVs that are also in the shapefiles")
+    parser.add_argument("--diff", action="store_true", help="also write *_diff.csv files for the future scenarios and eras")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the random values")
+
+    args = parser.parse_args()
+    params = {
+        "n_streams": args.n_streams * args.scale,
+        "n_models": args.n_models,
+        "n_scenarios": args.n_scenarios,
+        "n_eras": args.n_eras,
+        "n_stats": args.n_stats,
+        "nodata_rate": args.nodata_rate,
+        "missing_column_rate": args.missing_column_rate,
+        "clip_rate": args.clip_rate,
+        "diff": args.diff,
+        "seed": args.seed,
+    }
+
+    return args.data_dir, args.gis_dir, params
+
+
+def get_synthetic_runs(n_models, n_scenarios, n_eras, diff=False):
+    # list the (model, scenario, era, diff) combinations of the synthetic dataset
+    # every GCM has the historical run and every future scenario / era; Maurer only has the historical run
+    # diff files only exist for the future runs of the GCMs
+
+    gcms = [model for model in encodings_lookup["model"] if model != "Maurer"][:n_models]
+    scenarios = FUTURE_SCENARIOS[:n_scenarios]
+    eras = FUTURE_ERAS[:n_eras]
+
+    runs = [("Maurer", "historical", HISTORICAL_ERA, False)]
+    for model in gcms:
+        runs.append((model, "historical", HISTORICAL_ERA, False))
+        for scenario in scenarios:
+            for era in eras:
+                runs.append((model, scenario, era, False))
+                if diff:
+                    runs.append((model, scenario, era, True))
+
+    return runs
+
+
+def write_stats_csv(path, id_col, ids, stats, rng, nodata_rate, missing_column_rate):
+    # write one synthetic stats CSV with random values, -99999 nodata values and randomly dropped stat columns
+
+    values = (rng.normal(size=(len(stats), len(ids))) * 100).round(4)
+    values[rng.random(values.shape) < nodata_rate] = -99999
+
+    columns = {id_col: pa.array(ids)}
+    for stat, column in zip(stats, values):
+        if rng.random() >= missing_column_rate:
+            columns[stat] = pa.array(column)
+
+    # write the header separately, since pyarrow quotes the column names
+    with open(path, "wb") as f:
+        f.write((",".join(columns.keys()) + "\n").encode())
+        pacsv.write_csv(
+            pa.table(columns), f, write_options=pacsv.WriteOptions(include_header=False, quoting_style="none")
+        )
+
+
+def write_gis_files(gis_dir, n_streams, clip_rate, rng):
+    # write point shapefiles with the seg_id_nat / hru_id_nat IDs kept by the clip, and the HRU ID crosswalk
+    # segment IDs in the CSVs are national IDs already; HRU IDs in the CSVs are crosswalked to hru_id_nat = hru_id + 1000000
+
+    os.makedirs(gis_dir, exist_ok=True)
+    ids = np.arange(1, n_streams + 1)
+    kept = np.sort(rng.choice(ids, int(round(n_streams * clip_rate)), replace=False))
+    geometry = gpd.points_from_xy(kept.astype(float), kept.astype(float))
+
+    gpd.GeoDataFrame({"seg_id_nat": kept}, geometry=geometry, crs="EPSG:4326").to_file(
+        os.path.join(gis_dir, "Segments_subset.shp")
+    )
+    gpd.GeoDataFrame({"hru_id_nat": kept + 1000000}, geometry=geometry, crs="EPSG:4326").to_file(
+        os.path.join(gis_dir, "HRU_subset.shp")
+    )
+    pd.DataFrame({"hru_id": ids, "hru_id_nat": ids + 1000000}).to_csv(
+        os.path.join(gis_dir, "nhm_hru_id_crosswalk.csv"), index=False
+    )
+
+
+def generate_dataset(
+    data_dir,
+    gis_dir,
+    n_streams=1000,
+    n_models=5,
+    n_scenarios=2,
+    n_eras=3,
+    n_stats=len(stat_vars_dict),
+    nodata_rate=0.01,
+    missing_column_rate=0.01,
+    clip_rate=0.9,
+    diff=False,
+    seed=0,
+):
+    # write a full synthetic dataset: seg and hru CSVs for both landcovers and every run, plus the GIS files
+    # returns the number of CSVs written
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    stats = list(stat_vars_dict.keys())[:n_stats]
+    ids = np.arange(1, n_streams + 1)
+
+    count = 0
+    for landcover in encodings_lookup["landcover"]:
+        for model, scenario, era, is_diff in get_synthetic_runs(n_models, n_scenarios, n_eras, diff):
+            for type in ["seg", "hru"]:
+                suffix = "_diff" if is_diff else ""
+                name = f"{landcover}_{model}_{scenario}_r1i1p1_{type}_{era}{suffix}.csv"
+                write_stats_csv(
+                    os.path.join(data_dir, name), f"{type}_id", ids, stats, rng, nodata_rate, missing_column_rate
+                )
+                count += 1
+
+    write_gis_files(gis_dir, n_streams, clip_rate, rng)
+
+    return count
+
+
+if __name__ == "__main__":
+
+    data_dir, gis_dir, params = arguments(sys.argv)
+
+    print(f"Writing synthetic stats CSVs with {params['n_streams']} streams to {data_dir}...\n")
+    count = generate_dataset(data_dir, gis_dir, **params)
+    print(f"Wrote {count} CSVs to {data_dir} and GIS files to {gis_dir}.\n")
@@ -0,0 +1,127 @@
+# reader for the combined netCDFs written by seg_correct_and_combine.py (e.g. seg_combined.nc)
+# outputs written with --virtual only store the original_gcm and gcm_diff sources; the gcm_diff_applied_to_maurer source
+# is computed on read, for just the selected stream_ids, with the same rules as seg_correct_and_combine.py
+# recently computed stream blocks are kept in an LRU cache, so repeated queries for the same streams are not recomputed
+# stored sources (and outputs written without --virtual) are read straight from the file
+#
+# example:
+#     with CombinedReader("seg_combined.nc") as reader:
+#         da = reader.select("ma12", "gcm_diff_applied_to_maurer", [1001, 1002], model="CCSM4", scenario="rcp45")
+
+from functools import lru_cache
+import numpy as np
+import xarray as xr
+import netCDF4
+from functions import DIMS, set_auto_unpack, read_values, get_id_index, get_id_positions
+from luts import *
+from seg_correct_and_combine import (
+    SOURCE_ENCODING,
+    MONTHLY_VARS,
+    correct_block,
+    mean_monthly_block,
+    get_baseline_positions,
+)
+
+
+class CombinedReader:
+    # read stat values by source and stream_id from a combined netCDF, computing derived sources on demand
+
+    def __init__(self, path, cache_size=256):
+        self.nc = netCDF4.Dataset(path, "r")
+        set_auto_unpack(self.nc)
+
+        self.stream_ids = self.nc["stream_id"][:]
+        # the stream_ids are not necessarily sorted, so they are looked up through a sorted index
+        self.id_index = get_id_index(self.stream_ids)
+        self.coords = {dim: self.nc[dim][:] for dim in DIMS}
+        self.variables = [var for var in self.nc.variables if self.nc[var].dimensions[:1] == ("source",)]
+        # map source names to their positions along the stored source dimension
+        self.sources = {SOURCE_ENCODING[int(code)]: i for i, code in enumerate(self.nc["source"][:])}
+        self.derived = [name for name in SOURCE_ENCODING.values() if name not in self.sources]
+        self.baseline = get_baseline_positions(self.nc)
+
+        # cache the derived blocks, keyed by (var, source, stream positions)
+        self.read_derived = lru_cache(maxsize=cache_size)(self._read_derived)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.read_derived.cache_clear()
+        self.nc.close()
+
+    def get_stream_positions(self, stream_ids):
+        # get the positions of stream_ids in the file, raising a KeyError for IDs that are not there
+
+        stream_ids = np.atleast_1d(np.asarray(stream_ids, dtype=self.stream_ids.dtype))
+        positions = get_id_positions(self.stream_ids, stream_ids, self.id_index)
+        missing = stream_ids[positions < 0]
+        if len(missing) > 0:
+            raise KeyError(f"stream_ids not in the file: {missing.tolist()}")
+
+        return positions
+
+    def read_stored(self, var, source, positions):
+        # read a stored source of one variable for the streams at positions, as (landcover, model, scenario, era, stream_id)
+        # netCDF4 needs increasing indices, so the unique sorted positions are read and then put back in the requested order
+
+        unique, inverse = np.unique(positions, return_inverse=True)
+        if len(unique) > 0 and unique[-1] - unique[0] + 1 == len(unique):
+            # a contiguous range (e.g. a block of streams) is read as one slice
+            block = read_values(self.nc[var], (self.sources[source], Ellipsis, slice(unique[0], unique[-1] + 1)))
+        else:
+            block = read_values(self.nc[var], (self.sources[source], Ellipsis, unique))
+
+        return block[..., inverse]
+
+    def _read_derived(self, var, source, positions):
+        # compute a derived source of one variable for the streams at positions (a tuple, so it can be cached)
+
+        positions = np.array(positions, dtype=int)
+        if source != "gcm_diff_applied_to_maurer":
+            raise ValueError(f"Don't know how to derive the {source} source")
+        if self.baseline is None:
+            raise ValueError("The Maurer historical baseline is not in the file, can't derive the corrected values")
+
+        if var == "ma99":
+            # ma99 of the corrected values is the mean of the corrected monthly flow variables
+            monthly = [self.read_derived(month, source, tuple(positions)) for month in MONTHLY_VARS]
+            return mean_monthly_block(monthly)
+
+        seg_block = self.read_stored(var, "original_gcm", positions)
+        diff_block = self.read_stored(var, "gcm_diff", positions)
+        difference_method = self.nc[var].getncattr("difference_method")
+
+        return correct_block(var, seg_block, diff_block, self.baseline, difference_method)
+
+    def read(self, var, source, stream_ids):
+        # read the values of one variable and source for stream_ids, as an array of (landcover, model, scenario, era, stream_id)
+        # derived sources are computed for just these streams, or taken from the cache
+
+        if var not in self.variables:
+            raise KeyError(f"{var} is not in the file")
+        positions = self.get_stream_positions(stream_ids)
+        if source in self.sources:
+            return self.read_stored(var, source, positions)
+        if source in self.derived:
+            # return a copy, so the caller can't modify the cached block
+            return self.read_derived(var, source, tuple(positions.tolist())).copy()
+
+        raise KeyError(f"Unknown source: {source}; must be one of {list(SOURCE_ENCODING.values())}")
+
+    def select(self, var, source, stream_ids, **labels):
+        # read one variable and source for stream_ids as a DataArray, optionally selecting
+        # landcover, model, scenario and era by their names, e.g. model="CCSM4"
+
+        values = self.read(var, source, stream_ids)
+        coords = {dim: self.coords[dim] for dim in DIMS}
+        coords["stream_id"] = np.atleast_1d(stream_ids)
+        da = xr.DataArray(values, dims=DIMS + ["stream_id"], coords=coords, name=var)
+        da.attrs = {k: self.nc[var].getncattr(k) for k in self.nc[var].ncattrs() if k != "_FillValue"}
+
+        selection = {dim: encodings_lookup[dim][label] for dim, label in labels.items()}
+
+        return da.sel(selection)
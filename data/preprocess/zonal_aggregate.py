@@ -0,0 +1,179 @@
+# script and functions to aggregate the HRU stats of hru.nc (or hru_diff.nc) to watersheds, e.g. HUC8s
+# each zone gets the area-weighted mean of the HRUs that intersect it, weighted by the area of each HRU inside the zone
+# the weights are a sparse (zone, HRU) matrix of intersection areas, computed once from HRU_subset.shp and the zone
+# polygons in an equal-area CRS, and cached as a .npz file keyed by the hashes of both shapefiles
+# the weights are then applied to every stat, landcover, model, scenario and era at once as a sparse matrix product
+# HRUs with no data are left out of the mean of each zone, and zones without any data are NaN
+# any polygon layer with an ID column can be used as the zones, e.g. --zones WBDHU8.shp --zone_col huc8
+
+import argparse
+import sys
+import os
+import hashlib
+import numpy as np
+import xarray as xr
+import geopandas as gpd
+from scipy import sparse
+from manifest import hash_file
+from functions import get_id_positions
+
+# CONUS Albers equal-area, so intersection areas are comparable across the domain
+AREA_CRS = "EPSG:5070"
+
+
+def arguments(argv):
+    """Parse some args"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nc", type=str, help="HRU stats netCDF built by build_nc.py, e.g. hru.nc", required=True)
+    parser.add_argument("--hru_shp", type=str, help="HRU polygons, e.g. HRU_subset.shp", required=True)
+    parser.add_argument("--zones", type=str, help="zone polygons to aggregate to, e.g. WBDHU8.shp", required=True)
+    parser.add_argument("--output", type=str, help="path of the aggregated netCDF to write, e.g. huc8.nc", required=True)
+    parser.add_argument("--hru_col", type=str, default="hru_id_nat", help="HRU ID column of --hru_shp")
+    parser.add_argument("--zone_col", type=str, default="huc8", help="zone ID column of --zones")
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        default=None,
+        help="directory to cache the weights in (default: the directory of --output)",
+    )
+
+    args = parser.parse_args()
+    cache_dir = args.cache_dir if args.cache_dir is not None else os.path.dirname(os.path.abspath(args.output))
+
+    return args.nc, args.hru_shp, args.zones, args.output, args.hru_col, args.zone_col, cache_dir
+
+
+def get_weights_cache_path(hru_shp, zones_shp, hru_col, zone_col, cache_dir):
+    # path of the cached weights of a pair of shapefiles, e.g. <cache_dir>/HRU_subset_WBDHU8_huc8_<hash>.npz
+    # the hash is of both .shp and .dbf files, so the cache is invalidated whenever the geometries or IDs change
+
+    h = hashlib.sha256(f"{hru_col},{zone_col}".encode())
+    for shp in [hru_shp, zones_shp]:
+        root, _ = os.path.splitext(shp)
+        h.update(hash_file(f"{root}.shp").encode())
+        h.update(hash_file(f"{root}.dbf").encode())
+    digest = h.hexdigest()[:16]
+    hru_name = os.path.splitext(os.path.basename(hru_shp))[0]
+    zones_name = os.path.splitext(os.path.basename(zones_shp))[0]
+
+    return os.path.join(cache_dir, f"{hru_name}_{zones_name}_{zone_col}_{digest}.npz")
+
+
+def compute_weights(hru_shp, zones_shp, hru_col, zone_col):
+    # intersect the HRU and zone polygons, and get the area of each HRU inside each zone
+    # returns (weights, zone_ids, hru_ids), where weights is a sparse (zone, HRU) matrix of intersection areas in km2,
+    # zone_ids are the sorted zone IDs and hru_ids the sorted HRU IDs
+
+    hrus = gpd.read_file(hru_shp, columns=[hru_col]).to_crs(AREA_CRS)
+    zones = gpd.read_file(zones_shp, columns=[zone_col]).to_crs(AREA_CRS)
+    pieces = gpd.overlay(hrus, zones, how="intersection", keep_geom_type=True)
+    pieces["area"] = pieces.geometry.area / 1e6
+
+    # sum the areas of pieces of the same HRU and zone, e.g. from multipart polygons
+    areas = pieces.groupby([zone_col, hru_col])["area"].sum().reset_index()
+    # zone IDs are kept as strings (e.g. HUC codes with leading zeros), as a fixed-width array so they can be cached
+    zone_ids = np.unique(zones[zone_col].astype(str).to_numpy(dtype=str))
+    hru_ids = np.unique(hrus[hru_col].to_numpy(dtype=np.int64))
+    rows = np.searchsorted(zone_ids, areas[zone_col].astype(str).to_numpy(dtype=str))
+    cols = np.searchsorted(hru_ids, areas[hru_col].to_numpy(dtype=np.int64))
+    weights = sparse.csr_matrix((areas["area"].to_numpy(), (rows, cols)), shape=(len(zone_ids), len(hru_ids)))
+
+    return weights, zone_ids, hru_ids
+
+
+def load_weights(hru_shp, zones_shp, hru_col, zone_col, cache_dir=None):
+    # get the weights of compute_weights(), from the cache if possible
+    # if cache_dir is None, the weights are computed every time
+
+    if cache_dir is None:
+        return compute_weights(hru_shp, zones_shp, hru_col, zone_col)
+
+    cache_path = get_weights_cache_path(hru_shp, zones_shp, hru_col, zone_col, cache_dir)
+    if os.path.exists(cache_path):
+        print(f"Loading cached weights from {cache_path}...\n")
+        cache = np.load(cache_path)
+        weights = sparse.csr_matrix((cache["data"], cache["indices"], cache["indptr"]), shape=tuple(cache["shape"]))
+        return weights, cache["zone_ids"], cache["hru_ids"]
+
+    print(f"Intersecting {hru_shp} with {zones_shp} and caching the weights to {cache_path}...\n")
+    weights, zone_ids, hru_ids = compute_weights(hru_shp, zones_shp, hru_col, zone_col)
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary file first, so that an interrupted run never leaves a partial cache
+    tmp_path = f"{cache_path}.tmp.npz"
+    np.savez(
+        tmp_path,
+        data=weights.data,
+        indices=weights.indices,
+        indptr=weights.indptr,
+        shape=np.array(weights.shape),
+        zone_ids=zone_ids,
+        hru_ids=hru_ids,
+    )
+    os.replace(tmp_path, cache_path)
+
+    return weights, zone_ids, hru_ids
+
+
+def align_weights(weights, hru_ids, stream_ids):
+    # reorder the HRU columns of the weights to the stream_ids of a netCDF
+    # HRUs that are not in the netCDF are dropped, and HRUs without any polygon get no weight
+
+    positions = get_id_positions(stream_ids, hru_ids)
+    found = positions >= 0
+
+    mapping = sparse.csr_matrix(
+        (np.ones(found.sum()), (np.flatnonzero(found), positions[found])), shape=(len(hru_ids), len(stream_ids))
+    )
+
+    return (weights @ mapping).tocsr()
+
+
+def aggregate_values(weights, values):
+    # area-weighted mean of values (..., HRU) for each zone, leaving out HRUs with NaN values
+    # returns an array of (..., zone)
+
+    shape = values.shape
+    values = values.reshape(-1, shape[-1])
+    valid = np.isfinite(values)
+
+    total = (weights @ np.where(valid, values, 0).T.astype(np.float64)).T
+    area = (weights @ valid.T.astype(np.float64)).T
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = np.where(area > 0, total / area, np.nan)
+
+    return means.astype(np.float32).reshape(shape[:-1] + (weights.shape[0],))
+
+
+def aggregate_dataset(ds, weights, zone_ids, zone_col):
+    # aggregate every stat variable of an HRU dataset to the zones, keeping all other dimensions and coordinates
+    # the weights must already be aligned to the stream_ids of ds (see align_weights())
+
+    data_vars = {}
+    for var in ds.data_vars:
+        da = ds[var]
+        if da.dims[-1:] != ("stream_id",):
+            continue
+        values = aggregate_values(weights, da.values)
+        data_vars[var] = (da.dims[:-1] + (zone_col,), values, da.attrs)
+
+    coords = {name: coord for name, coord in ds.coords.items() if "stream_id" not in coord.dims}
+    coords[zone_col] = ([zone_col], zone_ids.astype(str))
+    # the area of each zone covered by HRUs in the input, to help judge how representative each mean is
+    coords["hru_area_km2"] = ([zone_col], np.asarray(weights.sum(axis=1)).ravel().astype(np.float32))
+
+    return xr.Dataset(data_vars, coords=coords, attrs=ds.attrs)
+
+
+if __name__ == "__main__":
+
+    nc_path, hru_shp, zones_shp, outfile, hru_col, zone_col, cache_dir = arguments(sys.argv)
+
+    weights, zone_ids, hru_ids = load_weights(hru_shp, zones_shp, hru_col, zone_col, cache_dir)
+
+    ds = xr.open_dataset(nc_path)
+    weights = align_weights(weights, hru_ids, ds["stream_id"].values.astype(np.int64))
+    print(f"Aggregating {nc_path} to {len(zone_ids)} zones of {zones_shp}...\n")
+    aggregated = aggregate_dataset(ds, weights, zone_ids, zone_col)
+    aggregated.to_netcdf(outfile)
+    ds.close()
+    print(f"Wrote {outfile}.\n")
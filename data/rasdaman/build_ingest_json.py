@@ -53,10 +53,20 @@ def build_ingest_json(ds, type):
     axes_dict = {}
     grid_order = 0
     # list all dims including stream_id
-    all_dims = list(ds.coords.keys())
+    # outputs in the compact layout (build_nc.py --compact) only have the run and stream_id axes
+    if "run" in ds.dims:
+        all_dims = ["run", "stream_id"]
+    else:
+        all_dims = list(ds.coords.keys())
     # move stream_id to the end of the list
     all_dims.append(all_dims.pop(all_dims.index("stream_id")))
 
+    crs = "@".join([f'OGC/0/Index1D?axis-label="{dim}"' for dim in all_dims])
+    if "run" in ds.dims:
+        tiling = f"ALIGNED [0:{ds.sizes['run'] - 1}, 0:0] tile size 1048576"
+    else:
+        tiling = "ALIGNED [0:1, 0:13, 0:4, 0:3, 0:0] tile size 1048576"
+
     for dim in all_dims:
         axes_dict[dim] = {
             "min": f"${{netcdf:variable:{dim}:min}}",
@@ -85,11 +95,11 @@ def build_ingest_json(ds, type):
         "recipe": {
             "name": "general_coverage",
             "options": {
-                "tiling": "ALIGNED [0:1, 0:13, 0:4, 0:3, 0:0] tile size 1048576",
+                "tiling": tiling,
                 "wms_import": "false",
                 "import_order": "ascending",
                 "coverage": {
-                    "crs": 'OGC/0/Index1D?axis-label="landcover"@OGC/0/Index1D?axis-label="model"@OGC/0/Index1D?axis-label="scenario"@OGC/0/Index1D?axis-label="era"@OGC/0/Index1D?axis-label="stream_id"',
+                    "crs": crs,
                     "metadata": {
                         "type": "xml",
                         "global": "auto"